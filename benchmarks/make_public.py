@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Micro-benchmark of `api.make_public` (precompiled URI templates, single
+pass) against the recursive `url_for` implementation, on a list of posts as
+returned by `DataBase.get_all_posts()`.
+
+Usage: python make_public.py [number_of_posts]
+'''
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from flask import url_for
+
+import api
+
+def url_for_make_public(obj):
+    '''`make_public` as implemented with `url_for` and recursion
+    '''
+    if not isinstance(obj, dict):
+        return obj
+    newdic = {}
+    for key, val in obj.iteritems():
+        if isinstance(val, dict):
+            newdic[key] = url_for_make_public(val)
+        elif isinstance(val, list):
+            newdic[key] = [url_for_make_public(x) for x in val]
+        elif key.endswith('id'):
+            root = key.split('_')[0]
+            newdic['uri'] = url_for('get_'+root, obj_id=val, _external=True)
+        else:
+            newdic[key] = val
+    return newdic
+
+def payload(n_posts):
+    '''Serialized posts with their item, location, tags and photos
+    '''
+    now = datetime.datetime.utcnow()
+    return [{'post_id': j+1,
+             'rating': j % 5 + 1,
+             'review': 'Review %d' % j,
+             'post_datetime': (now -
+                               datetime.timedelta(minutes=j)).isoformat(),
+             'tags': [{'tag_id': tag_id, 'tag_name': 'tag%d' % tag_id,
+                       'number_of_posts': 10}
+                      for tag_id in (j % 7, j % 11, j % 13)],
+             'photos': ([{'photo_id': j, 'file_name': 'photo%d.jpg' % j}]
+                        if j % 3 == 0 else []),
+             'item': {'item_id': j % 1000,
+                      'item_name': 'Item %d' % (j % 1000),
+                      'category': 'Place\\Business\\Restaurant',
+                      'rating': 3.5,
+                      'location': {'location_id': j % 1000,
+                                   'lat': 37.7749,
+                                   'lon': -122.4194,
+                                   'address': 'Address %d' % j}}}
+            for j in range(n_posts)]
+
+def main(n_posts):
+    posts = payload(n_posts)
+    with api.APP.test_request_context('/api/v'+api.config.API_VERSION+'/'):
+        assert ([url_for_make_public(post) for post in posts] ==
+                [api.make_public(post) for post in posts])
+        t_old = min(timeit.repeat(
+            lambda: [url_for_make_public(post) for post in posts],
+            number=1, repeat=5))
+        t_new = min(timeit.repeat(
+            lambda: [api.make_public(post) for post in posts],
+            number=1, repeat=5))
+    print '{0} posts'.format(n_posts)
+    print '{0:<12}{1:>12}{2:>14}{3:>10}'.format('', 'url_for (s)',
+                                               'template (s)', 'speedup')
+    print '{0:<12}{1:>12.4f}{2:>14.4f}{3:>9.1f}x'.format(
+        'make_public', t_old, t_new, t_old/t_new)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
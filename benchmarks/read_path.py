@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of the projection-based read path against the ORM path for the
+list methods of `queries.DataBase`.
+
+Usage: python read_path.py [number_of_posts]
+'''
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+import dbmodels
+import queries
+
+def populate(dbase, n_posts):
+    '''Fill an empty database with random items, tags and posts
+    '''
+    n_items = max(n_posts//10, 1)
+    n_tags = max(n_posts//50, 3)
+    session = dbase.session
+    for j in range(10):
+        session.add(dbmodels.Categories(category_name='Category %d' % j))
+    session.commit()
+    session.execute(dbmodels.Locations.__table__.insert(),
+                    [{'location_id': j+1,
+                      'lat': random.uniform(-90, 90),
+                      'lon': random.uniform(-180, 180),
+                      'address': 'Address %d' % j} for j in range(n_items)])
+    session.execute(dbmodels.Items.__table__.insert(),
+                    [{'item_id': j+1,
+                      'item_name': 'Item %d' % j,
+                      'category_id': random.randint(1, 10),
+                      'location_id': j+1 if j % 2 else None}
+                     for j in range(n_items)])
+    session.execute(dbmodels.Tags.__table__.insert(),
+                    [{'tag_id': j+1, 'tag_name': 'tag%d' % j}
+                     for j in range(n_tags)])
+    now = datetime.datetime.utcnow()
+    session.execute(dbmodels.Posts.__table__.insert(),
+                    [{'post_id': j+1,
+                      'post_datetime': now - datetime.timedelta(minutes=j),
+                      'user_id': 1,
+                      'item_id': random.randint(1, n_items),
+                      'rating': random.randint(1, 5)}
+                     for j in range(n_posts)])
+    session.execute(dbmodels.t_posts_tags.insert(),
+                    [{'post_id': j+1, 'tag_id': tag_id}
+                     for j in range(n_posts)
+                     for tag_id in random.sample(range(1, n_tags+1), 3)])
+    session.execute(dbmodels.Photos.__table__.insert(),
+                    [{'post_id': j+1, 'file_name': 'photo%d.jpg' % j}
+                     for j in range(0, n_posts, 3)])
+    session.commit()
+    dbase.rebuild_item_ratings()
+    dbase.rebuild_tag_counts()
+
+def orm_path(dbase):
+    '''The list methods as implemented with ORM instances
+    '''
+    items = queries.get_all_obj(dbmodels.Items,
+                                order_by=lambda x: x['item_name'],
+                                profile='item')
+    posts = queries.get_all_obj(dbmodels.Posts,
+                                order_by=dbmodels.Posts.post_datetime.desc(),
+                                profile='post_with_item', with_item=True)
+    tags = queries.get_all_obj(dbmodels.Tags, order_by=dbmodels.Tags.tag_name)
+    return {'get_all_items': lambda: items(dbase),
+            'get_all_posts': lambda: posts(dbase),
+            'get_all_tags': lambda: tags(dbase)}
+
+def main(n_posts):
+    path = tempfile.mkdtemp()
+    try:
+        dbmodels.set_up_database(path)
+        dbase = queries.DataBase(path)
+        populate(dbase, n_posts)
+        orm = orm_path(dbase)
+        print '{0} posts'.format(n_posts)
+        print '{0:<16}{1:>10}{2:>16}{3:>10}'.format('method', 'orm (s)',
+                                                   'projection (s)',
+                                                   'speedup')
+        for name in sorted(orm):
+            assert orm[name]() == getattr(dbase, name)()
+            ## Expire the identity map so that the ORM path pays the
+            ## hydration cost of every run
+            t_orm = min(timeit.repeat(
+                lambda: (dbase.session.expire_all(), orm[name]()),
+                number=1, repeat=5))
+            t_proj = min(timeit.repeat(getattr(dbase, name),
+                                       number=1, repeat=5))
+            print '{0:<16}{1:>10.4f}{2:>16.4f}{3:>9.1f}x'.format(
+                name, t_orm, t_proj, t_orm/t_proj)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -8,11 +8,17 @@
 Module for the Flask RESTful API.
 '''
 
+import itertools
+import json
+
 import queries
 import config
+import trending
 
-from flask import Flask, jsonify, abort, make_response, url_for, request
+from flask import (Flask, jsonify, abort, make_response, url_for, request,
+                   Response, stream_with_context)
 from queries import IntegrityError
+from duplicates import DuplicateItemError
 # from flask.ext.httpauth import HTTPBasicAuth
 
 DATABASE = queries.DataBase()
@@ -44,41 +50,194 @@ def not_found(error):
     '''
     return make_response(jsonify({'error': 'Not found'}), 404)
 
-def get_uri(funcname, obj_id):
+@APP.errorhandler(DuplicateItemError)
+def duplicate_item(error):
+    '''Similar items already exist (Error 409), for an item created with
+    `check_duplicates`: they can be used instead, or the item created anyway
+    without `check_duplicates`
+    '''
+    return make_response(jsonify({'error': 'Similar items already exist',
+                                  'items': [make_public(candidate) for
+                                            candidate in error.candidates]}),
+                         409)
+
+## Path of the resource URIs, e.g. URI_TEMPLATES['get_tag'] ==
+## '/api/v1.0/tags/{}/'. They are built once, after all routes are registered
+## (see `build_uri_templates`), and formatted without going through the URL
+## map at every call.
+URI_TEMPLATES = {}
+
+def build_uri_templates():
+    '''Build the URI template of every route that takes a single `obj_id`
+    '''
+    ## Placeholder id, replaced by the template field once the URL is built
+    placeholder = 918273645
+    adapter = APP.url_map.bind('localhost')
+    templates = {}
+    for rule in APP.url_map.iter_rules():
+        if rule.arguments != set(['obj_id']) or rule.endpoint in templates:
+            continue
+        path = adapter.build(rule.endpoint, {'obj_id': placeholder})
+        templates[rule.endpoint] = path.replace(str(placeholder), '{}')
+    return templates
+
+def get_uri(funcname, obj_id, root=None):
     '''Get URI given an object id and the handler function
     '''
-    return url_for(funcname, obj_id=obj_id, _external=True)
+    template = URI_TEMPLATES.get(funcname)
+    if template is None:
+        return url_for(funcname, obj_id=obj_id, _external=True)
+    if root is None:
+        root = request.url_root[:-1]
+    return root+template.format(obj_id)
 
 def make_public(obj):
-    '''transform all ids in URI
+    '''transform all ids in URI. The nested dictionaries and lists are
+    rewritten in a single pass, with an explicit stack instead of recursion.
     '''
     if not isinstance(obj, dict):
         return obj
+    root = request.url_root[:-1]
     newdic = {}
-    for key, val in obj.iteritems():
-        if isinstance(val, dict):
-            newdic[key] = make_public(val)
-        elif isinstance(val, list):
-            newdic[key] = [make_public(x) for x in val]
-        elif key.endswith('id'):
-            root = key.split('_')[0]
-            newdic['uri'] = get_uri('get_'+root, val)
-        else:
-            newdic[key] = val
+    stack = [(obj, newdic)]
+    while stack:
+        dic, newdic_ = stack.pop()
+        for key, val in dic.iteritems():
+            if isinstance(val, dict):
+                newdic_[key] = {}
+                stack.append((val, newdic_[key]))
+            elif isinstance(val, list):
+                newlist = newdic_[key] = []
+                for elem in val:
+                    if isinstance(elem, dict):
+                        newlist.append({})
+                        stack.append((elem, newlist[-1]))
+                    else:
+                        newlist.append(elem)
+            elif key.endswith('id'):
+                newdic_['uri'] = get_uri('get_'+key.split('_')[0], val,
+                                         root=root)
+            else:
+                newdic_[key] = val
     return newdic
 
+def page_args(default=config.PAGE_SIZE):
+    '''Get the `limit` (`default` if absent) and `cursor` parameters of a
+    collection request
+    '''
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= config.MAX_PAGE_SIZE:
+        abort(400)
+    return limit, request.args.get('cursor')
+
+def make_page(kind, objs, limit, fields=None):
+    '''JSON response for a page of a collection, with a `next_cursor` if
+    there may be more objects. The objects must contain the page keys (see
+    `queries.with_page_keys`) and are restricted to `fields` afterwards.
+    '''
+    cursor = queries.next_cursor(kind, objs, limit)
+    response = {kind: [make_public(queries.only_fields(obj, fields))
+                       for obj in objs]}
+    if cursor is not None:
+        response['next_cursor'] = cursor
+    return jsonify(response)
+
+def fieldset_args():
+    '''Get the `fields` and `expand` parameters of a request, as lists of
+    names (None if absent)
+    '''
+    def names(arg):
+        value = request.args.get(arg)
+        if value is None:
+            return
+        return [name.strip() for name in value.split(',') if name.strip()]
+    return names('fields'), names('expand')
+
+def streaming():
+    '''Whether a collection request asks for a streaming response
+    (`?stream=1`)
+    '''
+    return request.args.get('stream', '0') not in ('0', 'false', '')
+
+def make_stream(kind, **kwargs):
+    '''Chunked JSON response with all the objects of a collection. The
+    objects are fetched in batches and encoded one at a time, so the full
+    collection is never held in memory. Keyword arguments are passed to
+    `DataBase.iter_all`. An empty collection is not found (Error 404), as
+    when it is paged.
+    '''
+    objs = DATABASE.iter_all(kind, **kwargs)
+    ## Fetch the first batch right away, so that invalid parameters raise
+    ## before the response has started
+    first = list(itertools.islice(objs, 1))
+    if not first:
+        abort(404)
+    def generate():
+        yield '{{"{}": ['.format(kind)
+        separator = ''
+        for obj in itertools.chain(first, objs):
+            yield separator+json.dumps(make_public(obj))
+            separator = ', '
+        yield ']}'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+def make_batch(kind, public=True):
+    '''Create the objects of a batch request (`{"<kind>s": [...]}`) in a
+    single transaction. The response has one result per object, its uri (or
+    ids with `public=False`) or its error, with status 201 if all the
+    objects were created and 207 otherwise.
+    '''
+    content = request.get_json()
+    if not content or kind+'s' not in content:
+        abort(400)
+    try:
+        results = getattr(DATABASE, 'create_'+kind+'s')(content[kind+'s'])
+    except (TypeError, ValueError, IntegrityError):
+        abort(400)
+    status = 207 if any('error' in result for result in results) else 201
+    if public:
+        results = [make_public(result) for result in results]
+    return jsonify({'results': results}), status
+
 ### TAGS ###
 
 @APP.route('/api/v'+config.API_VERSION+'/tags', methods=['GET'])
 @APP.route('/api/v'+config.API_VERSION+'/tags/', methods=['GET'])
 # @auth.login_required
 def get_tags():
-    '''Get all tags in JSON format
+    '''Get all tags in JSON format (streamed with `?stream=1`)
     '''
-    tags = DATABASE.get_all_tags()
-    if not tags:
+    if streaming():
+        return make_stream('tags')
+    limit, cursor = page_args()
+    try:
+        tags = DATABASE.get_all_tags(limit=limit, cursor=cursor)
+    except ValueError:
+        abort(400)
+    if not tags and cursor is None:
         abort(404)
-    return jsonify({'tags': [make_public(tag) for tag in tags]})
+    return make_page('tags', tags, limit)
+
+@APP.route('/api/v'+config.API_VERSION+'/tags/trending', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/tags/trending/', methods=['GET'])
+# @auth.login_required
+def get_trending_tags():
+    '''Get the `?n=` tags with the most posts over the last `?window=` (e.g.
+    1h, 24h or 7d, 24h by default)
+    '''
+    try:
+        window = trending.parse_window(request.args.get('window', '24h'))
+        n_tags = int(request.args.get('n', 5))
+    except ValueError:
+        abort(400)
+    if not 0 < n_tags <= config.MAX_PAGE_SIZE:
+        abort(400)
+    tags = DATABASE.get_trendy_tags(timediff=window, n_tags=n_tags)
+    return jsonify({'tags': tags})
 
 @APP.route('/api/v'+config.API_VERSION+'/tags', methods=['POST'])
 @APP.route('/api/v'+config.API_VERSION+'/tags/', methods=['POST'])
@@ -98,6 +257,14 @@ def post_tag():
         abort(400)
     return jsonify({'tag': tag}), 201
 
+@APP.route('/api/v'+config.API_VERSION+'/tags/batch', methods=['POST'])
+@APP.route('/api/v'+config.API_VERSION+'/tags/batch/', methods=['POST'])
+# @auth.login_required
+def post_tags_batch():
+    '''Create new tags in a single transaction
+    '''
+    return make_batch('tag')
+
 @APP.route('/api/v'+config.API_VERSION+'/tags/<int:obj_id>', methods=['GET'])
 @APP.route('/api/v'+config.API_VERSION+'/tags/<int:obj_id>/', methods=['GET'])
 # @auth.login_required
@@ -129,13 +296,18 @@ def delete_tag(obj_id):
 @APP.route('/api/v'+config.API_VERSION+'/categories/', methods=['GET'])
 # @auth.login_required
 def get_categories():
-    '''Get all categories in JSON format
+    '''Get all categories in JSON format (streamed with `?stream=1`)
     '''
-    categories = DATABASE.get_all_categories()
-    if not categories:
+    if streaming():
+        return make_stream('categories')
+    limit, cursor = page_args()
+    try:
+        categories = DATABASE.get_all_categories(limit=limit, cursor=cursor)
+    except ValueError:
+        abort(400)
+    if not categories and cursor is None:
         abort(404)
-    return jsonify({'categories': [make_public(category)
-                                   for category in categories]})
+    return make_page('categories', categories, limit)
 
 @APP.route('/api/v'+config.API_VERSION+'/categories', methods=['POST'])
 @APP.route('/api/v'+config.API_VERSION+'/categories/', methods=['POST'])
@@ -168,6 +340,26 @@ def get_category(obj_id):
         abort(404)
     return jsonify({'category': make_public(category)})
 
+@APP.route('/api/v'+config.API_VERSION+'/categories/<int:obj_id>/items',
+           methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/categories/<int:obj_id>/items/',
+           methods=['GET'])
+# @auth.login_required
+def get_category_items(obj_id):
+    '''Get the items of a specific category (and of all its subcategories
+    with `?recursive=1`) in JSON format
+    '''
+    recursive = request.args.get('recursive', '0') not in ('0', 'false', '')
+    limit, cursor = page_args()
+    try:
+        items = DATABASE.get_category_items(obj_id, recursive=recursive,
+                                            limit=limit, cursor=cursor)
+    except ValueError:
+        abort(400)
+    if items is None:
+        abort(404)
+    return make_page('items', items, limit)
+
 @APP.route('/api/v'+config.API_VERSION+'/categories/<int:obj_id>',
            methods=['DELETE'])
 @APP.route('/api/v'+config.API_VERSION+'/categories/<int:obj_id>/',
@@ -279,12 +471,26 @@ def delete_photo(obj_id):
 @APP.route('/api/v'+config.API_VERSION+'/items/', methods=['GET'])
 # @auth.login_required
 def get_items():
-    '''Get all items in JSON format
+    '''Get all items in JSON format (streamed with `?stream=1`). The fields
+    can be restricted with `?fields=` and the location left out with
+    `?expand=`.
     '''
-    items = DATABASE.get_all_items()
-    if not items:
+    fields, expand = fieldset_args()
+    if streaming():
+        try:
+            return make_stream('items', fields=fields, expand=expand)
+        except ValueError:
+            abort(400)
+    limit, cursor = page_args()
+    try:
+        items = DATABASE.get_all_items(
+            limit=limit, cursor=cursor,
+            fields=queries.with_page_keys('items', fields), expand=expand)
+    except ValueError:
+        abort(400)
+    if not items and cursor is None:
         abort(404)
-    return jsonify({'items': [make_public(item) for item in items]})
+    return make_page('items', items, limit, fields=fields)
 
 @APP.route('/api/v'+config.API_VERSION+'/items', methods=['POST'])
 @APP.route('/api/v'+config.API_VERSION+'/items/', methods=['POST'])
@@ -304,13 +510,51 @@ def post_item():
         abort(400)
     return jsonify({'item': item}), 201
 
+@APP.route('/api/v'+config.API_VERSION+'/items/batch', methods=['POST'])
+@APP.route('/api/v'+config.API_VERSION+'/items/batch/', methods=['POST'])
+# @auth.login_required
+def post_items_batch():
+    '''Create new items in a single transaction
+    '''
+    return make_batch('item')
+
+@APP.route('/api/v'+config.API_VERSION+'/items/nearby', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/items/nearby/', methods=['GET'])
+# @auth.login_required
+def get_nearby_items():
+    '''Get the items within `?radius=` km of `?lat=`,`?lon=`, or the
+    `?limit=` nearest ones without a radius, closest first. `?category=`
+    restricts the search to a category and its subcategories.
+    '''
+    args = request.args
+    if 'lat' not in args or 'lon' not in args:
+        abort(400)
+    try:
+        limit = args.get('limit', type=int)
+        if limit is not None and limit > config.MAX_PAGE_SIZE:
+            abort(400)
+        category_id = args.get('category')
+        items = DATABASE.get_nearby_items(
+            args['lat'], args['lon'], radius=args.get('radius'), limit=limit,
+            category_id=int(category_id) if category_id else None)
+    except ValueError:
+        abort(400)
+    if items is None:
+        abort(404)
+    return jsonify({'items': [make_public(item) for item in items]})
+
 @APP.route('/api/v'+config.API_VERSION+'/items/<int:obj_id>', methods=['GET'])
 @APP.route('/api/v'+config.API_VERSION+'/items/<int:obj_id>/', methods=['GET'])
 # @auth.login_required
 def get_item(obj_id):
-    '''Get a specific item in JSON format
+    '''Get a specific item in JSON format, restricted to `?fields=` and
+    `?expand=location,posts` if given
     '''
-    item = DATABASE.get_item(obj_id)
+    fields, expand = fieldset_args()
+    try:
+        item = DATABASE.get_item(obj_id, fields=fields, expand=expand)
+    except ValueError:
+        abort(400)
     if item is None:
         abort(404)
     return jsonify({'item': make_public(item)})
@@ -349,6 +593,14 @@ def post_comment():
         abort(400)
     return jsonify({'comment': comment}), 201
 
+@APP.route('/api/v'+config.API_VERSION+'/comments/batch', methods=['POST'])
+@APP.route('/api/v'+config.API_VERSION+'/comments/batch/', methods=['POST'])
+# @auth.login_required
+def post_comments_batch():
+    '''Create new comments in a single transaction
+    '''
+    return make_batch('comment')
+
 @APP.route('/api/v'+config.API_VERSION+'/comments/<int:obj_id>',
            methods=['DELETE'])
 @APP.route('/api/v'+config.API_VERSION+'/comments/<int:obj_id>/',
@@ -383,6 +635,14 @@ def post_like():
         abort(400)
     return jsonify({'like': like}), 201
 
+@APP.route('/api/v'+config.API_VERSION+'/likes/batch', methods=['POST'])
+@APP.route('/api/v'+config.API_VERSION+'/likes/batch/', methods=['POST'])
+# @auth.login_required
+def post_likes_batch():
+    '''Create new likes in a single transaction
+    '''
+    return make_batch('like', public=False)
+
 @APP.route('/api/v'+config.API_VERSION+'/likes/<int:post_id>/<int:user_id>',
            methods=['DELETE'])
 @APP.route('/api/v'+config.API_VERSION+'/likes/<int:post_id>/<int:user_id>/',
@@ -403,11 +663,47 @@ def delete_like(post_id, user_id):
 @APP.route('/api/v'+config.API_VERSION+'/posts/', methods=['GET'])
 # @auth.login_required
 def get_posts():
-    '''Get all posts in JSON format
+    '''Get all posts in JSON format (streamed with `?stream=1`). The fields
+    can be restricted with `?fields=` and the embedded relationships with
+    `?expand=item,tags,photos`.
     '''
-    posts = DATABASE.get_all_posts()
-    if not posts:
+    fields, expand = fieldset_args()
+    if streaming():
+        try:
+            return make_stream('posts', fields=fields, expand=expand)
+        except ValueError:
+            abort(400)
+    limit, cursor = page_args()
+    try:
+        posts = DATABASE.get_all_posts(
+            limit=limit, cursor=cursor,
+            fields=queries.with_page_keys('posts', fields), expand=expand)
+    except ValueError:
+        abort(400)
+    if not posts and cursor is None:
         abort(404)
+    return make_page('posts', posts, limit, fields=fields)
+
+@APP.before_first_request
+def load_recent_posts():
+    '''Fill the in-memory buffer of recent posts before the first request
+    '''
+    DATABASE.recent_posts.load(DATABASE.session)
+
+@APP.route('/api/v'+config.API_VERSION+'/posts/recent', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/posts/recent/', methods=['GET'])
+# @auth.login_required
+def get_recent_posts():
+    '''Get the `?n=` (at most `config.RECENT_POSTS`) most recent posts, from
+    memory
+    '''
+    try:
+        n_posts = int(request.args.get('n', 5))
+    except ValueError:
+        abort(400)
+    if not 0 < n_posts <= config.RECENT_POSTS:
+        abort(400)
+    posts = DATABASE.get_recent_posts(n_posts)
     return jsonify({'posts': [make_public(post) for post in posts]})
 
 @APP.route('/api/v'+config.API_VERSION+'/posts', methods=['POST'])
@@ -428,15 +724,28 @@ def post_post():
         abort(400)
     return jsonify({'post': post}), 201
 
+@APP.route('/api/v'+config.API_VERSION+'/posts/batch', methods=['POST'])
+@APP.route('/api/v'+config.API_VERSION+'/posts/batch/', methods=['POST'])
+# @auth.login_required
+def post_posts_batch():
+    '''Create new posts in a single transaction
+    '''
+    return make_batch('post')
+
 @APP.route('/api/v'+config.API_VERSION+'/posts/<int:obj_id>',
            methods=['GET'])
 @APP.route('/api/v'+config.API_VERSION+'/posts/<int:obj_id>/',
            methods=['GET'])
 # @auth.login_required
 def get_post(obj_id):
-    '''Get a specific post in JSON format
+    '''Get a specific post in JSON format, restricted to `?fields=` and
+    `?expand=item,tags,photos` if given
     '''
-    post = DATABASE.get_post(obj_id)
+    fields, expand = fieldset_args()
+    try:
+        post = DATABASE.get_post(obj_id, fields=fields, expand=expand)
+    except ValueError:
+        abort(400)
     if post is None:
         abort(404)
     return jsonify({'post': make_public(post)})
@@ -456,6 +765,116 @@ def get_user(obj_id):
         abort(404)
     return jsonify({'user': user})
 
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/friends',
+           methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/friends/',
+           methods=['GET'])
+# @auth.login_required
+def get_user_friends(obj_id):
+    '''Get the friends of a specific user in JSON format, one page at a
+    time
+    '''
+    limit, cursor = page_args()
+    try:
+        friends = DATABASE.get_friends(obj_id, limit=limit, cursor=cursor)
+    except ValueError:
+        abort(400)
+    if friends is None:
+        abort(404)
+    return make_page('friends', friends, limit)
+
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/feed',
+           methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/feed/',
+           methods=['GET'])
+# @auth.login_required
+def get_user_feed(obj_id):
+    '''Get the home timeline of a specific user in JSON format, one page at
+    a time
+    '''
+    limit, cursor = page_args()
+    try:
+        posts = DATABASE.get_feed(obj_id, limit=limit, cursor=cursor)
+    except ValueError:
+        abort(400)
+    if posts is None:
+        abort(404)
+    return make_page('posts', posts, limit)
+
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/suggestions',
+           methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/users/<int:obj_id>/suggestions/',
+           methods=['GET'])
+# @auth.login_required
+def get_user_suggestions(obj_id):
+    '''Get the friend suggestions of a specific user in JSON format
+    '''
+    try:
+        suggestions = DATABASE.get_friend_suggestions(
+            obj_id, limit=request.args.get('limit'))
+    except ValueError:
+        abort(400)
+    if suggestions is None:
+        abort(404)
+    return jsonify({'suggestions': [make_public(suggestion)
+                                    for suggestion in suggestions]})
+
+### MAP ###
+
+@APP.route('/api/v'+config.API_VERSION+'/map/clusters', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/map/clusters/', methods=['GET'])
+# @auth.login_required
+def get_map_clusters():
+    '''Get the clustered item markers of a bounding box
+    (`?bbox=min_lon,min_lat,max_lon,max_lat`) at a zoom level (`?zoom=`).
+    The response can be cached for `config.MAP_CACHE_MAX_AGE` seconds and
+    revalidated with its ETag.
+    '''
+    try:
+        clusters = DATABASE.get_map_clusters(request.args.get('zoom', 0),
+                                             request.args.get('bbox'))
+    except ValueError:
+        abort(400)
+    response = jsonify({'clusters': clusters})
+    response.cache_control.public = True
+    response.cache_control.max_age = config.MAP_CACHE_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
+
+### SEARCH ###
+
+@APP.route('/api/v'+config.API_VERSION+'/search', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/search/', methods=['GET'])
+# @auth.login_required
+def search():
+    '''Full-text search of the post reviews, item names and comments
+    (`?q=`), best matches first
+    '''
+    limit, cursor = page_args()
+    try:
+        results = DATABASE.search(request.args.get('q', u''), limit=limit,
+                                  cursor=cursor)
+    except ValueError:
+        abort(400)
+    return make_page('results', results, limit)
+
+@APP.route('/api/v'+config.API_VERSION+'/autocomplete', methods=['GET'])
+@APP.route('/api/v'+config.API_VERSION+'/autocomplete/', methods=['GET'])
+# @auth.login_required
+def autocomplete():
+    '''Most popular tags, items and categories (or only those of `?kind=`)
+    with a word starting with `?q=`, at most `?limit=`
+    '''
+    limit, _ = page_args(default=config.AUTOCOMPLETE_LIMIT)
+    try:
+        suggestions = DATABASE.autocomplete(request.args.get('q', u''),
+                                            kind=request.args.get('kind'),
+                                            limit=limit)
+    except ValueError:
+        abort(400)
+    return jsonify({'suggestions': [make_public(suggestion)
+                                    for suggestion in suggestions]})
+
 ### REST ###
 
 @APP.route('/', defaults={'path': ''})
@@ -511,5 +930,7 @@ def catch_all(path):
 #     tasks.remove(task[0])
 #     return jsonify({'result': True})
 
+URI_TEMPLATES.update(build_uri_templates())
+
 if __name__ == '__main__':
     APP.run(debug=True)
@@ -0,0 +1,43 @@
+'''
+.. module:: glob.changes
+
+Committed changes of the sessions, for the in-memory indexes.
+
+An index watching a session factory records what each flush changes in the
+`info` of the session, and applies these changes once the transaction is
+committed. The changes of a rolled back transaction are forgotten, so the
+index never sees objects that were not committed.
+'''
+
+from sqlalchemy import event
+
+def watch_changes(session_factory, key, collect, apply_changes,
+                  empty=list, flush_event='after_flush'):
+    '''Call `collect(session, changes)` at every flush of the sessions of
+    `session_factory` (a `sessionmaker` or `Session` class), where `changes`
+    is kept in `session.info[key]` (an `empty()` container at first), and
+    `apply_changes(changes)` when they are committed. `flush_event` is
+    'before_flush' to collect while the pending objects and their history
+    are still in the session.
+    '''
+    def on_flush(session, *args):
+        '''Record the changes of a flush until commit
+        '''
+        if key not in session.info:
+            session.info[key] = empty()
+        collect(session, session.info[key])
+
+    def on_commit(session):
+        '''Apply the changes of a committed transaction
+        '''
+        if key in session.info:
+            apply_changes(session.info.pop(key))
+
+    def on_rollback(session, *args):
+        '''Forget the changes of a rolled back transaction
+        '''
+        session.info.pop(key, None)
+
+    event.listen(session_factory, flush_event, on_flush)
+    event.listen(session_factory, 'after_commit', on_commit)
+    event.listen(session_factory, 'after_soft_rollback', on_rollback)
@@ -10,3 +10,41 @@ DBLOCAL = True
 DBFILE = 'dbglob.db'
 
 API_VERSION = '1.0'
+
+## Pagination of the collection endpoints
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+## Number of objects fetched at a time by the streaming responses
+STREAM_BATCH_SIZE = 500
+## Number of friends embedded in a user profile
+FRIENDS_PAGE_SIZE = 20
+## Number of friend suggestions cached for each user
+FRIEND_SUGGESTIONS = 10
+## Number of posts kept in each home timeline, and number of friends above
+## which the posts of a user are merged into feeds on read instead of write
+TIMELINE_SIZE = 800
+FANOUT_LIMIT = 1000
+## Number of most recent posts kept in memory
+RECENT_POSTS = 100
+## Size (in seconds) of the time buckets of the trending tag counters, and
+## number of days they are kept in memory
+TRENDING_BUCKET_SIZE = 60
+TRENDING_HORIZON = 7
+## Number of items returned by the nearest items queries
+NEARBY_ITEMS = 10
+## Deepest zoom level of the map clusters, and number of seconds the map
+## cluster responses can be cached
+MAP_MAX_ZOOM = 16
+MAP_CACHE_MAX_AGE = 60
+## Number of decimals of the coordinates under which two locations with the
+## same address are the same place (5 decimals is about a meter)
+LOCATION_PRECISION = 5
+## Size (in degrees, about a km) of the grid cells within which items are
+## compared to find duplicates, and similarity of the names (between 0 and 1)
+## above which two items of a category are duplicate candidates
+DUPLICATE_CELL_SIZE = 0.01
+DUPLICATE_SIMILARITY = 0.7
+## Number of suggestions returned by the autocompletion
+AUTOCOMPLETE_LIMIT = 10
+## Maximum number of objects created by a batch request
+MAX_BATCH_SIZE = 10000
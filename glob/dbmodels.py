@@ -14,13 +14,15 @@ import json
 import os
 import re
 from sqlalchemy import (Column, ForeignKey, BigInteger, Boolean, Date, DateTime,
-                        Float, Integer, SmallInteger, String, Table)
+                        Float, Index, Integer, SmallInteger, String, Table)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, validates, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, validates, sessionmaker, Session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import select, func, and_
+from sqlalchemy.sql.expression import ClauseElement
 
 class CommonBase(object):
     '''Methods and attribute common to all classes
@@ -32,6 +34,7 @@ class CommonBase(object):
 
 Base = declarative_base(cls=CommonBase)
 HASHLEN = 87
+RATINGS = range(1, 6)
 
 #################
 ### LOCATIONS ###
@@ -46,6 +49,14 @@ class Locations(Base):
     lat = Column(Float, nullable=False)
     lon = Column(Float, nullable=False)
     address = Column(String(250))
+    ## Coordinates snapped to `config.LOCATION_PRECISION` decimals, to find
+    ## the existing locations at the same place (see `location_key`)
+    geokey = Column(String(32), index=True)
+
+    def as_dict(self):
+        dic = super(Locations, self).as_dict()
+        del dic['geokey']
+        return dic
 #
 #     def as_dict(self):
 #         dic = {'lat': self.lat,
@@ -53,6 +64,28 @@ class Locations(Base):
 #                'address': self.address}
 #         return dic
 
+def location_key(lat, lon, precision=None):
+    '''Key of the grid cell of `config.LOCATION_PRECISION` decimal degrees
+    containing a point
+    '''
+    if precision is None:
+        precision = config.LOCATION_PRECISION
+    ## Adding 0. turns -0. into 0.
+    return '%.*f,%.*f' % (precision, round(float(lat), precision)+0.,
+                          precision, round(float(lon), precision)+0.)
+
+def address_key(address):
+    '''Normalized address, for comparisons
+    '''
+    return u' '.join((address or u'').lower().split())
+
+@event.listens_for(Locations, 'before_insert')
+@event.listens_for(Locations, 'before_update')
+def set_location_key(mapper, connection, target):
+    '''Keep the grid key of a location up to date with its coordinates
+    '''
+    target.geokey = location_key(target.lat, target.lon)
+
 #############
 ### USERS ###
 #############
@@ -117,6 +150,15 @@ class Users(Base):
     def friends(self):
         return self.friends_to+self.friends_from
 
+    def as_summary(self):
+        '''Compact serialization, used in friend lists
+        '''
+        return {'user_id': self.user_id,
+                'status': self.status.status_name if self.status else None,
+                'account_creation_date': (
+                    self.account_creation_date.isoformat()
+                    if self.account_creation_date else None)}
+
     def as_dict(self, friends=False):
         dic = {'account_creation_date': self.account_creation_date.isoformat(),
                'status': self.status.status_name,
@@ -125,8 +167,7 @@ class Users(Base):
                'comments': [comment.as_dict() for comment in self.comments],
                'likes': [like.as_dict(with_item=True) for like in self.likes]}
         if friends:
-            dic['friends'] = [friend.as_dict(friends=False)
-                              for friend in self.friends]
+            dic['friends'] = [friend.as_summary() for friend in self.friends]
 
         return dic
 
@@ -167,10 +208,17 @@ class Categories(Base):
     parent_id = Column(Integer, ForeignKey('categories.category_id'))
     parent = relationship('Categories', remote_side=[category_id])
 
+    ## Materialized path ("Place\\Business\\Hotel") and depth in the tree,
+    ## set right after the category is inserted (see `index_category`)
+    path = Column(String(250), index=True)
+    depth = Column(SmallInteger, default=0)
+
     items = relationship('Items', back_populates="category")
 
     @property
     def complete_string(self):
+        if self.path is not None:
+            return self.path
         if self.parent is None:
             return self.category_name
         return self.parent.complete_string + '\\' + self.category_name
@@ -182,6 +230,60 @@ class Categories(Base):
             dic['items'] = [item.as_dict() for item in self.items]
         return dic
 
+# Closure table of the category tree: one row for every (ancestor,
+# descendant) pair, including each category with itself at distance 0
+t_category_closure = Table('category_closure', Base.metadata,
+    Column('ancestor_id', Integer, ForeignKey('categories.category_id'),
+           primary_key=True),
+    Column('descendant_id', Integer, ForeignKey('categories.category_id'),
+           primary_key=True, index=True),
+    Column('distance', Integer, nullable=False),
+)
+
+@event.listens_for(Categories, 'after_insert')
+def index_category(mapper, connection, target):
+    '''Materialize the path, depth and closure rows of a new category.
+    Parents inserted in the same flush may not be indexed yet, so the tree is
+    walked up until an indexed ancestor (or a root) is found.
+    '''
+    table = Categories.__table__
+    closure = t_category_closure
+    names = [target.category_name]
+    ancestors = [(target.category_id, 0)]
+    depth = 0
+    parent_id = target.parent_id
+    while parent_id is not None:
+        parent = connection.execute(
+            select([table.c.category_name, table.c.parent_id,
+                    table.c.path, table.c.depth])
+            .where(table.c.category_id == parent_id)).first()
+        if parent is None:
+            break
+        depth += 1
+        if parent.path is not None:
+            names.append(parent.path)
+            ancestors.extend(
+                (row.ancestor_id, row.distance + depth)
+                for row in connection.execute(
+                    select([closure.c.ancestor_id, closure.c.distance])
+                    .where(closure.c.descendant_id == parent_id)))
+            depth += parent.depth
+            break
+        names.append(parent.category_name)
+        ancestors.append((parent_id, depth))
+        parent_id = parent.parent_id
+    path = '\\'.join(reversed(names))
+    connection.execute(table.update()
+                            .where(table.c.category_id == target.category_id)
+                            .values(path=path, depth=depth))
+    connection.execute(closure.insert(),
+                       [{'ancestor_id': ancestor_id,
+                         'descendant_id': target.category_id,
+                         'distance': distance}
+                        for ancestor_id, distance in ancestors])
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
 # Table saying what tag is in what posts
 t_posts_tags = Table('posts_tags', Base.metadata,
     Column('post_id', Integer, ForeignKey('posts.post_id')),
@@ -199,6 +301,10 @@ class Tags(Base):
 
     posts = relationship("Posts", secondary=t_posts_tags)
 
+    ## Number of posts carrying the tag, kept up to date when posts are
+    ## created, tagged or deleted (see `update_aggregates`)
+    post_count = Column(Integer, default=0, index=True)
+
     @validates('tag_name')
     def validate_tag(self, key, tag):
         '''tags should be case-insensitive
@@ -207,18 +313,7 @@ class Tags(Base):
 
     @property
     def number_of_posts(self):
-        return len(self.posts)
-
-    @hybrid_property
-    def h_number_of_posts(self):
-        return self.posts.count()
-
-    @h_number_of_posts.expression
-    def h_number_of_posts(cls):
-        return (select([func.count(t_posts_tags.c.post_id)]).
-                where(t_posts_tags.c.tag_id == cls.tag_id).
-                label("h_number_of_posts")
-                )
+        return self.post_count or 0
 
     def as_dict(self, with_posts=False):
         dic = {'tag_id': self.tag_id,
@@ -234,7 +329,7 @@ class Items(Base):
     __tablename__ = 'items'
 
     item_id = Column(Integer, primary_key=True)
-    item_name = Column(String(250), nullable=False)
+    item_name = Column(String(250), nullable=False, index=True)
 
     category_id = Column(Integer, ForeignKey('categories.category_id'),
                          nullable=False)
@@ -245,21 +340,44 @@ class Items(Base):
 
     posts = relationship("Posts", back_populates="item")
 
+    ## Rating aggregates of the item posts, kept up to date when posts are
+    ## created or deleted (see `update_aggregates`)
+    rating_sum = Column(Integer, default=0)
+    rating_count = Column(Integer, default=0)
+    rating_1 = Column(Integer, default=0)
+    rating_2 = Column(Integer, default=0)
+    rating_3 = Column(Integer, default=0)
+    rating_4 = Column(Integer, default=0)
+    rating_5 = Column(Integer, default=0)
+
     @property
     def rating(self):
-        rated_posts = [post for post in self.posts if post.rating is not None]
-        if not rated_posts:
+        if not self.rating_count:
             return None
-        return float(sum(post.rating
-                         for post in rated_posts))/float(len(rated_posts))
+        return float(self.rating_sum)/float(self.rating_count)
 
-    def as_dict(self, with_posts=False):
+    @property
+    def rating_histogram(self):
+        '''Number of posts for each rating, from 1 to 5
+        '''
+        return [getattr(self, 'rating_%d' % rating) or 0
+                for rating in RATINGS]
+
+    def as_dict(self, with_posts=False, expand=None):
+        '''`expand` restricts the embedded relationships to the given ones
+        among 'location' and 'posts'
+        '''
+        if expand is None:
+            expand = ('location', 'posts') if with_posts else ('location',)
         dic = {'item_id': self.item_id,
                'item_name': self.item_name,
                'category': self.category.complete_string,
-               'location': self.location.as_dict() if self.location else {},
                'rating': self.rating}
+        if 'location' in expand:
+            dic['location'] = self.location.as_dict() if self.location else {}
         if with_posts:
+            dic['rating_histogram'] = self.rating_histogram
+        if 'posts' in expand:
             dic['posts'] = [post.as_dict() for post in self.posts]
         return dic
 
@@ -270,7 +388,8 @@ class Posts(Base):
     __tablename__ = 'posts'
 
     post_id = Column(Integer, primary_key=True)
-    post_datetime = Column(DateTime(timezone=True), nullable=False)
+    post_datetime = Column(DateTime(timezone=True), nullable=False,
+                           index=True)
 
     user_id = Column(Integer, ForeignKey('users.user_id'),
                      nullable=False)
@@ -300,14 +419,23 @@ class Posts(Base):
     def tag_string(self):
         return ', '.join(tag.tag_name for tag in self.tags)
 
-    def as_dict(self, with_item=False, all_fields=False):
+    def as_dict(self, with_item=False, all_fields=False, expand=None):
+        '''`expand` restricts the embedded relationships to the given ones
+        among 'item', 'tags' and 'photos'
+        '''
+        if expand is None:
+            expand = ('tags', 'photos')
+            if with_item or all_fields:
+                expand += ('item',)
         dic = {'post_id': self.post_id,
                'rating': self.rating,
                'review': self.review,
-               'post_datetime': self.post_datetime.isoformat(),
-               'tags': [tag.as_dict() for tag in self.tags],
-               'photos': [photo.as_dict() for photo in self.photos]}
-        if with_item or all_fields:
+               'post_datetime': self.post_datetime.isoformat()}
+        if 'tags' in expand:
+            dic['tags'] = [tag.as_dict() for tag in self.tags]
+        if 'photos' in expand:
+            dic['photos'] = [photo.as_dict() for photo in self.photos]
+        if 'item' in expand:
             dic['item'] = self.item.as_dict()
         if all_fields:
             dic['is_favorite'] = self.is_favorite
@@ -316,6 +444,67 @@ class Posts(Base):
             dic['comments'] = [comment.as_dict() for comment in self.comments]
         return dic
 
+def add_to_column(obj, key, value):
+    '''Add `value` to a numeric column of `obj` in the upcoming flush. For
+    rows that already exist, the addition is done in SQL so that concurrent
+    updates are not lost.
+    '''
+    state = inspect(obj)
+    current = state.dict.get(key)
+    if state.persistent:
+        if not isinstance(current, ClauseElement):
+            current = getattr(type(obj), key)
+    elif current is None:
+        current = 0
+    setattr(obj, key, current + value)
+
+def rate_item(item, rating, sign=1):
+    '''Add (sign=1) or remove (sign=-1) a rating to the item aggregates
+    '''
+    add_to_column(item, 'rating_sum', sign*rating)
+    add_to_column(item, 'rating_count', sign)
+    if rating in RATINGS:
+        add_to_column(item, 'rating_%d' % rating, sign)
+
+def tag_posts(tags, sign=1):
+    '''Add (sign=1) or remove (sign=-1) a post to the tag counters
+    '''
+    for tag in tags:
+        add_to_column(tag, 'post_count', sign)
+
+@event.listens_for(Session, 'before_flush')
+def update_aggregates(session, flush_context, instances):
+    '''Update the denormalized aggregates (item ratings and tag counters) for
+    the posts that are about to be inserted, tagged or deleted, within the
+    same flush
+    '''
+    for obj in session.new:
+        if isinstance(obj, Posts):
+            tag_posts(obj.tags)
+            if obj.rating is None:
+                continue
+            item = obj.item
+            if item is None and obj.item_id is not None:
+                item = session.query(Items).get(obj.item_id)
+            if item is not None:
+                rate_item(item, obj.rating)
+        elif isinstance(obj, Tags):
+            add_to_column(obj, 'post_count', len(obj.posts))
+    for obj in session.dirty:
+        if isinstance(obj, Posts):
+            history = get_history(obj, 'tags')
+            tag_posts(history.added)
+            tag_posts(history.deleted, sign=-1)
+        elif isinstance(obj, Tags):
+            history = get_history(obj, 'posts')
+            add_to_column(obj, 'post_count',
+                          len(history.added) - len(history.deleted))
+    for obj in session.deleted:
+        if isinstance(obj, Posts):
+            tag_posts(obj.tags, sign=-1)
+            if obj.rating is not None:
+                rate_item(obj.item, obj.rating, sign=-1)
+
 ######################
 ### SOCIAL NETWORK ###
 ######################
@@ -343,17 +532,28 @@ class UserRelationships(Base):
     __tablename__ = 'user_relationships'
 
     first_user_id = Column(Integer, ForeignKey('users.user_id'),
-                           primary_key=True)
+                           primary_key=True, index=True)
     first_user = relationship(Users, foreign_keys=[first_user_id])
 
     second_user_id = Column(Integer, ForeignKey('users.user_id'),
-                            primary_key=True)
+                            primary_key=True, index=True)
     second_user = relationship(Users, foreign_keys=[second_user_id])
 
     type_id = Column(Integer,
                      ForeignKey('user_relationship_types.relationship_id'))
     type = relationship(UserRelationshipTypes)
 
+# Home timelines: the most recent posts of the friends of every user (capped,
+# see `timelines`), with the post date copied so that a page of a timeline is
+# a single range scan of the (user_id, post_datetime, post_id) index
+t_timelines = Table('timelines', Base.metadata,
+    Column('user_id', Integer, ForeignKey('users.user_id'), primary_key=True),
+    Column('post_id', Integer, ForeignKey('posts.post_id'), primary_key=True),
+    Column('post_datetime', DateTime(timezone=True), nullable=False),
+    Index('ix_timelines_user_id_post_datetime', 'user_id', 'post_datetime',
+          'post_id'),
+)
+
 
 class PostLikes(Base):
     '''The `post_likes` Table contains all the info about
@@ -390,8 +590,43 @@ class PostComments(Base):
         dic['datetime'] = dic['datetime'].isoformat()
         return dic
 
-def set_up_database(path=''):
+def upgrade_database(engine):
+    '''Bring a database created by an earlier version up to the current
+    models: create the missing tables, add the missing columns (ALTER TABLE,
+    as `create_all` leaves the existing tables alone) and create the missing
+    indexes. Returns the names of the created tables and added columns
+    ('table.column'), whose contents still have to be filled in.
+    '''
+    changes = set()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(connection)
+                changes.add(table.name)
+                continue
+            columns = set(column['name'] for column
+                          in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(
+                        'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                            table.name, column.name,
+                            column.type.compile(dialect=engine.dialect)))
+                    changes.add(table.name+'.'+column.name)
+            indexes = set(index['name'] for index
+                          in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+    return changes
 
+def set_up_database(path=''):
+    '''Create a new database, with its user status and relationship types.
+    Databases created by earlier versions are upgraded when they are opened
+    (see `upgrade_database` and `queries.DataBase`).
+    '''
     if config.DBLOCAL:
         engine = create_engine('sqlite:///'+os.path.join(path, config.DBFILE))
     Base.metadata.create_all(engine)
@@ -0,0 +1,153 @@
+'''
+.. module:: glob.duplicates
+
+Duplicate item candidates.
+
+Two items are candidates when they are in the same category, near each other
+and have similar names. The items are split in blocks: one per category and
+grid cell of `config.DUPLICATE_CELL_SIZE` degrees (the items without a
+location are in one block per category), and the names are only compared
+within a block and its neighbouring cells, instead of comparing all the pairs
+of items. The similarity of two names is the Jaccard index of the sets of
+trigrams of their normalized forms.
+'''
+
+from collections import defaultdict
+import math
+import re
+import unicodedata
+
+from sqlalchemy.sql import and_, select
+
+from dbmodels import Items, Locations
+import config
+import geo
+
+class DuplicateItemError(ValueError):
+    '''Raised when an item is created while similar items already exist.
+    `candidates` holds them (see `similar_items`).
+    '''
+    def __init__(self, candidates):
+        super(DuplicateItemError, self).__init__('Similar items already exist')
+        self.candidates = candidates
+
+def normalize_name(name):
+    '''Lower-case name without accents, punctuation nor extra whitespace
+    '''
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name or u'')
+    name = u''.join(char for char in name if not unicodedata.combining(char))
+    return u' '.join(re.findall(r'\w+', name.lower(), re.UNICODE))
+
+def trigrams(name):
+    '''Set of the trigrams of a normalized name (padded with spaces, so that
+    short names still have some)
+    '''
+    padded = u'  {} '.format(name)
+    return frozenset(padded[i:i+3] for i in range(len(padded)-2))
+
+def similarity(first, second):
+    '''Jaccard index of the trigram sets of two names, between 0 and 1
+    '''
+    first, second = (trigrams(normalize_name(first)),
+                     trigrams(normalize_name(second)))
+    return jaccard(first, second)
+
+def jaccard(first, second):
+    '''Jaccard index of two sets
+    '''
+    if not first and not second:
+        return 1.
+    shared = len(first & second)
+    return float(shared)/(len(first)+len(second)-shared)
+
+def cell(lat, lon):
+    '''Grid cell of a point, None without coordinates
+    '''
+    if lat is None or lon is None:
+        return None
+    size = config.DUPLICATE_CELL_SIZE
+    return int(math.floor(lat/size)), int(math.floor(lon/size))
+
+def neighbours(grid_cell):
+    '''A cell and the 8 cells around it (the cell itself without location)
+    '''
+    if grid_cell is None:
+        return [None]
+    row, column = grid_cell
+    return [(row+i, column+j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+def find_duplicates(items, threshold=None):
+    '''Pairs of similar items among `(item_id, item_name, category_id, lat,
+    lon)` rows, as `(item_id, duplicate_id, similarity)` with the oldest item
+    first, most similar pairs first
+    '''
+    if threshold is None:
+        threshold = config.DUPLICATE_SIMILARITY
+    blocks = defaultdict(list)
+    for item_id, item_name, category_id, lat, lon in items:
+        blocks[category_id, cell(lat, lon)].append(
+            (item_id, trigrams(normalize_name(item_name))))
+    pairs = []
+    for (category_id, grid_cell), members in blocks.iteritems():
+        others = [other for neighbour in neighbours(grid_cell)
+                  for other in blocks.get((category_id, neighbour), [])]
+        for item_id, grams in members:
+            for other_id, other_grams in others:
+                ## Every pair is seen from both sides: keep one
+                if other_id <= item_id:
+                    continue
+                ## The index cannot reach the threshold when the sizes are
+                ## too different
+                if (min(len(grams), len(other_grams)) <
+                        threshold*max(len(grams), len(other_grams))):
+                    continue
+                score = jaccard(grams, other_grams)
+                if score >= threshold:
+                    pairs.append((item_id, other_id, score))
+    pairs.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+    return pairs
+
+def similar_items(session, item_name, category_id, lat=None, lon=None,
+                  threshold=None):
+    '''Existing items of a block (see `find_duplicates`) with a name similar
+    to `item_name`, most similar first, with their `similarity`
+    '''
+    if threshold is None:
+        threshold = config.DUPLICATE_SIMILARITY
+    query = (select([Items.item_id, Items.item_name])
+             .where(Items.category_id == category_id))
+    grid_cell = cell(lat, lon)
+    if grid_cell is None:
+        query = query.where(Items.location_id.is_(None))
+    else:
+        ## Locations of the block and its neighbours, from the R*-tree
+        size = config.DUPLICATE_CELL_SIZE
+        row, column = grid_cell
+        query = query.where(Items.location_id.in_(
+            select([geo.RTREE.c.location_id])
+            .where(and_(geo.RTREE.c.max_lat >= (row-1)*size,
+                        geo.RTREE.c.min_lat < (row+2)*size,
+                        geo.RTREE.c.max_lon >= (column-1)*size,
+                        geo.RTREE.c.min_lon < (column+2)*size))))
+    grams = trigrams(normalize_name(item_name))
+    candidates = []
+    for item_id, name in session.execute(query.order_by(Items.item_id)):
+        score = jaccard(grams, trigrams(normalize_name(name)))
+        if score >= threshold:
+            candidates.append({'item_id': item_id,
+                               'item_name': name,
+                               'similarity': score})
+    candidates.sort(key=lambda dic: (-dic['similarity'], dic['item_id']))
+    return candidates
+
+def item_rows(session):
+    '''`(item_id, item_name, category_id, lat, lon)` rows of all the items,
+    for `find_duplicates`
+    '''
+    return session.execute(
+        select([Items.item_id, Items.item_name, Items.category_id,
+                Locations.lat, Locations.lon])
+        .select_from(Items.__table__.outerjoin(
+            Locations.__table__, Locations.location_id == Items.location_id)))
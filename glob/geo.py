@@ -0,0 +1,150 @@
+'''
+.. module:: glob.geo
+
+Nearby items, with an SQLite R*-tree index over the locations.
+
+Each location is a point (a degenerate box) in the `locations_rtree` table,
+kept in sync with the `locations` table by triggers. A radius query selects
+the locations in the bounding box(es) of the circle from the index, then
+keeps those within the radius (great-circle distance) among them. A nearest
+neighbours query runs radius queries on a growing radius until it has
+enough items.
+'''
+
+import math
+
+from sqlalchemy.sql import and_, column, or_, select, table, text
+
+from dbmodels import Items, t_category_closure
+import projections
+
+RTREE_TABLE = 'locations_rtree'
+
+## Mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0
+## Radius beyond which a circle covers the whole Earth
+MAX_RADIUS = math.pi*EARTH_RADIUS
+
+RTREE = table(RTREE_TABLE, column('location_id'), column('min_lat'),
+              column('max_lat'), column('min_lon'), column('max_lon'))
+
+CREATE_TABLE = ('CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING '
+                'rtree(location_id, min_lat, max_lat, min_lon, max_lon)')
+
+TRIGGERS = ['''
+CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON locations BEGIN
+    INSERT INTO {0} VALUES (new.location_id, new.lat, new.lat, new.lon,
+                            new.lon);
+END''', '''
+CREATE TRIGGER IF NOT EXISTS {0}_update AFTER UPDATE OF lat, lon
+ON locations BEGIN
+    UPDATE {0} SET min_lat = new.lat, max_lat = new.lat, min_lon = new.lon,
+                   max_lon = new.lon
+    WHERE location_id = old.location_id;
+END''', '''
+CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON locations BEGIN
+    DELETE FROM {0} WHERE location_id = old.location_id;
+END''']
+
+def install(engine):
+    '''Create the index and its triggers if they do not exist yet, and fill
+    the index when it is created
+    '''
+    with engine.begin() as connection:
+        exists = connection.execute(
+            text("SELECT name FROM sqlite_master WHERE name = :name"),
+            name=RTREE_TABLE).first()
+        if exists:
+            return
+        connection.execute(CREATE_TABLE.format(RTREE_TABLE))
+        for trigger in TRIGGERS:
+            connection.execute(trigger.format(RTREE_TABLE))
+        fill(connection)
+
+def fill(connection):
+    '''Index all the locations
+    '''
+    connection.execute('INSERT INTO {0} SELECT location_id, lat, lat, lon, '
+                       'lon FROM locations'.format(RTREE_TABLE))
+
+def rebuild(connection):
+    '''Re-index all the locations
+    '''
+    connection.execute('DELETE FROM {0}'.format(RTREE_TABLE))
+    fill(connection)
+
+def distance(lat1, lon1, lat2, lon2):
+    '''Great-circle distance between two points (haversine formula), in km
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    hav = (math.sin((lat2-lat1)/2)**2 +
+           math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2)
+    return 2*EARTH_RADIUS*math.asin(min(1., math.sqrt(hav)))
+
+def bounding_boxes(lat, lon, radius):
+    '''(min_lat, max_lat, min_lon, max_lon) boxes covering the circle of
+    `radius` km around a point: one box, or two when the circle crosses the
+    antimeridian
+    '''
+    angle = radius/EARTH_RADIUS
+    min_lat = lat-math.degrees(angle)
+    max_lat = lat+math.degrees(angle)
+    if min_lat <= -90 or max_lat >= 90:
+        ## The circle contains a pole: all the longitudes
+        return [(max(min_lat, -90.), min(max_lat, 90.), -180., 180.)]
+    delta = math.degrees(math.asin(math.sin(angle) /
+                                   math.cos(math.radians(lat))))
+    min_lon, max_lon = lon-delta, lon+delta
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon+360, 180.),
+                (min_lat, max_lat, -180., max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180.),
+                (min_lat, max_lat, -180., max_lon-360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+def check_point(lat, lon):
+    '''Validate coordinates
+    '''
+    lat, lon = float(lat), float(lon)
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        raise ValueError('Invalid coordinates')
+    return lat, lon
+
+def within(session, lat, lon, radius, category_id=None):
+    '''Get the items within `radius` km of a point (and in a category or its
+    subcategories), closest first, with their `distance` in km
+    '''
+    boxes = bounding_boxes(lat, lon, radius)
+    location_ids = (select([RTREE.c.location_id])
+                    .where(or_(*[and_(RTREE.c.max_lat >= min_lat,
+                                      RTREE.c.min_lat <= max_lat,
+                                      RTREE.c.max_lon >= min_lon,
+                                      RTREE.c.min_lon <= max_lon)
+                                 for min_lat, max_lat, min_lon, max_lon
+                                 in boxes])))
+    criteria = [Items.location_id.in_(location_ids)]
+    if category_id is not None:
+        criteria.append(Items.category_id.in_(
+            select([t_category_closure.c.descendant_id])
+            .where(t_category_closure.c.ancestor_id == category_id)))
+    items = []
+    for item in projections.select_items(session, criteria=criteria):
+        dic = item.as_dict()
+        dic['distance'] = distance(lat, lon, dic['location']['lat'],
+                                   dic['location']['lon'])
+        if dic['distance'] <= radius:
+            items.append(dic)
+    items.sort(key=lambda dic: (dic['distance'], dic['item_id']))
+    return items
+
+def nearest(session, lat, lon, k, category_id=None, start_radius=1.):
+    '''Get the `k` items nearest to a point (and in a category or its
+    subcategories), closest first, with their `distance` in km
+    '''
+    radius = start_radius
+    while True:
+        items = within(session, lat, lon, radius, category_id=category_id)
+        if len(items) >= k or radius >= MAX_RADIUS:
+            return items[:k]
+        radius *= 4
@@ -0,0 +1,237 @@
+'''
+.. module:: glob.mapclusters
+
+Clustered map markers for the item locations.
+
+The map is divided, at every zoom level `z`, in a grid of square cells of
+180/2**z degrees (2**(z+1) columns, from longitude -180, and 2**z rows,
+from latitude 90). For every non-empty cell, `map_clusters` holds the
+number of items, the sums of their coordinates (for the centroid, in
+microdegrees, so that adding and removing an item restores the exact same
+sums) and of their ratings, and `map_cluster_categories` the number of
+items of each category. The aggregates are updated by triggers when items
+are created, deleted, moved, recategorized or rated, and when locations
+move, so a map view reads one row per cell instead of every location.
+'''
+
+from sqlalchemy.sql import text
+
+ZOOM_TABLE = 'map_zoom_levels'
+CLUSTER_TABLE = 'map_clusters'
+CATEGORY_TABLE = 'map_cluster_categories'
+
+CREATE_TABLES = ['''
+CREATE TABLE IF NOT EXISTS {zooms} (
+    zoom INTEGER PRIMARY KEY,
+    cells INTEGER NOT NULL,
+    size FLOAT NOT NULL
+)''', '''
+CREATE TABLE IF NOT EXISTS {clusters} (
+    zoom INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    item_count INTEGER NOT NULL,
+    lat_e6_sum INTEGER NOT NULL,
+    lon_e6_sum INTEGER NOT NULL,
+    rating_sum INTEGER NOT NULL,
+    rating_count INTEGER NOT NULL,
+    PRIMARY KEY (zoom, x, y)
+)''', '''
+CREATE TABLE IF NOT EXISTS {categories} (
+    zoom INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    item_count INTEGER NOT NULL,
+    PRIMARY KEY (zoom, x, y, category_id)
+)''']
+
+## Column and row of the cell of a point at the zoom level `z`
+CELL_X = 'MIN(2*z.cells-1, MAX(0, CAST(({lon}+180.0)/z.size AS INTEGER)))'
+CELL_Y = 'MIN(z.cells-1, MAX(0, CAST((90.0-{lat})/z.size AS INTEGER)))'
+
+## Coordinate in microdegrees
+E6 = 'CAST(ROUND({0}*1000000) AS INTEGER)'
+
+## Add (sign=1) or remove (sign=-1) the items selected by `source` and
+## `where` (with their `lat`, `lon`, `category_id`, `rating_sum` and
+## `rating_count`) to the cells of all zoom levels
+UPDATE_CELLS = '''
+INSERT INTO {clusters}(zoom, x, y, item_count, lat_e6_sum, lon_e6_sum,
+                       rating_sum, rating_count)
+SELECT z.zoom, {x}, {y}, {sign}, {sign}*{lat_e6}, {sign}*{lon_e6},
+       {sign}*COALESCE({rating_sum}, 0), {sign}*COALESCE({rating_count}, 0)
+FROM {zooms} AS z, {source} WHERE {where}
+ON CONFLICT(zoom, x, y) DO UPDATE SET
+    item_count = item_count+excluded.item_count,
+    lat_e6_sum = lat_e6_sum+excluded.lat_e6_sum,
+    lon_e6_sum = lon_e6_sum+excluded.lon_e6_sum,
+    rating_sum = rating_sum+excluded.rating_sum,
+    rating_count = rating_count+excluded.rating_count;
+INSERT INTO {categories}(zoom, x, y, category_id, item_count)
+SELECT z.zoom, {x}, {y}, {category_id}, {sign}
+FROM {zooms} AS z, {source} WHERE {where}
+ON CONFLICT(zoom, x, y, category_id) DO UPDATE SET
+    item_count = item_count+excluded.item_count;
+DELETE FROM {clusters} WHERE item_count <= 0 AND (zoom, x, y) IN (
+    SELECT z.zoom, {x}, {y} FROM {zooms} AS z, {source} WHERE {where});
+DELETE FROM {categories} WHERE item_count <= 0 AND (zoom, x, y) IN (
+    SELECT z.zoom, {x}, {y} FROM {zooms} AS z, {source} WHERE {where});'''
+
+def update_cells(sign, source, where, lat, lon, category_id, rating_sum,
+                 rating_count):
+    '''Statements of a trigger adding or removing items to the cells
+    '''
+    return UPDATE_CELLS.format(
+        zooms=ZOOM_TABLE, clusters=CLUSTER_TABLE, categories=CATEGORY_TABLE,
+        x=CELL_X.format(lon=lon), y=CELL_Y.format(lat=lat), sign=sign,
+        source=source, where=where, lat_e6=E6.format(lat),
+        lon_e6=E6.format(lon), category_id=category_id, rating_sum=rating_sum,
+        rating_count=rating_count)
+
+def item_cells(sign, row):
+    '''Add or remove the `new` or `old` item of a trigger
+    '''
+    return update_cells(sign, 'locations AS l',
+                        'l.location_id = {}.location_id'.format(row),
+                        'l.lat', 'l.lon', row+'.category_id',
+                        row+'.rating_sum', row+'.rating_count')
+
+def location_cells(sign, row):
+    '''Add or remove the items of the `new` or `old` location of a trigger
+    '''
+    return update_cells(sign, 'items AS i',
+                        'i.location_id = {}.location_id'.format(row),
+                        row+'.lat', row+'.lon', 'i.category_id',
+                        'i.rating_sum', 'i.rating_count')
+
+TRIGGERS = [
+    ('items_insert', 'AFTER INSERT ON items', item_cells(1, 'new')),
+    ('items_delete', 'AFTER DELETE ON items', item_cells(-1, 'old')),
+    ('items_update',
+     'AFTER UPDATE OF location_id, category_id, rating_sum, rating_count '
+     'ON items',
+     item_cells(-1, 'old')+item_cells(1, 'new')),
+    ('locations_update', 'AFTER UPDATE OF lat, lon ON locations',
+     location_cells(-1, 'old')+location_cells(1, 'new'))]
+
+def install(engine, max_zoom=16):
+    '''Create the aggregate tables and their triggers if they do not exist
+    yet, and fill them when they are created
+    '''
+    with engine.begin() as connection:
+        exists = connection.execute(
+            text("SELECT name FROM sqlite_master WHERE name = :name"),
+            name=CLUSTER_TABLE).first()
+        if exists:
+            return
+        for statement in CREATE_TABLES:
+            connection.execute(statement.format(zooms=ZOOM_TABLE,
+                                                clusters=CLUSTER_TABLE,
+                                                categories=CATEGORY_TABLE))
+        connection.execute(
+            text('INSERT INTO {0}(zoom, cells, size) '
+                 'VALUES (:zoom, :cells, :size)'.format(ZOOM_TABLE)),
+            [{'zoom': zoom, 'cells': 2**zoom, 'size': 180./2**zoom}
+             for zoom in range(max_zoom+1)])
+        for name, event, body in TRIGGERS:
+            connection.execute('CREATE TRIGGER IF NOT EXISTS {0}_{1} {2} '
+                               'BEGIN {3} END'.format(CLUSTER_TABLE, name,
+                                                      event, body))
+        fill(connection)
+
+FILL = '''
+INSERT INTO {clusters}(zoom, x, y, item_count, lat_e6_sum, lon_e6_sum,
+                       rating_sum, rating_count)
+SELECT z.zoom, {x} AS cell_x, {y} AS cell_y, COUNT(*), SUM({lat_e6}),
+       SUM({lon_e6}), SUM(COALESCE(i.rating_sum, 0)),
+       SUM(COALESCE(i.rating_count, 0))
+FROM {zooms} AS z, items AS i JOIN locations AS l
+     ON l.location_id = i.location_id
+GROUP BY z.zoom, cell_x, cell_y;
+INSERT INTO {categories}(zoom, x, y, category_id, item_count)
+SELECT z.zoom, {x} AS cell_x, {y} AS cell_y, i.category_id, COUNT(*)
+FROM {zooms} AS z, items AS i JOIN locations AS l
+     ON l.location_id = i.location_id
+GROUP BY z.zoom, cell_x, cell_y, i.category_id'''
+
+def fill(connection):
+    '''Aggregate all the items with a location
+    '''
+    for statement in FILL.format(zooms=ZOOM_TABLE, clusters=CLUSTER_TABLE,
+                                 categories=CATEGORY_TABLE,
+                                 x=CELL_X.format(lon='l.lon'),
+                                 y=CELL_Y.format(lat='l.lat'),
+                                 lat_e6=E6.format('l.lat'),
+                                 lon_e6=E6.format('l.lon')).split(';'):
+        connection.execute(statement)
+
+def rebuild(connection):
+    '''Aggregate all the items again
+    '''
+    connection.execute('DELETE FROM {0}'.format(CLUSTER_TABLE))
+    connection.execute('DELETE FROM {0}'.format(CATEGORY_TABLE))
+    fill(connection)
+
+def parse_bbox(string):
+    '''Parse a 'min_lon,min_lat,max_lon,max_lat' bounding box
+    '''
+    try:
+        min_lon, min_lat, max_lon, max_lat = [float(value) for value
+                                              in string.split(',')]
+    except (AttributeError, ValueError):
+        raise ValueError('Invalid bounding box')
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180 and
+            -90 <= min_lat <= max_lat <= 90):
+        raise ValueError('Invalid bounding box')
+    return min_lon, min_lat, max_lon, max_lat
+
+def cell_ranges(zoom, bbox):
+    '''(min_x, max_x, min_y, max_y) ranges of the cells covering a bounding
+    box: one range, or two when the box crosses the antimeridian
+    (min_lon > max_lon)
+    '''
+    min_lon, min_lat, max_lon, max_lat = bbox
+    size = 180./2**zoom
+    def column(lon):
+        return min(2**(zoom+1)-1, max(0, int((lon+180)/size)))
+    def row(lat):
+        return min(2**zoom-1, max(0, int((90-lat)/size)))
+    rows = (row(max_lat), row(min_lat))
+    if min_lon > max_lon:
+        return [(column(min_lon), 2**(zoom+1)-1)+rows,
+                (0, column(max_lon))+rows]
+    return [(column(min_lon), column(max_lon))+rows]
+
+CLUSTERS = '''
+SELECT c.x, c.y, c.item_count, c.lat_e6_sum, c.lon_e6_sum, c.rating_sum,
+       c.rating_count,
+       (SELECT categories.path FROM {categories} AS cc
+        JOIN categories ON categories.category_id = cc.category_id
+        WHERE cc.zoom = c.zoom AND cc.x = c.x AND cc.y = c.y
+        ORDER BY cc.item_count DESC, cc.category_id LIMIT 1) AS category
+FROM {clusters} AS c
+WHERE c.zoom = :zoom AND c.x BETWEEN :min_x AND :max_x
+      AND c.y BETWEEN :min_y AND :max_y
+ORDER BY c.x, c.y'''
+
+def clusters(session, zoom, bbox):
+    '''Get the clusters of the cells of a zoom level covering a bounding box:
+    number of items, centroid, average rating and most common category
+    '''
+    query = text(CLUSTERS.format(clusters=CLUSTER_TABLE,
+                                 categories=CATEGORY_TABLE))
+    markers = []
+    for min_x, max_x, min_y, max_y in cell_ranges(zoom, bbox):
+        for row in session.execute(query, {'zoom': zoom, 'min_x': min_x,
+                                           'max_x': max_x, 'min_y': min_y,
+                                           'max_y': max_y}):
+            markers.append({
+                'cell': [zoom, row.x, row.y],
+                'number_of_items': row.item_count,
+                'lat': row.lat_e6_sum/(row.item_count*1e6),
+                'lon': row.lon_e6_sum/(row.item_count*1e6),
+                'rating': (float(row.rating_sum)/row.rating_count
+                           if row.rating_count else None),
+                'category': row.category})
+    return markers
@@ -0,0 +1,261 @@
+'''
+.. module:: glob.projections
+
+Read-only query layer for the list endpoints. The queries select only the
+columns that are serialized and build lightweight records instead of ORM
+instances, so no identity map, attribute instrumentation or lazy loading is
+involved. Each record has the same `as_dict` output as the corresponding
+class in `dbmodels`.
+'''
+
+from sqlalchemy.sql import and_, or_, select, union
+
+from dbmodels import (Categories, Items, Locations, Photos, Posts, Tags,
+                      UserRelationships, UserRelationshipTypes, Users,
+                      UserStatusTypes, t_posts_tags)
+
+class ItemRecord(object):
+    '''Item as serialized by `Items.as_dict()`
+    '''
+    __slots__ = ('item_id', 'item_name', 'category', 'location', 'rating')
+
+    def __init__(self, row):
+        self.item_id = row.item_id
+        self.item_name = row.item_name
+        self.category = row.path
+        ## The location columns are not selected when it is not expanded
+        if getattr(row, 'location_id', None) is None:
+            self.location = None
+        else:
+            self.location = (row.location_id, row.lat, row.lon, row.address)
+        if row.rating_count:
+            self.rating = float(row.rating_sum)/float(row.rating_count)
+        else:
+            self.rating = None
+
+    def as_dict(self, expand=None):
+        dic = {'item_id': self.item_id,
+               'item_name': self.item_name,
+               'category': self.category,
+               'rating': self.rating}
+        if expand is None or 'location' in expand:
+            if self.location is None:
+                dic['location'] = {}
+            else:
+                dic['location'] = dict(zip(('location_id', 'lat', 'lon',
+                                            'address'), self.location))
+        return dic
+
+class TagRecord(object):
+    '''Tag as serialized by `Tags.as_dict()`
+    '''
+    __slots__ = ('tag_id', 'tag_name', 'number_of_posts')
+
+    def __init__(self, row):
+        self.tag_id = row.tag_id
+        self.tag_name = row.tag_name
+        self.number_of_posts = row.post_count or 0
+
+    def as_dict(self):
+        return {'tag_id': self.tag_id,
+                'tag_name': self.tag_name,
+                'number_of_posts': self.number_of_posts}
+
+class PostRecord(object):
+    '''Post as serialized by `Posts.as_dict(with_item=True)`
+    '''
+    __slots__ = ('post_id', 'rating', 'review', 'post_datetime', 'item',
+                 'tags', 'photos')
+
+    def __init__(self, row, with_item=True):
+        self.post_id = row.post_id
+        self.rating = row.rating
+        self.review = row.review
+        self.post_datetime = row.post_datetime
+        self.item = ItemRecord(row) if with_item else None
+        self.tags = []
+        self.photos = []
+
+    def as_dict(self, expand=None):
+        dic = {'post_id': self.post_id,
+               'rating': self.rating,
+               'review': self.review,
+               'post_datetime': self.post_datetime.isoformat()}
+        if expand is None or 'tags' in expand:
+            dic['tags'] = [tag.as_dict() for tag in self.tags]
+        if expand is None or 'photos' in expand:
+            dic['photos'] = [{'photo_id': photo_id, 'file_name': file_name}
+                             for photo_id, file_name in self.photos]
+        if expand is None or 'item' in expand:
+            dic['item'] = self.item.as_dict()
+        return dic
+
+class UserRecord(object):
+    '''User as serialized by `Users.as_summary()`
+    '''
+    __slots__ = ('user_id', 'status', 'account_creation_date')
+
+    def __init__(self, row):
+        self.user_id = row.user_id
+        self.status = row.status_name
+        self.account_creation_date = row.account_creation_date
+
+    def as_dict(self):
+        return {'user_id': self.user_id,
+                'status': self.status,
+                'account_creation_date': (
+                    self.account_creation_date.isoformat()
+                    if self.account_creation_date else None)}
+
+def after_key(columns, values, descending=False):
+    '''Keyset pagination condition selecting the rows that come after
+    `values` when ordering by `columns`
+    '''
+    condition = None
+    for column, value in reversed(zip(columns, values)):
+        after = column < value if descending else column > value
+        if condition is None:
+            condition = after
+        else:
+            condition = or_(after, and_(column == value, condition))
+    return condition
+
+ITEM_COLUMNS = [Items.item_id, Items.item_name, Categories.path,
+                Items.rating_sum, Items.rating_count]
+LOCATION_COLUMNS = [Locations.location_id, Locations.lat, Locations.lon,
+                    Locations.address]
+
+def items_from(with_location=True):
+    '''Join of the tables needed to serialize items
+    '''
+    join = Items.__table__.join(Categories.__table__,
+                                Categories.category_id == Items.category_id)
+    if with_location:
+        join = join.outerjoin(Locations.__table__,
+                              Locations.location_id == Items.location_id)
+    return join
+
+ITEM_KEY = (Items.item_name, Items.item_id)
+TAG_KEY = (Tags.tag_name, Tags.tag_id)
+POST_KEY = (Posts.post_datetime, Posts.post_id)
+
+def paginate(query, key, limit=None, after=None, descending=False):
+    '''Order a select by `key` and restrict it to one page
+    '''
+    if descending:
+        query = query.order_by(*[column.desc() for column in key])
+    else:
+        query = query.order_by(*key)
+    if after is not None:
+        query = query.where(after_key(key, after, descending=descending))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def select_items(session, limit=None, after=None, criteria=(),
+                 expand=('location',)):
+    '''Get the items ordered by name, `limit` at a time, starting after the
+    (item_name, item_id) key `after`. The location is only selected if it is
+    in `expand`.
+    '''
+    with_location = 'location' in expand
+    columns = ITEM_COLUMNS + (LOCATION_COLUMNS if with_location else [])
+    query = select(columns).select_from(items_from(with_location))
+    for criterion in criteria:
+        query = query.where(criterion)
+    query = paginate(query, ITEM_KEY, limit=limit, after=after)
+    return [ItemRecord(row) for row in session.execute(query)]
+
+def select_tags(session, limit=None, after=None):
+    '''Get the tags ordered by name, `limit` at a time, starting after the
+    (tag_name, tag_id) key `after`
+    '''
+    query = paginate(select([Tags.tag_id, Tags.tag_name, Tags.post_count]),
+                     TAG_KEY, limit=limit, after=after)
+    return [TagRecord(row) for row in session.execute(query)]
+
+def select_posts(session, limit=None, after=None,
+                 expand=('item', 'tags', 'photos'), criteria=()):
+    '''Get the posts (with the relationships in `expand` among their item,
+    tags and photos), most recent first, `limit` at a time, starting after
+    the (post_datetime, post_id) key `after`. At most three statements are
+    run whatever the number of posts: one for the posts and their items, one
+    for the tags and one for the photos.
+    '''
+    with_item = 'item' in expand
+    post_ids = select([Posts.post_id])
+    for criterion in criteria:
+        post_ids = post_ids.where(criterion)
+    post_ids = paginate(post_ids, POST_KEY, limit=limit, after=after,
+                        descending=True)
+    columns = [Posts.post_id, Posts.rating, Posts.review, Posts.post_datetime]
+    if with_item:
+        query = (select(columns + ITEM_COLUMNS + LOCATION_COLUMNS)
+                 .select_from(items_from()
+                              .join(Posts.__table__,
+                                    Posts.item_id == Items.item_id)))
+    else:
+        query = select(columns)
+    for criterion in criteria:
+        query = query.where(criterion)
+    query = paginate(query, POST_KEY, limit=limit, after=after,
+                     descending=True)
+
+    posts = [PostRecord(row, with_item=with_item)
+             for row in session.execute(query)]
+    if not posts:
+        return posts
+    by_id = dict((post.post_id, post) for post in posts)
+
+    if 'tags' in expand:
+        tags = (select([t_posts_tags.c.post_id, Tags.tag_id, Tags.tag_name,
+                        Tags.post_count])
+                .select_from(t_posts_tags.join(Tags.__table__,
+                                               Tags.tag_id ==
+                                               t_posts_tags.c.tag_id))
+                .where(t_posts_tags.c.post_id.in_(post_ids)))
+        for row in session.execute(tags):
+            by_id[row.post_id].tags.append(TagRecord(row))
+
+    if 'photos' in expand:
+        photos = (select([Photos.post_id, Photos.photo_id, Photos.file_name])
+                  .where(Photos.post_id.in_(post_ids)))
+        for post_id, photo_id, file_name in session.execute(photos):
+            by_id[post_id].photos.append((photo_id, file_name))
+
+    return posts
+
+def friend_ids(user_id):
+    '''Ids of the friends of a user. A friendship is stored once in
+    `user_relationships`, with the user either first or second, so both
+    directions are resolved in a single UNION.
+    '''
+    relationships = UserRelationships.__table__
+    friends = (select([UserRelationshipTypes.relationship_id])
+               .where(UserRelationshipTypes.relationship_name == u'friends')
+               .as_scalar())
+    return union(
+        select([relationships.c.second_user_id.label('user_id')])
+        .where(and_(relationships.c.first_user_id == user_id,
+                    relationships.c.type_id == friends)),
+        select([relationships.c.first_user_id.label('user_id')])
+        .where(and_(relationships.c.second_user_id == user_id,
+                    relationships.c.type_id == friends))).alias('friend_ids')
+
+USER_KEY = (Users.user_id,)
+
+def select_friends(session, user_id, limit=None, after=None):
+    '''Get the summaries of the friends of a user, ordered by id, `limit` at
+    a time, starting after the (user_id,) key `after`
+    '''
+    friends = friend_ids(user_id)
+    query = (select([Users.user_id, Users.account_creation_date,
+                     UserStatusTypes.status_name])
+             .select_from(friends
+                          .join(Users.__table__,
+                                Users.user_id == friends.c.user_id)
+                          .outerjoin(UserStatusTypes.__table__,
+                                     UserStatusTypes.status_id ==
+                                     Users.status_id)))
+    query = paginate(query, USER_KEY, limit=limit, after=after)
+    return [UserRecord(row) for row in session.execute(query)]
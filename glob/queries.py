@@ -6,23 +6,180 @@
 Module containing all the methods used to send queries to the databases.
 '''
 
+import base64
 import datetime
+import json
 import os
 
 from passlib.hash import pbkdf2_sha256 as pb256
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql import bindparam
 
 from dbmodels import *
 import config
+import duplicates
+import geo
+import mapclusters
+import projections
+import recentposts
+import search
+import socialgraph
+import tagindex
+import timelines
+import trending
+import typeahead
+
+def item_options():
+    '''Loader options for `Items.as_dict()`
+    '''
+    return [joinedload(Items.location),
+            joinedload(Items.category)]
+
+def post_options(with_item=False, expand=None):
+    '''Loader options for `Posts.as_dict()`
+    '''
+    if expand is None:
+        expand = ('tags', 'photos')
+        if with_item:
+            expand += ('item',)
+    options = []
+    if 'tags' in expand:
+        options.append(selectinload(Posts.tags))
+    if 'photos' in expand:
+        options.append(selectinload(Posts.photos))
+    if 'item' in expand:
+        options.append(joinedload(Posts.item).options(*item_options()))
+    return options
+
+## Named loading profiles, one per `as_dict` serialization tree. Each profile
+## is a list of loader options that make the serialization run a fixed
+## number of queries, whatever the number of objects.
+LOADING_PROFILES = {
+    'post_with_item': post_options(with_item=True),
+    'post_all_fields': (post_options(with_item=True) +
+                        [selectinload(Posts.liked_by),
+                         selectinload(Posts.comments)]),
+    'item': item_options(),
+    'item_with_posts': (item_options() +
+                        [selectinload(Items.posts).options(*post_options())]),
+    'category_with_items': [selectinload(Categories.items)
+                            .options(*item_options())],
+    'tag_with_posts': [selectinload(Tags.posts)
+                       .options(*post_options(with_item=True))],
+}
+LOADING_PROFILES['user_profile'] = [
+    joinedload(Users.status),
+    selectinload(Users.posts).options(*LOADING_PROFILES['post_all_fields']),
+    selectinload(Users.comments),
+    selectinload(Users.likes).options(*LOADING_PROFILES['post_with_item'])]
+
+def load_profile(query, profile):
+    '''Apply a named loading profile to a query
+    '''
+    if profile is None:
+        return query
+    return query.options(*LOADING_PROFILES[profile])
+
+## Keys of the serialized objects used for keyset pagination
+PAGE_KEYS = {'posts': ('post_datetime', 'post_id'),
+             'items': ('item_name', 'item_id'),
+             'tags': ('tag_name', 'tag_id'),
+             'categories': ('category_name', 'category_id'),
+             'friends': ('user_id',),
+             'results': ('rank', 'document')}
+
+## Fields and embedded relationships of the serialized objects that can be
+## selected with `fields` and `expand` (see `fieldset`). A single item
+## ('item') also has its rating histogram and posts, which the item lists
+## ('items') leave out.
+FIELDS = {'posts': ('post_id', 'rating', 'review', 'post_datetime'),
+          'items': ('item_id', 'item_name', 'category', 'rating')}
+FIELDS['item'] = FIELDS['items'] + ('rating_histogram',)
+RELATIONSHIPS = {'posts': ('item', 'tags', 'photos'),
+                 'items': ('location',),
+                 'item': ('location', 'posts')}
+
+def fieldset(kind, fields=None, expand=None):
+    '''Get the relationships to load and embed in the serialized objects:
+    those in `expand` (all of them by default) that are also in `fields` (if
+    given)
+    '''
+    relationships = RELATIONSHIPS[kind]
+    if expand is None:
+        expand = relationships
+    elif set(expand) - set(relationships):
+        raise ValueError('Unknown relationships: {}'.format(
+            ', '.join(sorted(set(expand) - set(relationships)))))
+    if fields is not None:
+        unknown = set(fields) - set(FIELDS[kind]) - set(relationships)
+        if unknown:
+            raise ValueError('Unknown fields: {}'.format(
+                ', '.join(sorted(unknown))))
+        expand = [name for name in expand if name in fields]
+    return tuple(name for name in relationships if name in expand)
+
+def only_fields(dic, fields):
+    '''Restrict a serialized object to the given fields
+    '''
+    if fields is None:
+        return dic
+    return dict((key, dic[key]) for key in fields if key in dic)
+
+def with_page_keys(kind, fields):
+    '''Add the fields needed to compute the cursor of the next page
+    '''
+    if fields is None:
+        return
+    return list(fields) + [key for key in PAGE_KEYS[kind]
+                           if key not in fields]
 
-def get_obj(cls, obj_name, **kwargs):
+def check_limit(limit):
+    '''Validate a page size
+    '''
+    if limit is None:
+        return
+    limit = int(limit)
+    if limit <= 0:
+        raise ValueError('`limit` must be a positive integer')
+    return limit
+
+def next_cursor(kind, objs, limit):
+    '''Get the opaque cursor pointing after the last object of a page of
+    serialized objects (None if the page is not full)
+    '''
+    if not objs or limit is None or len(objs) < int(limit):
+        return
+    key = [objs[-1][name] for name in PAGE_KEYS[kind]]
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def decode_cursor(kind, cursor):
+    '''Get the key after which the page pointed by `cursor` starts
+    '''
+    if cursor is None:
+        return
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(key, list) or len(key) != len(PAGE_KEYS[kind]):
+            raise ValueError
+        if kind == 'posts':
+            ## isoformat() leaves the microseconds out when they are 0
+            fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in key[0] else \
+                  '%Y-%m-%dT%H:%M:%S'
+            key[0] = datetime.datetime.strptime(key[0], fmt)
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError('Invalid cursor')
+    return key
+
+def get_obj(cls, obj_name, profile=None, **kwargs):
     '''General function for retrieving database entries
     '''
     def wrapper(dbase, obj_id, return_object=False):
         '''Wrapper function
         '''
-        obj = (dbase.session
-                    .query(cls)
-                    .filter(getattr(cls, obj_name+'_id') == obj_id)
+        query = dbase.session.query(cls)
+        if not return_object:
+            query = load_profile(query, profile)
+        obj = (query.filter(getattr(cls, obj_name+'_id') == obj_id)
                     .first())
         if not obj:
             return
@@ -36,19 +193,18 @@ def get_obj(cls, obj_name, **kwargs):
 
     return wrapper
 
-def get_all_obj(cls, order_by=None, **kwargs):
+def get_all_obj(cls, order_by=None, profile=None, **kwargs):
     '''General function for retrieving all database entries in a given table
     '''
     def wrapper(dbase):
         '''Wrapper function
         '''
-
+        query = load_profile(dbase.session.query(cls), profile)
         if callable(order_by) or order_by is None:
-            objs = dbase.session.query(cls).all()
+            objs = query.all()
         else:
-            objs = (dbase.session.query(cls)
-                                 .order_by(order_by)
-                                 .all())
+            objs = (query.order_by(order_by)
+                         .all())
         objs = [obj.as_dict(**kwargs) for obj in objs]
         if callable(order_by):
             return sorted(objs, key=order_by)
@@ -56,6 +212,13 @@ def get_all_obj(cls, order_by=None, **kwargs):
 
     return wrapper
 
+def discard_new(session, before):
+    '''Remove from the session the objects added since `before` (the new
+    objects of the session at that time), when their creation failed
+    '''
+    for obj in session.new.difference(before):
+        session.expunge(obj)
+
 def create_obj(cls, required_keys=None, optional_keys=None):
     '''General decorator for creating database entries
     '''
@@ -94,10 +257,19 @@ def create_obj(cls, required_keys=None, optional_keys=None):
                 if arg not in optional:
                     raise TypeError('Too many arguments')
 
-            kwdict = function(dbase, **kwargs)
+            ## The nested objects (e.g. the new item and tags of a post) are
+            ## created without commit nor flush: the whole graph is flushed
+            ## and committed once, with the object
+            before = dbase.session.new
+            try:
+                with dbase.session.no_autoflush:
+                    kwdict = function(dbase, **kwargs)
 
-            ## Create class instance
-            obj = cls(**kwdict)
+                    ## Create class instance
+                    obj = cls(**kwdict)
+            except Exception:
+                discard_new(dbase.session, before)
+                raise
 
             if commit:
                 ## Commit changes to database
@@ -141,6 +313,17 @@ def delete_obj(cls, obj_name):
 
     return wrapper
 
+## Methods filling the tables and columns added to databases created by
+## earlier versions (see `dbmodels.upgrade_database`)
+BACKFILLS = [(('categories.path', 'categories.depth', 'category_closure'),
+              'rebuild_category_tree'),
+             (['items.rating_sum', 'items.rating_count'] +
+              ['items.rating_%d' % rating for rating in RATINGS],
+              'rebuild_item_ratings'),
+             (('tags.post_count',), 'rebuild_tag_counts'),
+             (('locations.geokey',), 'fill_location_keys'),
+             (('timelines',), 'rebuild_timelines')]
+
 class DataBase(object):
     '''Class to handle database queries
     '''
@@ -151,9 +334,86 @@ class DataBase(object):
         if config.DBLOCAL:
             self.engine = create_engine('sqlite:///' +
                                         os.path.join(path, config.DBFILE))
-
+        ## Tables, columns and indexes missing from a database created by an
+        ## earlier version, filled in once the indexes are set up
+        upgraded = upgrade_database(self.engine)
+
+        ## Full-text search index, kept in sync by triggers (see `search`)
+        search.install(self.engine)
+        ## Spatial index of the locations, kept in sync by triggers (see
+        ## `geo`)
+        geo.install(self.engine)
+        ## Map clusters of the items, kept up to date by triggers (see
+        ## `mapclusters`)
+        mapclusters.install(self.engine, max_zoom=config.MAP_MAX_ZOOM)
         self.Session = sessionmaker(bind=self.engine)
         self.session = self.Session()
+        self._friends_graph = None
+        self._friend_suggestions = None
+        ## Fan out new posts to the home timelines (see `timelines`)
+        self.timelines = timelines.HomeTimelines(
+            lambda: self.friends_graph, size=config.TIMELINE_SIZE,
+            fanout_limit=config.FANOUT_LIMIT)
+        self.timelines.watch(self.Session)
+        ## Most recent posts served from memory (see `recentposts`)
+        self.recent_posts = recentposts.RecentPosts(size=config.RECENT_POSTS)
+        self.recent_posts.watch(self.Session)
+        ## Tag counters for the trending tags (see `trending`)
+        self.trending = trending.TrendingTags(
+            bucket_size=datetime.timedelta(
+                seconds=config.TRENDING_BUCKET_SIZE),
+            horizon=datetime.timedelta(days=config.TRENDING_HORIZON))
+        self.trending.load(self.session)
+        self.trending.watch(self.Session)
+        ## Post ids of every tag, for the tag searches (see `tagindex`)
+        self.tag_index = tagindex.TagIndex()
+        self.tag_index.watch(self.Session)
+        ## Prefix index of the tag, item and category names, for the
+        ## autocompletion (see `typeahead`)
+        self.typeahead = typeahead.Typeahead()
+        self.typeahead.watch(self.Session)
+        self.backfill(upgraded)
+
+    def backfill(self, changes):
+        '''Fill the tables and columns added by `dbmodels.upgrade_database`
+        (given as its result)
+        '''
+        for names, method in BACKFILLS:
+            if changes.intersection(names):
+                getattr(self, method)()
+
+    def load_graph(self, relationship_names):
+        '''Build a graph of the relationships between users (see
+        `socialgraph`), kept up to date with the committed changes
+        '''
+        graph = socialgraph.SocialGraph(relationship_names)
+        graph.load(self.session)
+        graph.watch(self.Session)
+        return graph
+
+    @property
+    def friends_graph(self):
+        '''Graph of the friendships between users, built on first use
+        '''
+        if self._friends_graph is None:
+            self._friends_graph = self.load_graph([u'friends'])
+        return self._friends_graph
+
+    @property
+    def friend_suggestions(self):
+        '''Friend suggestion engine (see `socialgraph.FriendSuggestions`),
+        built on first use
+        '''
+        if self._friend_suggestions is None:
+            excluded = self.load_graph([u'pending_first_second',
+                                        u'pending_second_first',
+                                        u'blocked_first_second',
+                                        u'blocked_second_first',
+                                        u'blocked_both'])
+            self._friend_suggestions = socialgraph.FriendSuggestions(
+                self.friends_graph, excluded,
+                k=config.FRIEND_SUGGESTIONS)
+        return self._friend_suggestions
 
     @property
     def USER_STATUS_ACTIVE(self):
@@ -232,13 +492,108 @@ class DataBase(object):
                     .first())
 
     def get_recent_posts(self, n_posts=5):
-        '''Get the most recent posts from the database
+        '''Get the most recent posts from the database. Up to
+        `config.RECENT_POSTS` posts are served from the in-memory buffer.
+        '''
+        n_posts = int(n_posts)
+        if n_posts <= self.recent_posts.size:
+            return self.recent_posts.get(self.session, n_posts)
+        posts = projections.select_posts(self.session, limit=n_posts)
+        return [post.as_dict() for post in posts]
+
+    def iter_all(self, kind, batch_size=None, fields=None, **kwargs):
+        '''Iterate over all the serialized objects of a collection ('posts',
+        'items', 'tags' or 'categories'), fetching them one page of
+        `batch_size` objects at a time so that only one page is ever held in
+        memory. Other keyword arguments are passed to the `get_all_*` method.
+        '''
+        get_page = getattr(self, 'get_all_'+kind, None)
+        if kind not in PAGE_KEYS or get_page is None:
+            raise ValueError('Unknown collection: {}'.format(kind))
+        batch_size = check_limit(batch_size or config.STREAM_BATCH_SIZE)
+        if fields is not None:
+            kwargs['fields'] = with_page_keys(kind, fields)
+        cursor = None
+        while True:
+            page = get_page(limit=batch_size, cursor=cursor, **kwargs)
+            for obj in page:
+                yield only_fields(obj, fields)
+            cursor = next_cursor(kind, page, batch_size)
+            if cursor is None:
+                return
+
+    def create_batch(self, create, kind, elements, errors=None):
+        '''Create a batch of objects (dictionaries of the arguments of the
+        `create` method, e.g. `create_post`) in a single transaction: nothing
+        is flushed before all the elements are validated, and everything is
+        committed at once. `errors` maps the indexes of the elements already
+        found invalid to their error. Returns one result per element: the id
+        of the created object, or the error that prevented its creation.
         '''
-        posts = (self.session
-                 .query(Posts)
-                 .order_by(Posts.post_datetime.desc())
-                 .limit(int(n_posts)))
-        return [post.as_dict(with_item=True) for post in posts]
+        if not isinstance(elements, list):
+            raise TypeError('Wrong data type for the batch')
+        if len(elements) > config.MAX_BATCH_SIZE:
+            raise ValueError('Too many objects in the batch')
+        errors = dict(errors or {})
+        objs = {}
+        with self.session.no_autoflush:
+            for index, element in enumerate(elements):
+                if index in errors:
+                    continue
+                if not isinstance(element, dict):
+                    errors[index] = 'Wrong data type for `{}`'.format(kind)
+                    continue
+                before = self.session.new
+                try:
+                    obj = create(commit=False, return_object=True, **element)
+                except (TypeError, ValueError) as err:
+                    ## Forget the objects created for the element
+                    discard_new(self.session, before)
+                    errors[index] = str(err)
+                    continue
+                self.session.add(obj)
+                objs[index] = obj
+        try:
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        results = []
+        for index in range(len(elements)):
+            if index in objs:
+                mapper = inspect(objs[index]).mapper
+                results.append(dict((column.key,
+                                     getattr(objs[index], column.key))
+                                    for column in mapper.primary_key))
+            else:
+                results.append({'error': errors[index]})
+        return results
+
+    def existing_ids(self, column, ids):
+        '''The values of `ids` found in a primary key `column`, with a single
+        query
+        '''
+        ids = set(obj_id for obj_id in ids if obj_id is not None)
+        if not ids:
+            return set()
+        return set(obj_id for obj_id, in
+                   self.session.query(column).filter(column.in_(ids)))
+
+    def check_references(self, elements, errors, **columns):
+        '''Record in `errors` the indexes of the elements referencing
+        objects that do not exist, by the keys of `columns` (e.g.
+        `user_id=Users.user_id`), with one query per key
+        '''
+        for key, column in sorted(columns.iteritems()):
+            found = self.existing_ids(column, [element.get(key)
+                                               for element in elements
+                                               if isinstance(element, dict)])
+            for index, element in enumerate(elements):
+                if (index not in errors and isinstance(element, dict) and
+                        element.get(key) is not None and
+                        element[key] not in found):
+                    errors[index] = ('No {} corresponding to the given id'
+                                     .format(key[:-len('_id')]))
 
     ### CATEGORIES ###
 
@@ -253,25 +608,138 @@ class DataBase(object):
     def get_category(self, obj_id, return_object=False):
         '''Get a category by its id
         '''
-        func = get_obj(Categories, 'category', with_items=True)
+        func = get_obj(Categories, 'category', profile='category_with_items',
+                       with_items=True)
         return func(self, obj_id, return_object=return_object)
 
-    def get_all_categories(self):
-        '''Get all categories from the database
+    def get_all_categories(self, limit=None, cursor=None):
+        '''Get all categories from the database, ordered by path. With a
+        `limit`, only one page is returned, starting after `cursor`.
         '''
-        func = get_all_obj(Categories, order_by=lambda x: x['category_name'])
-        return func(self)
+        query = (self.session.query(Categories)
+                             .order_by(Categories.path,
+                                       Categories.category_id))
+        after = decode_cursor('categories', cursor)
+        if after is not None:
+            query = query.filter(projections.after_key(
+                (Categories.path, Categories.category_id), after))
+        limit = check_limit(limit)
+        if limit is not None:
+            query = query.limit(limit)
+        return [cat.as_dict() for cat in query]
+
+    def rebuild_category_tree(self):
+        '''Recompute the materialized path, depth and closure rows of all
+        categories (for databases created before these existed)
+        '''
+        categories = self.session.query(Categories).all()
+        children = {}
+        for cat in categories:
+            children.setdefault(cat.parent_id, []).append(cat)
+        closure = []
+        level = [(cat, None, []) for cat in children.get(None, [])]
+        while level:
+            next_level = []
+            for cat, parent, ancestors in level:
+                if parent is None:
+                    cat.path = cat.category_name
+                    cat.depth = 0
+                else:
+                    cat.path = parent.path + '\\' + cat.category_name
+                    cat.depth = parent.depth + 1
+                ancestors = ancestors + [cat.category_id]
+                closure.extend({'ancestor_id': ancestor_id,
+                                'descendant_id': cat.category_id,
+                                'distance': len(ancestors) - j - 1}
+                               for j, ancestor_id in enumerate(ancestors))
+                next_level.extend((child, cat, ancestors)
+                                  for child in children.get(cat.category_id,
+                                                            []))
+            level = next_level
+        self.session.execute(t_category_closure.delete())
+        if closure:
+            self.session.execute(t_category_closure.insert(), closure)
+        try:
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        return 'OK'
+
+    def get_category_items(self, obj_id, recursive=False, limit=None,
+                           cursor=None):
+        '''Get the items of a category. If `recursive` is True, the items of
+        all its subcategories are included as well. With a `limit`, only one
+        page is returned, starting after `cursor`.
+        '''
+        if not self.session.query(Categories.category_id).filter(
+                Categories.category_id == obj_id).first():
+            return
+        if recursive:
+            criterion = Items.category_id.in_(
+                select([t_category_closure.c.descendant_id])
+                .where(t_category_closure.c.ancestor_id == obj_id))
+        else:
+            criterion = Items.category_id == obj_id
+        items = projections.select_items(self.session,
+                                         limit=check_limit(limit),
+                                         after=decode_cursor('items', cursor),
+                                         criteria=[criterion])
+        return [item.as_dict() for item in items]
+
+    def get_category_rollups(self, obj_id=None):
+        '''Get the number of items and the average post rating of every
+        category subtree (or of the subtree of a given category)
+        '''
+        closure = t_category_closure
+        query = (self.session
+                 .query(Categories.category_id, Categories.path,
+                        func.count(Items.item_id),
+                        func.sum(Items.rating_sum),
+                        func.sum(Items.rating_count))
+                 .outerjoin(closure,
+                            closure.c.ancestor_id == Categories.category_id)
+                 .outerjoin(Items,
+                            Items.category_id == closure.c.descendant_id)
+                 .group_by(Categories.category_id, Categories.path)
+                 .order_by(Categories.path))
+        if obj_id is not None:
+            query = query.filter(Categories.category_id == obj_id)
+        return [{'category_id': category_id,
+                 'category_name': path,
+                 'number_of_items': n_items,
+                 'rating': (float(rating_sum)/float(rating_count)
+                            if rating_count else None)}
+                for category_id, path, n_items, rating_sum, rating_count
+                in query]
 
     def delete_category(self, obj_id):
-        '''Delete a category by its id
+        '''Delete a category and all its subcategories by its id
         '''
-        obj = (self.session
-                   .query(Categories.category_id)
-                   .filter(Categories.parent_id == obj_id)
-                   .all())
-        for cat_id, in obj:
-            self.delete_category(cat_id)
-        return delete_obj(Categories, 'category')(self, obj_id)
+        closure = t_category_closure
+        subtree = (self.session
+                       .query(Categories)
+                       .join(closure,
+                             closure.c.descendant_id == Categories.category_id)
+                       .filter(closure.c.ancestor_id == obj_id)
+                       .all())
+        if not subtree:
+            raise ValueError('No object corresponding to the given id')
+        ## Deleted through the session, so that the items still referencing
+        ## the subtree make the flush fail (their category_id is not
+        ## nullable), as with a single category
+        for cat in subtree:
+            self.session.delete(cat)
+        try:
+            self.session.execute(closure.delete()
+                                        .where(closure.c.descendant_id.in_(
+                                            [cat.category_id
+                                             for cat in subtree])))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        return 'OK'
 
     ### LOCATIONS ###
 
@@ -301,6 +769,80 @@ class DataBase(object):
                              'location')
         return delete_obj(Locations, 'location')(self, obj_id)
 
+    def find_location(self, lat, lon, address=None):
+        '''Get an existing location at the same place: in the same grid
+        cell (see `location_key`) and with the same address (case and
+        whitespace aside). The lookup goes through the index on the grid key.
+        '''
+        address = address_key(address)
+        locations = (self.session.query(Locations)
+                                 .filter(Locations.geokey ==
+                                         location_key(lat, lon))
+                                 .order_by(Locations.location_id))
+        for location in locations:
+            if address_key(location.address) == address:
+                return location
+
+    def fill_location_keys(self, batch_size=1000):
+        '''Compute the grid keys (see `location_key`) of the locations created
+        before they existed, `batch_size` locations at a time
+        '''
+        table = Locations.__table__
+        connection = self.session.connection()
+        missing = (select([table.c.location_id, table.c.lat, table.c.lon])
+                   .where(table.c.geokey.is_(None))
+                   .limit(batch_size))
+        set_key = (table.update()
+                   .where(table.c.location_id == bindparam('id'))
+                   .values(geokey=bindparam('key')))
+        while True:
+            rows = connection.execute(missing).fetchall()
+            if not rows:
+                break
+            connection.execute(set_key,
+                               [{'id': location_id,
+                                 'key': location_key(lat, lon)}
+                                for location_id, lat, lon in rows])
+        self.session.commit()
+        return 'OK'
+
+    def merge_duplicate_locations(self, batch_size=1000):
+        '''Merge the locations at the same place (see `find_location`) into
+        the oldest of them, and point their items to it. The grid keys of the
+        locations created before they existed are filled first. Returns the
+        number of locations removed.
+        '''
+        self.fill_location_keys(batch_size=batch_size)
+        table = Locations.__table__
+        connection = self.session.connection()
+        duplicated = (select([table.c.geokey])
+                      .group_by(table.c.geokey)
+                      .having(func.count(table.c.location_id) > 1))
+        candidates = (select([table.c.location_id, table.c.geokey,
+                              table.c.address])
+                      .where(table.c.geokey.in_(duplicated))
+                      .order_by(table.c.location_id))
+        kept = {}
+        merged = []
+        for location_id, geokey, address in connection.execute(candidates):
+            place = (geokey, address_key(address))
+            if place in kept:
+                merged.append({'old': location_id, 'new': kept[place]})
+            else:
+                kept[place] = location_id
+
+        items = Items.__table__
+        repoint = (items.update()
+                   .where(items.c.location_id == bindparam('old'))
+                   .values(location_id=bindparam('new')))
+        remove = table.delete().where(table.c.location_id == bindparam('old'))
+        for start in range(0, len(merged), batch_size):
+            batch = merged[start:start+batch_size]
+            connection.execute(repoint, batch)
+            connection.execute(remove, batch)
+        self.session.commit()
+        return len(merged)
+
     ### PHOTOS ###
 
     @create_obj(Photos, required_keys=['file_name'], optional_keys=['post_id'])
@@ -325,13 +867,20 @@ class DataBase(object):
     ### ITEMS ###
 
     @create_obj(Items, required_keys=['item_name', 'category|category_id'],
-                optional_keys=['location'])
+                optional_keys=['location', 'check_duplicates'])
     def create_item(self, commit=True, return_object=False, **kwargs):
         '''creates a new item. This function returns a dictionary that is used
         by the create_obj decorator to create the actual database entry.
+        With `check_duplicates`, raises `DuplicateItemError` when similar
+        items already exist in the same category and place (see
+        `find_similar_items`).
         '''
         ## Make a copy of the keyword arguments dictionary
         kwdict = kwargs.copy()
+        if kwdict.pop('check_duplicates', False):
+            candidates = self.find_similar_items(**kwdict)
+            if candidates:
+                raise duplicates.DuplicateItemError(candidates)
         if 'location' in kwdict:
             location = kwdict['location']
             if isinstance(location, Locations):
@@ -344,9 +893,11 @@ class DataBase(object):
                     kwdict['location_id'] = location['location_id']
                     del kwdict['location']
                 else:
-                    kwdict['location'] = self.create_location(return_object=True,
-                                                              commit=commit,
-                                                              **location)
+                    ## Reuse the location if it already exists
+                    kwdict['location'] = (
+                        self.find_location(**location) or
+                        self.create_location(return_object=True,
+                                             commit=False, **location))
         if 'category' in kwdict:
             category = kwdict['category']
             if isinstance(category, Categories):
@@ -360,20 +911,251 @@ class DataBase(object):
                     del kwdict['category']
                 else:
                     kwdict['category'] = self.create_category(return_object=True,
-                                                              commit=commit,
+                                                              commit=False,
                                                               **category)
         return kwdict
 
 
-    def get_item(self, obj_id):
-        '''Get a item by its id
+    def create_items(self, items):
+        '''Create a batch of items (see `create_batch`). The categories and
+        locations referenced by id are checked once for the whole batch, and
+        the new categories and locations shared by several items are
+        created once.
+        '''
+        if not isinstance(items, list):
+            raise TypeError('Wrong data type for the batch')
+        errors = {}
+        items = [dict(item) if isinstance(item, dict) else item
+                 for item in items]
+        for item in items:
+            if (isinstance(item, dict) and
+                    isinstance(item.get('category'), dict) and
+                    'category_id' in item['category']):
+                item['category_id'] = item.pop('category')['category_id']
+            if (isinstance(item, dict) and
+                    isinstance(item.get('location'), dict) and
+                    'location_id' in item['location']):
+                item['location_id'] = item.pop('location')['location_id']
+        self.check_references(items, errors,
+                              category_id=Categories.category_id,
+                              location_id=Locations.location_id)
+        locations = dict((location.location_id, location) for location in
+                         self.session.query(Locations).filter(
+                             Locations.location_id.in_(
+                                 set(item.get('location_id') for item in items
+                                     if isinstance(item, dict)))))
+        ## New categories and locations, by their arguments
+        created = {}
+        for index, item in enumerate(items):
+            if index in errors or not isinstance(item, dict):
+                continue
+            if 'location_id' in item:
+                item['location'] = locations[item.pop('location_id')]
+            for key, create in (('category', self.create_category),
+                                ('location', self.create_location)):
+                value = item.get(key)
+                if not isinstance(value, dict):
+                    continue
+                try:
+                    shared = (key, tuple(sorted(value.iteritems())))
+                    if shared not in created and key == 'location':
+                        ## Reuse the location if it already exists
+                        created[shared] = self.find_location(**value)
+                    if not created.get(shared):
+                        created[shared] = create(commit=False,
+                                                 return_object=True, **value)
+                except (TypeError, ValueError) as err:
+                    errors[index] = str(err)
+                    break
+                item[key] = created[shared]
+        return self.create_batch(self.create_item, 'item', items,
+                                 errors=errors)
+
+    def find_similar_items(self, item_name, category=None, category_id=None,
+                           location=None, threshold=None, **kwargs):
+        '''Get the existing items of the same category, near the same
+        location (or without location), with a name similar to `item_name`,
+        most similar first (see `duplicates`). `category` and `location` are
+        given as to `create_item`.
+        '''
+        if isinstance(category, Categories):
+            category_id = category.category_id
+        elif isinstance(category, dict):
+            category_id = category.get('category_id')
+        elif category is not None:
+            raise TypeError('Wrong data type for `category`')
+        if category_id is None:
+            ## New category: nothing can be in it yet
+            return []
+        if isinstance(location, dict) and 'location_id' in location:
+            location = self.get_location(location['location_id'],
+                                         return_object=True)
+        if isinstance(location, Locations):
+            lat, lon = location.lat, location.lon
+        elif isinstance(location, dict):
+            lat, lon = location.get('lat'), location.get('lon')
+        elif location is None:
+            lat = lon = None
+        else:
+            raise TypeError('Wrong data type for `location`')
+        return duplicates.similar_items(self.session, item_name, category_id,
+                                        lat=lat, lon=lon, threshold=threshold)
+
+    def find_duplicate_items(self, threshold=None):
+        '''Get all the pairs of similar items (see `duplicates`), as
+        dictionaries with the `item_id` of the oldest item, the
+        `duplicate_id` of the other one and their `similarity`, most similar
+        first
+        '''
+        pairs = duplicates.find_duplicates(
+            duplicates.item_rows(self.session), threshold=threshold)
+        return [{'item_id': item_id,
+                 'duplicate_id': duplicate_id,
+                 'similarity': score}
+                for item_id, duplicate_id, score in pairs]
+
+    def merge_items(self, obj_id, duplicate_ids):
+        '''Merge items into the item `obj_id`: their posts are moved to it,
+        their rating aggregates added to its own, and they are deleted. All
+        the updates are single statements over the set of duplicates.
+        '''
+        duplicate_ids = set(duplicate_ids)
+        if not duplicate_ids or obj_id in duplicate_ids:
+            raise ValueError('Invalid duplicate items')
+        table = Items.__table__
+        found = self.session.execute(
+            select([func.count()])
+            .where(table.c.item_id.in_(duplicate_ids | set([obj_id])))
+            ).scalar()
+        if found != len(duplicate_ids)+1:
+            raise ValueError('No object corresponding to the given id')
+        columns = ['rating_sum', 'rating_count'] + ['rating_%d' % rating
+                                                    for rating in RATINGS]
+        other = table.alias()
+        values = dict(
+            (name, func.coalesce(table.c[name], 0) + (
+                select([func.coalesce(func.sum(other.c[name]), 0)])
+                .where(other.c.item_id.in_(duplicate_ids)).as_scalar()))
+            for name in columns)
+        try:
+            self.session.execute(
+                Posts.__table__.update()
+                .where(Posts.__table__.c.item_id.in_(duplicate_ids))
+                .values(item_id=obj_id))
+            self.session.execute(table.update()
+                                 .where(table.c.item_id == obj_id)
+                                 .values(**values))
+            self.session.execute(table.delete()
+                                 .where(table.c.item_id.in_(duplicate_ids)))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        ## The buffered posts embed their item
+        self.recent_posts.loaded = False
+        self.typeahead.invalidate('item', duplicate_ids | set([obj_id]))
+        return 'OK'
+
+    def rebuild_item_ratings(self):
+        '''Recompute the rating aggregates of all items from their posts (for
+        databases created before these columns existed)
         '''
-        return get_obj(Items, 'item', with_posts=True)(self, obj_id)
+        def rated_posts(*criteria):
+            '''Correlated subquery over the rated posts of an item
+            '''
+            return (select([func.count(Posts.post_id)])
+                    .where(Posts.item_id == Items.item_id)
+                    .where(Posts.rating.isnot(None))
+                    .where(and_(*criteria)))
+        values = {'rating_sum': (select([func.coalesce(func.sum(Posts.rating),
+                                                       0)])
+                                 .where(Posts.item_id == Items.item_id)
+                                 .as_scalar()),
+                  'rating_count': rated_posts().as_scalar()}
+        for rating in RATINGS:
+            values['rating_%d' % rating] = rated_posts(
+                Posts.rating == rating).as_scalar()
+        try:
+            self.session.execute(Items.__table__.update().values(**values))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        ## The items are ranked by their number of ratings
+        self.typeahead.loaded = False
+        return 'OK'
 
-    def get_all_items(self):
-        '''Get all items from the database
+    def get_item(self, obj_id, fields=None, expand=None):
+        '''Get a item by its id. `fields` and `expand` restrict the fields
+        and the embedded relationships (see `fieldset`).
+        '''
+        expand = fieldset('item', fields, expand)
+        profile = 'item_with_posts' if 'posts' in expand else 'item'
+        item = (load_profile(self.session.query(Items), profile)
+                .filter(Items.item_id == obj_id)
+                .first())
+        if not item:
+            return
+        return only_fields(item.as_dict(with_posts=True, expand=expand),
+                           fields)
+
+    def get_all_items(self, limit=None, cursor=None, fields=None,
+                      expand=None):
+        '''Get all items from the database, ordered by name. With a `limit`,
+        only one page is returned, starting after `cursor`. `fields` and
+        `expand` restrict the fields and the embedded location (see
+        `fieldset`).
+        '''
+        expand = fieldset('items', fields, expand)
+        items = projections.select_items(self.session,
+                                         limit=check_limit(limit),
+                                         after=decode_cursor('items', cursor),
+                                         expand=expand)
+        return [only_fields(item.as_dict(expand=expand), fields)
+                for item in items]
+
+    def get_nearby_items(self, lat, lon, radius=None, limit=None,
+                         category_id=None):
+        '''Get the items closest to a point, with their `distance` in km:
+        the items within `radius` km if given (at most `limit` of them), the
+        `limit` (`config.NEARBY_ITEMS` by default) nearest items otherwise.
+        With a `category_id`, only the items of the category and its
+        subcategories are searched (None if the category does not exist).
+        '''
+        lat, lon = geo.check_point(lat, lon)
+        limit = check_limit(limit)
+        if category_id is not None and not self.session.query(
+                Categories.category_id).filter(
+                    Categories.category_id == category_id).first():
+            return
+        if radius is None:
+            return geo.nearest(self.session, lat, lon,
+                               limit or config.NEARBY_ITEMS,
+                               category_id=category_id)
+        radius = float(radius)
+        if radius <= 0:
+            raise ValueError('`radius` must be positive')
+        items = geo.within(self.session, lat, lon, radius,
+                           category_id=category_id)
+        return items[:limit] if limit is not None else items
+
+    def get_map_clusters(self, zoom, bbox):
+        '''Get the clustered markers of the items in a bounding box (a
+        'min_lon,min_lat,max_lon,max_lat' string) at a zoom level: number of
+        items, centroid, average rating and most common category of every
+        non-empty cell (see `mapclusters`)
         '''
-        return get_all_obj(Items, order_by=lambda x: x['item_name'])(self)
+        zoom = int(zoom)
+        if not 0 <= zoom <= config.MAP_MAX_ZOOM:
+            raise ValueError('Invalid zoom level')
+        return mapclusters.clusters(self.session, zoom,
+                                    mapclusters.parse_bbox(bbox))
+
+    def rebuild_map_clusters(self):
+        '''Aggregate all the items in the map clusters again
+        '''
+        mapclusters.rebuild(self.session.connection())
+        self.session.commit()
 
     def delete_item(self, obj_id):
         '''Delete an item by its id
@@ -397,6 +1179,18 @@ class DataBase(object):
         kwdict['datetime'] = datetime.datetime.utcnow()
         return kwdict
 
+    def create_comments(self, comments):
+        '''Create a batch of comments (see `create_batch`), checking the
+        posts and users they reference once for the whole batch
+        '''
+        if not isinstance(comments, list):
+            raise TypeError('Wrong data type for the batch')
+        errors = {}
+        self.check_references(comments, errors, post_id=Posts.post_id,
+                              user_id=Users.user_id)
+        return self.create_batch(self.create_comment, 'comment', comments,
+                                 errors=errors)
+
     def get_comment(self, obj_id, return_object=True):
         '''Get a comment by its id
         '''
@@ -418,6 +1212,30 @@ class DataBase(object):
         '''
         return kwargs
 
+    def create_likes(self, likes):
+        '''Create a batch of likes (see `create_batch`), checking the posts
+        and users they reference, and the existing likes, once for the
+        whole batch
+        '''
+        if not isinstance(likes, list):
+            raise TypeError('Wrong data type for the batch')
+        errors = {}
+        self.check_references(likes, errors, post_id=Posts.post_id,
+                              user_id=Users.user_id)
+        pairs = [(like.get('post_id'), like.get('user_id'))
+                 if isinstance(like, dict) else None for like in likes]
+        seen = set(self.session.query(PostLikes.post_id, PostLikes.user_id)
+                   .filter(PostLikes.post_id.in_(
+                       set(pair[0] for pair in pairs if pair))))
+        for index, pair in enumerate(pairs):
+            if index in errors or pair is None or None in pair:
+                continue
+            if pair in seen:
+                errors[index] = 'The post is already liked by the user'
+            seen.add(pair)
+        return self.create_batch(self.create_like, 'like', likes,
+                                 errors=errors)
+
     def get_like(self, post_id=None, user_id=None, return_object=True):
         '''Get a like by its post_id and user_id
         '''
@@ -481,7 +1299,7 @@ class DataBase(object):
                     del kwdict['item']
                 else:
                     kwdict['item'] = self.create_item(return_object=True,
-                                                      commit=commit,
+                                                      commit=False,
                                                       **item)
 
         kwdict['post_datetime'] = datetime.datetime.utcnow()
@@ -518,48 +1336,156 @@ class DataBase(object):
             elif not isinstance(tags, list):
                 raise TypeError('Wrong data type for `tags`')
             else:
+                ## New tags, by name: they are not flushed yet, so they
+                ## cannot be found by `get_tag`
+                new_tags = {}
                 for j, tag in enumerate(tags):
                     if isinstance(tag, Tags):
                         pass
                     elif isinstance(tag, (unicode, str)):
-                        newtag = self.get_tag(tag_name=tag)
+                        newtag = (new_tags.get(tag.lower()) or
+                                  self.get_tag(tag_name=tag,
+                                               return_object=True))
                         if newtag:
                             kwdict['tags'][j] = newtag
                         else:
-                            kwdict['tags'][j] = self.create_tag(
-                                                      return_object=True,
-                                                      commit=commit,
-                                                      tag_name=tag)
+                            kwdict['tags'][j] = new_tags[tag.lower()] = (
+                                self.create_tag(return_object=True,
+                                                commit=False, tag_name=tag))
                     elif isinstance(tag, dict):
                         if 'tag_id' in tag:
                             kwdict['tags'][j] = self.get_tag(
                                                       return_object=True,
                                                       obj_id=tag['tag_id'])
                         else:
-                            newtag = self.get_tag(tag_name=tag['tag_name'],
-                                                  return_object=True)
+                            newtag = (
+                                new_tags.get(tag['tag_name'].lower()) or
+                                self.get_tag(tag_name=tag['tag_name'],
+                                             return_object=True))
                             if newtag:
                                 kwdict['tags'][j] = newtag
                             else:
-                                kwdict['tags'][j] = self.create_tag(
-                                                      return_object=True,
-                                                      commit=commit,
-                                                      **tag)
+                                kwdict['tags'][j] = new_tags[
+                                    tag['tag_name'].lower()] = (
+                                        self.create_tag(return_object=True,
+                                                        commit=False, **tag))
+                ## A post is tagged once with each tag
+                unique = []
+                for tag in kwdict['tags']:
+                    if not any(tag is other for other in unique):
+                        unique.append(tag)
+                kwdict['tags'] = unique
 
         return kwdict
 
-    def get_post(self, obj_id, return_object=False):
-        '''Get a post by its id
+    def create_posts(self, posts):
+        '''Create a batch of posts (see `create_batch`). The items, users
+        and tags referenced by the posts are looked up once for the whole
+        batch, and the new tags are created once.
         '''
-        return get_obj(Posts, 'post',
-                       with_item=True)(self, obj_id,
-                                       return_object=return_object)
-
-    def get_all_posts(self):
-        '''Get all posts from the database
+        if not isinstance(posts, list):
+            raise TypeError('Wrong data type for the batch')
+        errors = {}
+        posts = [dict(post) if isinstance(post, dict) else post
+                 for post in posts]
+        valid = [(index, post) for index, post in enumerate(posts)
+                 if isinstance(post, dict)]
+
+        ## Items and users
+        def item_id(post):
+            '''Id of the existing item of a post
+            '''
+            item = post.get('item')
+            if isinstance(item, dict):
+                return item.get('item_id')
+            return post.get('item_id')
+        items = dict(
+            (item.item_id, item) for item in self.session.query(Items).filter(
+                Items.item_id.in_(set(item_id(post) for _, post in valid))))
+        self.check_references(posts, errors, user_id=Users.user_id)
+        for index, post in valid:
+            obj_id = item_id(post)
+            if index in errors:
+                continue
+            if obj_id is not None and obj_id not in items:
+                errors[index] = 'No item corresponding to the given id'
+            elif obj_id is not None:
+                post.pop('item_id', None)
+                post['item'] = items[obj_id]
+
+        ## Tags, by id or by name, the new ones being created once
+        def tag_key(tag):
+            '''('tag_id', id) or ('tag_name', name) key of a tag given as a
+            name or a dictionary
+            '''
+            if isinstance(tag, basestring):
+                return 'tag_name', tag.lower()
+            if isinstance(tag, dict) and 'tag_id' in tag:
+                return 'tag_id', tag['tag_id']
+            if isinstance(tag, dict):
+                return 'tag_name', (tag.get('tag_name') or u'').lower()
+        keys = set(tag_key(tag) for _, post in valid
+                   if isinstance(post.get('tags'), list)
+                   for tag in post['tags'])
+        tags = {}
+        for field in ('tag_id', 'tag_name'):
+            values = set(value for key in keys if key and key[0] == field
+                         for value in key[1:])
+            if values:
+                tags.update(((field, getattr(tag, field)), tag)
+                            for tag in self.session.query(Tags).filter(
+                                getattr(Tags, field).in_(values)))
+        for index, post in valid:
+            if index in errors or not isinstance(post.get('tags'), list):
+                continue
+            resolved = []
+            for tag in post['tags']:
+                key = tag_key(tag)
+                if key is not None and key not in tags:
+                    if key[0] == 'tag_id':
+                        errors[index] = 'No tag corresponding to the given id'
+                        break
+                    if not key[1]:
+                        errors[index] = 'Missing required argument'
+                        break
+                    tags[key] = self.create_tag(commit=False,
+                                                return_object=True,
+                                                tag_name=key[1])
+                resolved.append(tags[key] if key is not None else tag)
+            post['tags'] = resolved
+        return self.create_batch(self.create_post, 'post', posts,
+                                 errors=errors)
+
+    def get_post(self, obj_id, return_object=False, fields=None,
+                 expand=None):
+        '''Get a post by its id. `fields` and `expand` restrict the fields
+        and the embedded relationships (see `fieldset`).
         '''
-        return get_all_obj(Posts, order_by=Posts.post_datetime.desc(),
-                           with_item=True)(self)
+        if return_object:
+            return get_obj(Posts, 'post')(self, obj_id, return_object=True)
+        expand = fieldset('posts', fields, expand)
+        post = (self.session.query(Posts)
+                            .options(*post_options(expand=expand))
+                            .filter(Posts.post_id == obj_id)
+                            .first())
+        if not post:
+            return
+        return only_fields(post.as_dict(expand=expand), fields)
+
+    def get_all_posts(self, limit=None, cursor=None, fields=None,
+                      expand=None):
+        '''Get all posts from the database, most recent first. With a
+        `limit`, only one page is returned, starting after `cursor`. `fields`
+        and `expand` restrict the fields and the embedded relationships (see
+        `fieldset`).
+        '''
+        expand = fieldset('posts', fields, expand)
+        posts = projections.select_posts(self.session,
+                                         limit=check_limit(limit),
+                                         after=decode_cursor('posts', cursor),
+                                         expand=expand)
+        return [only_fields(post.as_dict(expand=expand), fields)
+                for post in posts]
 
     def delete_post(self, obj_id):
         '''Delete a post by its id
@@ -580,15 +1506,38 @@ class DataBase(object):
         '''
         return kwargs
 
+    def create_tags(self, tags):
+        '''Create a batch of tags (see `create_batch`), checking the existing
+        tag names once for the whole batch
+        '''
+        if not isinstance(tags, list):
+            raise TypeError('Wrong data type for the batch')
+        errors = {}
+        names = [tag['tag_name'].lower()
+                 if isinstance(tag, dict) and
+                 isinstance(tag.get('tag_name'), basestring) else None
+                 for tag in tags]
+        seen = set(tag_name for tag_name, in self.session.query(Tags.tag_name)
+                   .filter(Tags.tag_name.in_(set(names) - set([None]))))
+        for index, name in enumerate(names):
+            if name is None:
+                continue
+            if name in seen:
+                errors[index] = 'The tag already exists'
+            seen.add(name)
+        return self.create_batch(self.create_tag, 'tag', tags,
+                                 errors=errors)
+
     def get_tag(self, obj_id=None, tag_name=None, return_object=False):
         '''Get a tag by its id or by its tag name
         '''
         if tag_name is None and obj_id is None:
             return
         if tag_name is not None:
-            tag = (self.session
-                       .query(Tags)
-                       .filter(Tags.tag_name == tag_name.lower())
+            query = self.session.query(Tags)
+            if not return_object:
+                query = load_profile(query, 'tag_with_posts')
+            tag = (query.filter(Tags.tag_name == tag_name.lower())
                        .first())
             if not tag:
                 return
@@ -600,52 +1549,68 @@ class DataBase(object):
             ## return dictionary
             return tag.as_dict(with_posts=True)
 
-        func = get_obj(Tags, 'tag', with_posts=True)
+        func = get_obj(Tags, 'tag', profile='tag_with_posts', with_posts=True)
         return func(self, obj_id, return_object=return_object)
 
-    def get_all_tags(self):
-        '''Get all tags from the database
+    def get_all_tags(self, limit=None, cursor=None):
+        '''Get all tags from the database, ordered by name. With a `limit`,
+        only one page is returned, starting after `cursor`.
         '''
-        return get_all_obj(Tags, order_by=Tags.tag_name)(self)
+        tags = projections.select_tags(self.session,
+                                       limit=check_limit(limit),
+                                       after=decode_cursor('tags', cursor))
+        return [tag.as_dict() for tag in tags]
 
     def delete_tag(self, obj_id):
         '''Delete a tag by its id
         '''
         return delete_obj(Tags, 'tag')(self, obj_id)
 
+    def rebuild_tag_counts(self):
+        '''Recompute the post counters of all tags (for databases created
+        before this column existed)
+        '''
+        count = (select([func.count(t_posts_tags.c.post_id)])
+                 .where(t_posts_tags.c.tag_id == Tags.tag_id)
+                 .as_scalar())
+        try:
+            self.session.execute(Tags.__table__.update()
+                                               .values(post_count=count))
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            raise
+        ## The tags are ranked by their number of posts
+        self.typeahead.loaded = False
+        return 'OK'
+
     def get_popular_tags(self, n_tags = 5):
         '''Get the most popular tags
         '''
         tags = (self.session
                 .query(Tags)
-                .order_by(Tags.h_number_of_posts.desc())
+                .order_by(Tags.post_count.desc())
                 .limit(int(n_tags)))
         return [tag.as_dict() for tag in tags]
 
     def get_trendy_tags(self, timediff=datetime.timedelta(hours=24), n_tags=5):
-        '''Get the most popular tags in the last xx hours
+        '''Get the most popular tags in the last xx hours. The posts are
+        counted from the in-memory buckets of `trending` when they cover the
+        window, by the database otherwise.
         '''
         if type(timediff) != datetime.timedelta:
             raise TypeError('`timediff` must be a `datetime.timedelta` object')
-
-        from collections import Counter
-
-        time_limit = datetime.datetime.utcnow() - timediff
-        tags = (self.session
-                .query(Tags.tag_name)
-                .filter(Posts.post_datetime > time_limit)
-                .filter(Posts.post_id == t_posts_tags.c.post_id)
-                .filter(Tags.tag_id == t_posts_tags.c.tag_id)
-                .all())
-
-        ctr = Counter(tag[0] for tag in tags)
-        out = [{'tag_name': key,
-                'number_of_posts': val} for key, val in ctr.iteritems()]
-        out = sorted(out, key=lambda x: x['number_of_posts'], reverse=True)
-        return out[:n_tags]
-
-    def search_tags(self, string):
-        '''Search for posts that have a particular string
+        return [{'tag_name': tag_name, 'number_of_posts': count}
+                for tag_name, count in self.trending.top(self.session,
+                                                         timediff,
+                                                         int(n_tags))]
+
+    def search_tags(self, string, limit=None, cursor=None, any_tag=False):
+        '''Search for posts that have all the (space-separated) tags of a
+        string, or any of them with `any_tag`. The matching post ids are
+        found in the tag index (see `tagindex`) and only the posts of the
+        page are read. With a `limit`, only one page is returned, starting
+        after `cursor`.
         '''
         if not isinstance(string, (unicode, str)):
             raise TypeError('Argument must be a string')
@@ -654,12 +1619,51 @@ class DataBase(object):
         if not re.match('^[\w ]*$', string):
             raise ValueError('Invalid input string')
 
-        posts = self.session.query(Posts).order_by(Posts.post_datetime.desc())
-        for sub in string.split():
-            posts = posts.filter(Posts.tags.any(Tags.tag_name == sub))
-        posts = posts.all()
+        after = decode_cursor('posts', cursor)
+        limit = check_limit(limit)
+        tag_names = string.split()
+        if not tag_names:
+            posts = projections.select_posts(self.session, limit=limit,
+                                             after=after)
+            return [post.as_dict() for post in posts]
+        post_ids = self.tag_index.post_ids(
+            self.session, tag_names, any_tag=any_tag, limit=limit,
+            after=after)
+        if not post_ids:
+            return []
+        posts = projections.select_posts(
+            self.session, criteria=[Posts.post_id.in_(post_ids)])
+        return [post.as_dict() for post in posts]
+
+    ### SEARCH ###
+
+    def search(self, string, limit=None, cursor=None):
+        '''Full-text search of the post reviews, item names and comments
+        (see `search`), best matches first. With a `limit`, only one page is
+        returned, starting after `cursor`.
+        '''
+        if not isinstance(string, (unicode, str)):
+            raise TypeError('Argument must be a string')
+        return search.search(self.session, string, limit=check_limit(limit),
+                             after=decode_cursor('results', cursor))
+
+    def rebuild_search_index(self):
+        '''Re-index all the post reviews, item names and comments
+        '''
+        search.rebuild(self.session.connection())
+        self.session.commit()
 
-        return [post.as_dict(with_item=True) for post in posts]
+    ### AUTOCOMPLETE ###
+
+    def autocomplete(self, string, kind=None, limit=None):
+        '''Get the most popular tags, items and categories (or only those of
+        `kind`: 'tag', 'item' or 'category') with a word starting with
+        `string`, `limit` (`config.AUTOCOMPLETE_LIMIT` by default) at most
+        (see `typeahead`)
+        '''
+        limit = check_limit(limit) or config.AUTOCOMPLETE_LIMIT
+        return self.typeahead.complete(self.session, string, kind=kind,
+                                       limit=limit)
 
     ### USER ###
 
@@ -680,9 +1684,92 @@ class DataBase(object):
         return kwdict
 
     def get_user(self, obj_id):
-        '''Get a user by its id (only for authorized users)
+        '''Get a user by its id (only for authorized users), with the first
+        page of their friends (see `get_friends`)
+        '''
+        user = get_obj(Users, 'user', profile='user_profile')(self, obj_id)
+        if user is None:
+            return
+        limit = config.FRIENDS_PAGE_SIZE
+        user['friends'] = [friend.as_dict() for friend in
+                           projections.select_friends(self.session, obj_id,
+                                                      limit=limit)]
+        cursor = next_cursor('friends', user['friends'], limit)
+        if cursor is not None:
+            user['friends_next_cursor'] = cursor
+        return user
+
+    def get_degree_of_separation(self, first_user_id, second_user_id,
+                                 max_depth=6):
+        '''Get the number of friendship links between two users (None if it
+        is more than `max_depth`)
+        '''
+        return self.friends_graph.distance(first_user_id, second_user_id,
+                                           max_depth=int(max_depth))
+
+    def get_network_posts(self, obj_id, depth=2, limit=None, cursor=None):
+        '''Get the posts of the users at most `depth` friendship links away
+        from a user (friends and friends of friends by default), most recent
+        first. With a `limit`, only one page is returned, starting after
+        `cursor`.
+        '''
+        if not self.session.query(Users.user_id).filter(
+                Users.user_id == obj_id).first():
+            return
+        user_ids = self.friends_graph.within(obj_id, max_depth=int(depth))
+        if not user_ids:
+            return []
+        posts = projections.select_posts(
+            self.session, limit=check_limit(limit),
+            after=decode_cursor('posts', cursor),
+            criteria=[Posts.user_id.in_(sorted(user_ids))])
+        return [post.as_dict() for post in posts]
+
+    def get_feed(self, obj_id, limit=None, cursor=None):
+        '''Get the home timeline of a user: their posts and the posts of
+        their friends, most recent first. With a `limit`, only one page is
+        returned, starting after `cursor`.
         '''
-        return get_obj(Users, 'user')(self, obj_id)
+        if not self.session.query(Users.user_id).filter(
+                Users.user_id == obj_id).first():
+            return
+        posts = self.timelines.read(self.session, obj_id,
+                                    limit=check_limit(limit),
+                                    after=decode_cursor('posts', cursor))
+        return [post.as_dict() for post in posts]
+
+    def rebuild_timelines(self):
+        '''Rebuild the home timelines of all users from their posts and
+        friendships
+        '''
+        self.timelines.rebuild(self.session)
+
+    def get_friend_suggestions(self, obj_id, limit=None):
+        '''Get the "people you may know" of a user: the users with the most
+        friends in common with them (at most `config.FRIEND_SUGGESTIONS`)
+        '''
+        if not self.session.query(Users.user_id).filter(
+                Users.user_id == obj_id).first():
+            return
+        suggestions = self.friend_suggestions.suggest(obj_id)
+        limit = check_limit(limit)
+        if limit is not None:
+            suggestions = suggestions[:limit]
+        return [{'user_id': user_id, 'common_friends': count}
+                for user_id, count in suggestions]
+
+    def get_friends(self, obj_id, limit=None, cursor=None):
+        '''Get the summaries of the friends of a user, ordered by id, with a
+        single query whatever their number. With a `limit`, only one page is
+        returned, starting after `cursor`.
+        '''
+        if not self.session.query(Users.user_id).filter(
+                Users.user_id == obj_id).first():
+            return
+        friends = projections.select_friends(
+            self.session, obj_id, limit=check_limit(limit),
+            after=decode_cursor('friends', cursor))
+        return [friend.as_dict() for friend in friends]
 
     ## Add create_user to api.py and test it
     ## Add delete_user here and to api.py + tests
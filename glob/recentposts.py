@@ -0,0 +1,107 @@
+'''
+.. module:: glob.recentposts
+
+Process-local ring buffer of the most recent posts, serialized, so that the
+recent posts are served from memory without any SQL in the steady state.
+
+The buffer is filled on first use and kept up to date with the posts that
+are committed: deleted posts are dropped right away, new and modified posts
+are read (in one batch) on the next read. The tag counters and item ratings
+embedded in the buffered posts are those of the time the posts were read.
+'''
+
+from collections import deque
+from itertools import islice
+
+from changes import watch_changes
+from dbmodels import Posts
+import projections
+
+def post_key(post):
+    '''Ordering key of a serialized post (most recent last)
+    '''
+    return post['post_datetime'], post['post_id']
+
+class RecentPosts(object):
+    '''Ring buffer of the `size` most recent posts, most recent first
+    '''
+
+    def __init__(self, size=100):
+        self.size = size
+        self.posts = deque(maxlen=size)
+        self.loaded = False
+        ## Ids of the posts committed (created or modified) since the last
+        ## read
+        self.pending = set()
+
+    def load(self, session):
+        '''Fill the buffer from the database
+        '''
+        self.posts.clear()
+        self.posts.extend(post.as_dict() for post in
+                          projections.select_posts(session, limit=self.size))
+        self.pending.clear()
+        self.loaded = True
+
+    def refresh(self, session):
+        '''Read the posts committed since the last read into the buffer
+        '''
+        if not self.loaded:
+            self.load(session)
+            return
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, set()
+        new = sorted((post.as_dict() for post in projections.select_posts(
+                      session, criteria=[Posts.post_id.in_(sorted(pending))])),
+                     key=post_key)
+        if any(post['post_id'] in pending for post in self.posts):
+            ## Modified posts: replace them
+            kept = [post for post in self.posts
+                    if post['post_id'] not in pending]
+            self.posts.clear()
+            self.posts.extend(kept)
+        if not new:
+            return
+        if not self.posts or post_key(new[0]) > post_key(self.posts[0]):
+            ## Usual case: the new posts are the most recent ones
+            self.posts.extendleft(new)
+        else:
+            posts = sorted(list(self.posts)+new, key=post_key, reverse=True)
+            self.posts.clear()
+            self.posts.extend(posts[:self.size])
+
+    def get(self, session, n_posts):
+        '''Get the `n_posts` (at most `size`) most recent posts
+        '''
+        self.refresh(session)
+        return list(islice(self.posts, n_posts))
+
+    def watch(self, session_factory):
+        '''Keep the buffer up to date with the posts committed by the
+        sessions of `session_factory` (a `sessionmaker` or `Session` class)
+        '''
+        def collect(session, changes):
+            '''Record the changed and deleted posts of a flush
+            '''
+            changed, deleted = changes
+            for obj in session.new.union(session.dirty):
+                if isinstance(obj, Posts):
+                    changed.add(obj.post_id)
+            for obj in session.deleted:
+                if isinstance(obj, Posts):
+                    deleted.add(obj.post_id)
+
+        def apply_changes(changes):
+            '''Apply the changes of a committed transaction
+            '''
+            changed, deleted = changes
+            self.pending |= changed - deleted
+            self.pending -= deleted
+            if deleted and any(post['post_id'] in deleted
+                               for post in self.posts):
+                ## The buffer needs to be filled up again
+                self.loaded = False
+
+        watch_changes(session_factory, ('recentposts', id(self)), collect,
+                      apply_changes, empty=lambda: (set(), set()))
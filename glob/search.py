@@ -0,0 +1,128 @@
+'''
+.. module:: glob.search
+
+Full-text search over the post reviews, the item names and the comments,
+with an SQLite FTS5 index.
+
+All the documents are in a single `search_index` table, so that they are
+ranked together (bm25). The rowid of a document encodes what it is:
+`obj_id*4 + code`, with the codes of `DOCUMENTS`. The index is kept in sync
+by triggers on the indexed tables, so every writer (not only the sessions
+of this process) updates it in the same transaction.
+'''
+
+import re
+
+from sqlalchemy.sql import text
+
+SEARCH_TABLE = 'search_index'
+
+## Indexed documents: kind -> (code, table, id column, text column)
+DOCUMENTS = {'post': (1, 'posts', 'post_id', 'review'),
+             'item': (2, 'items', 'item_id', 'item_name'),
+             'comment': (3, 'post_comments', 'comment_id', 'comment')}
+KINDS = dict((code, kind) for kind, (code, _, _, _) in DOCUMENTS.iteritems())
+
+CREATE_TABLE = ("CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING "
+                "fts5(body, tokenize='porter unicode61 remove_diacritics 2')")
+
+TRIGGERS = ['''
+CREATE TRIGGER IF NOT EXISTS {0}_{table}_insert AFTER INSERT ON {table}
+WHEN new.{column} IS NOT NULL BEGIN
+    INSERT INTO {0}(rowid, body) VALUES (new.{id}*4+{code}, new.{column});
+END''', '''
+CREATE TRIGGER IF NOT EXISTS {0}_{table}_update
+AFTER UPDATE OF {column} ON {table} BEGIN
+    DELETE FROM {0} WHERE rowid = old.{id}*4+{code};
+    INSERT INTO {0}(rowid, body) SELECT new.{id}*4+{code}, new.{column}
+    WHERE new.{column} IS NOT NULL;
+END''', '''
+CREATE TRIGGER IF NOT EXISTS {0}_{table}_delete AFTER DELETE ON {table}
+BEGIN
+    DELETE FROM {0} WHERE rowid = old.{id}*4+{code};
+END''']
+
+def install(engine):
+    '''Create the index and its triggers if they do not exist yet, and fill
+    the index when it is created
+    '''
+    with engine.begin() as connection:
+        exists = connection.execute(
+            text("SELECT name FROM sqlite_master WHERE name = :name"),
+            name=SEARCH_TABLE).first()
+        if exists:
+            return
+        connection.execute(CREATE_TABLE.format(SEARCH_TABLE))
+        for code, table, id_column, column in DOCUMENTS.itervalues():
+            for trigger in TRIGGERS:
+                connection.execute(trigger.format(SEARCH_TABLE, table=table,
+                                                  id=id_column, code=code,
+                                                  column=column))
+        fill(connection)
+
+def fill(connection):
+    '''Index all the documents
+    '''
+    for code, table, id_column, column in DOCUMENTS.itervalues():
+        connection.execute(
+            "INSERT INTO {0}(rowid, body) SELECT {id}*4+{code}, {column} "
+            "FROM {table} WHERE {column} IS NOT NULL"
+            .format(SEARCH_TABLE, table=table, id=id_column, code=code,
+                    column=column))
+
+def rebuild(connection):
+    '''Re-index all the documents
+    '''
+    connection.execute("DELETE FROM {0}".format(SEARCH_TABLE))
+    fill(connection)
+
+def match_expression(string):
+    '''FTS5 query matching all the words of a user query. The words are
+    quoted, so that the FTS5 syntax is not interpreted.
+    '''
+    words = re.findall(r'\w+', string, re.UNICODE)
+    if not words:
+        raise ValueError('Empty search query')
+    return u' '.join(u'"{}"'.format(word) for word in words)
+
+QUERY = '''
+SELECT {0}.rowid AS document, {0}.rank AS rank,
+       snippet({0}, 0, '<b>', '</b>', '...', 10) AS snippet,
+       post_comments.post_id AS comment_post_id
+FROM {0} LEFT OUTER JOIN post_comments
+     ON {0}.rowid % 4 = {comment} AND post_comments.comment_id = {0}.rowid / 4
+WHERE {0} MATCH :query {after}
+ORDER BY rank, document
+{limit}'''
+
+AFTER = ('AND ({0}.rank > :rank OR '
+         '({0}.rank = :rank AND {0}.rowid > :document))')
+
+def search(session, string, limit=None, after=None):
+    '''Get the documents matching all the words of `string`, best matches
+    first, `limit` at a time, starting after the (rank, document) key
+    `after`. Each result has the kind and id of the matched object (the id
+    of the post for a comment), its rank and a snippet of the matched text.
+    '''
+    params = {'query': match_expression(string)}
+    if after is not None:
+        params['rank'], params['document'] = after
+    if limit is not None:
+        params['limit'] = limit
+    query = QUERY.format(SEARCH_TABLE, comment=DOCUMENTS['comment'][0],
+                         after=AFTER.format(SEARCH_TABLE)
+                         if after is not None else '',
+                         limit='LIMIT :limit' if limit is not None else '')
+    results = []
+    for row in session.execute(text(query), params):
+        kind = KINDS[row.document % 4]
+        result = {'kind': kind,
+                  'rank': row.rank,
+                  'document': row.document,
+                  'snippet': row.snippet}
+        if kind == 'comment':
+            result['post_id'] = row.comment_post_id
+        else:
+            result[kind+'_id'] = row.document // 4
+        results.append(result)
+    return results
@@ -0,0 +1,331 @@
+'''
+.. module:: glob.socialgraph
+
+In-memory graph of the relationships between users, for degree of
+separation and friends-of-friends queries that would otherwise take a chain
+of relationship loads.
+
+The graph of some relationship types (e.g. friends) is stored in compressed
+sparse row (CSR) form: the neighbours of the user at row `i` are
+`neighbors[offsets[i]:offsets[i+1]]`, sorted by id. Relationships committed
+after the arrays were built are kept in small per-user overlays, which are
+merged into the arrays once they hold more than `max_changes` changes.
+
+`FriendSuggestions` ranks the "people you may know" of a user by their
+number of common friends, read off the friends graph.
+'''
+
+import bisect
+import heapq
+from array import array
+
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import select
+
+from changes import watch_changes
+from dbmodels import UserRelationships, UserRelationshipTypes
+
+class SocialGraph(object):
+    '''Undirected graph of the users linked by any of the given relationship
+    types
+    '''
+
+    def __init__(self, relationship_names=(u'friends',), max_changes=1000):
+        self.relationship_names = relationship_names
+        self.type_ids = set()
+        self.max_changes = max_changes
+        ## Functions called with (first, second, linked) on every change
+        self.listeners = []
+        self.build([])
+
+    ### CONSTRUCTION ###
+
+    def build(self, edges):
+        '''Build the arrays from (first_user_id, second_user_id) pairs
+        '''
+        adjacency = {}
+        for first, second in edges:
+            if first == second:
+                continue
+            adjacency.setdefault(first, set()).add(second)
+            adjacency.setdefault(second, set()).add(first)
+        self.rows = {}
+        self.offsets = array('l', [0])
+        self.neighbors = array('l')
+        for row, user_id in enumerate(sorted(adjacency)):
+            self.rows[user_id] = row
+            self.neighbors.extend(sorted(adjacency[user_id]))
+            self.offsets.append(len(self.neighbors))
+        self.added = {}
+        self.removed = {}
+        self.n_changes = 0
+
+    def load(self, session):
+        '''Build the graph from the `user_relationships` table
+        '''
+        self.type_ids = set(
+            type_id for type_id, in
+            session.query(UserRelationshipTypes.relationship_id)
+                   .filter(UserRelationshipTypes.relationship_name
+                           .in_(self.relationship_names)))
+        table = UserRelationships.__table__
+        self.build(session.execute(
+            select([table.c.first_user_id, table.c.second_user_id])
+            .where(table.c.type_id.in_(self.type_ids))))
+
+    def edges(self):
+        '''Iterate over the (first_user_id, second_user_id) pairs, with
+        first_user_id < second_user_id
+        '''
+        for user_id in set(self.rows) | set(self.added):
+            for other in self.friends(user_id):
+                if user_id < other:
+                    yield user_id, other
+
+    def compact(self):
+        '''Merge the overlays into the arrays
+        '''
+        self.build(list(self.edges()))
+
+    ### UPDATES ###
+
+    def change(self, first, second, linked):
+        '''Record that two users are now linked (or not)
+        '''
+        if first == second or self.are_linked(first, second) == linked:
+            return
+        for user_id, other in ((first, second), (second, first)):
+            undo, do = ((self.removed, self.added) if linked
+                        else (self.added, self.removed))
+            if other in undo.get(user_id, ()):
+                undo[user_id].discard(other)
+            else:
+                do.setdefault(user_id, set()).add(other)
+        self.n_changes += 1
+        if self.n_changes > self.max_changes:
+            self.compact()
+        for listener in self.listeners:
+            listener(first, second, linked)
+
+    def add_edge(self, first, second):
+        '''Link two users
+        '''
+        self.change(first, second, True)
+
+    def remove_edge(self, first, second):
+        '''Unlink two users
+        '''
+        self.change(first, second, False)
+
+    def watch(self, session_factory):
+        '''Keep the graph up to date with the relationships committed by the
+        sessions of `session_factory` (a `sessionmaker` or `Session` class)
+        '''
+        def collect(session, changes):
+            '''Record the relationship changes of a flush
+            '''
+            for obj in session.new:
+                if isinstance(obj, UserRelationships):
+                    changes.append((obj.first_user_id, obj.second_user_id,
+                                    None, obj.type_id))
+            for obj in session.dirty:
+                if isinstance(obj, UserRelationships):
+                    changes.append((obj.first_user_id, obj.second_user_id,
+                                    previous_type_id(obj), obj.type_id))
+            for obj in session.deleted:
+                if isinstance(obj, UserRelationships):
+                    changes.append((obj.first_user_id, obj.second_user_id,
+                                    previous_type_id(obj), None))
+
+        def apply_changes(changes):
+            '''Apply the changes of a committed transaction
+            '''
+            for first, second, old, new in changes:
+                linked = new in self.type_ids
+                if (old in self.type_ids) != linked:
+                    self.change(first, second, linked)
+
+        watch_changes(session_factory, ('socialgraph', id(self)), collect,
+                      apply_changes)
+
+    ### QUERIES ###
+
+    def friends(self, user_id):
+        '''Sorted ids of the users linked to a user
+        '''
+        row = self.rows.get(user_id)
+        if row is None:
+            base = array('l')
+        else:
+            base = self.neighbors[self.offsets[row]:self.offsets[row+1]]
+        added = self.added.get(user_id)
+        removed = self.removed.get(user_id)
+        if not added and not removed:
+            return base
+        return sorted((set(base) - (removed or set())) | (added or set()))
+
+    def degree(self, user_id):
+        '''Number of users linked to a user
+        '''
+        row = self.rows.get(user_id)
+        degree = 0 if row is None else self.offsets[row+1]-self.offsets[row]
+        return (degree+len(self.added.get(user_id, ())) -
+                len(self.removed.get(user_id, ())))
+
+    def are_linked(self, first, second):
+        '''Whether two users are linked
+        '''
+        if second in self.added.get(first, ()):
+            return True
+        if second in self.removed.get(first, ()):
+            return False
+        row = self.rows.get(first)
+        if row is None:
+            return False
+        start, end = self.offsets[row], self.offsets[row+1]
+        index = bisect.bisect_left(self.neighbors, second, start, end)
+        return index < end and self.neighbors[index] == second
+
+    def within(self, user_id, max_depth=2, limit=None):
+        '''Breadth-first search from a user: get the distance to every user
+        at most `max_depth` links away (the user excluded), stopping once
+        `limit` users have been reached
+        '''
+        distances = {user_id: 0}
+        frontier = [user_id]
+        for depth in range(1, max_depth+1):
+            next_frontier = []
+            for current in frontier:
+                for other in self.friends(current):
+                    if other in distances:
+                        continue
+                    distances[other] = depth
+                    next_frontier.append(other)
+                    if limit is not None and len(distances) > limit:
+                        del distances[user_id]
+                        return distances
+            frontier = next_frontier
+        del distances[user_id]
+        return distances
+
+    def friends_of_friends(self, user_id, limit=None):
+        '''Sorted ids of the users two links away from a user (and not
+        directly linked to them)
+        '''
+        return sorted(other for other, depth
+                      in self.within(user_id, 2, limit=limit).iteritems()
+                      if depth == 2)
+
+    def distance(self, first, second, max_depth=6):
+        '''Degree of separation between two users, found with a
+        bidirectional breadth-first search (None if it is more than
+        `max_depth`)
+        '''
+        if first == second:
+            return 0
+        sides = [({first: 0}, [first]), ({second: 0}, [second])]
+        for depth in range(1, max_depth+1):
+            ## Expand the smallest frontier
+            seen, frontier = min(sides, key=lambda side: len(side[1]))
+            other_seen = sides[1][0] if seen is sides[0][0] else sides[0][0]
+            next_frontier = []
+            best = None
+            for current in frontier:
+                for other in self.friends(current):
+                    if other in other_seen:
+                        length = seen[current]+1+other_seen[other]
+                        if best is None or length < best:
+                            best = length
+                    elif other not in seen:
+                        seen[other] = seen[current]+1
+                        next_frontier.append(other)
+            if best is not None:
+                return best
+            if not next_frontier:
+                return
+            del frontier[:]
+            frontier.extend(next_frontier)
+
+class FriendSuggestions(object):
+    '''Top `k` "people you may know" of every user: the users with the most
+    friends in common with them, excluding their friends and the users they
+    have another relationship with (pending or blocked).
+
+    The common friend counts of a user are the row of the sparse matrix
+    product A.A, where A is the adjacency matrix of the friends graph. The
+    row is computed from the CSR rows of A (row-by-row sparse product), so
+    it only costs the number of friends of friends. The top `k` of every
+    user is cached, and only the users whose row changes are refreshed when
+    a relationship changes.
+    '''
+
+    def __init__(self, friends, excluded, k=10):
+        self.friends = friends
+        self.excluded = excluded
+        self.k = k
+        self.cache = {}
+        friends.listeners.append(self.friendship_changed)
+        excluded.listeners.append(self.exclusion_changed)
+
+    def common_friends(self, user_id):
+        '''Number of friends in common with every user two links away
+        '''
+        counts = {}
+        for friend in self.friends.friends(user_id):
+            for other in self.friends.friends(friend):
+                counts[other] = counts.get(other, 0)+1
+        counts.pop(user_id, None)
+        return counts
+
+    def compute(self, user_id):
+        '''Rank the suggestions of a user
+        '''
+        counts = self.common_friends(user_id)
+        for other in self.friends.friends(user_id):
+            counts.pop(other, None)
+        for other in self.excluded.friends(user_id):
+            counts.pop(other, None)
+        return heapq.nsmallest(self.k, counts.iteritems(),
+                               key=lambda item: (-item[1], item[0]))
+
+    def compute_all(self):
+        '''Fill the cache for all the users of the friends graph
+        '''
+        for user_id in set(self.friends.rows) | set(self.friends.added):
+            self.cache[user_id] = self.compute(user_id)
+
+    def suggest(self, user_id):
+        '''Get the (user_id, number of common friends) suggestions of a user,
+        most common friends first
+        '''
+        if user_id not in self.cache:
+            self.cache[user_id] = self.compute(user_id)
+        return self.cache[user_id]
+
+    def friendship_changed(self, first, second, linked):
+        '''A friendship changes the rows of A.A of both users and of their
+        friends
+        '''
+        for user_id in (first, second):
+            self.cache.pop(user_id, None)
+            for friend in self.friends.friends(user_id):
+                self.cache.pop(friend, None)
+
+    def exclusion_changed(self, first, second, linked):
+        '''A pending or blocked relationship only changes the suggestions of
+        both users
+        '''
+        self.cache.pop(first, None)
+        self.cache.pop(second, None)
+
+def previous_type_id(obj):
+    '''Relationship type of a `UserRelationships` before the current flush
+    '''
+    history = get_history(obj, 'type_id')
+    if history.deleted:
+        return history.deleted[0]
+    history = get_history(obj, 'type')
+    if history.deleted:
+        return history.deleted[0].relationship_id if history.deleted[0] \
+            else None
+    return obj.type_id
@@ -0,0 +1,221 @@
+'''
+.. module:: glob.tagindex
+
+In-memory inverted index from tag names to the ids of the posts carrying
+them, for tag searches.
+
+The post ids of a tag are stored in a `Bitmap`: as in roaring bitmaps, the
+ids are split in chunks of 2**16 on their high bits, and each chunk is the
+bitset of the low bits of its ids (a Python long), so that AND and OR
+queries are chunk-wise bitwise operations. The index also keeps the
+datetime of the tagged posts, so that a page of results, the most recent
+matching posts by (post_datetime, post_id), is picked before any post is
+loaded.
+'''
+
+import heapq
+
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import select
+
+from changes import watch_changes
+from dbmodels import Posts, Tags, t_posts_tags
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS)-1
+
+class Bitmap(object):
+    '''Compressed set of non-negative integers
+    '''
+    __slots__ = ('chunks',)
+
+    def __init__(self, values=()):
+        ## high bits -> bitset of the low bits
+        self.chunks = {}
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        high = value >> CHUNK_BITS
+        self.chunks[high] = (self.chunks.get(high, 0) |
+                             1 << (value & CHUNK_MASK))
+
+    def discard(self, value):
+        high = value >> CHUNK_BITS
+        chunk = self.chunks.get(high, 0) & ~(1 << (value & CHUNK_MASK))
+        if chunk:
+            self.chunks[high] = chunk
+        else:
+            self.chunks.pop(high, None)
+
+    def __contains__(self, value):
+        return bool(self.chunks.get(value >> CHUNK_BITS, 0) >>
+                    (value & CHUNK_MASK) & 1)
+
+    def __len__(self):
+        return sum(bin(chunk).count('1') for chunk in self.chunks.itervalues())
+
+    def __and__(self, other):
+        if len(other.chunks) < len(self.chunks):
+            self, other = other, self
+        result = Bitmap()
+        for high, chunk in self.chunks.iteritems():
+            chunk &= other.chunks.get(high, 0)
+            if chunk:
+                result.chunks[high] = chunk
+        return result
+
+    def __or__(self, other):
+        result = Bitmap()
+        result.chunks = dict(self.chunks)
+        for high, chunk in other.chunks.iteritems():
+            result.chunks[high] = result.chunks.get(high, 0) | chunk
+        return result
+
+    def descending(self, before=None):
+        '''Iterate over the values in decreasing order, starting below
+        `before`
+        '''
+        for high in sorted(self.chunks, reverse=True):
+            chunk = self.chunks[high]
+            if before is not None:
+                if high > before >> CHUNK_BITS:
+                    continue
+                if high == before >> CHUNK_BITS:
+                    chunk &= (1 << (before & CHUNK_MASK))-1
+            while chunk:
+                low = chunk.bit_length()-1
+                yield high << CHUNK_BITS | low
+                chunk ^= 1 << low
+
+class TagIndex(object):
+    '''Bitmap of the post ids of every tag, filled on first use and kept up
+    to date with the committed tag changes
+    '''
+
+    def __init__(self):
+        self.bitmaps = {}
+        ## post id -> post datetime, for the ordering of the results
+        self.datetimes = {}
+        self.loaded = False
+
+    def load(self, session):
+        '''Build the index from the `posts_tags` table
+        '''
+        self.bitmaps = {}
+        self.datetimes = {}
+        query = (select([Tags.tag_name, t_posts_tags.c.post_id,
+                         Posts.post_datetime])
+                 .select_from(t_posts_tags
+                              .join(Tags.__table__,
+                                    Tags.tag_id == t_posts_tags.c.tag_id)
+                              .join(Posts.__table__,
+                                    Posts.post_id == t_posts_tags.c.post_id)))
+        for tag_name, post_id, post_datetime in session.execute(query):
+            self.add(tag_name, post_id, post_datetime)
+        self.loaded = True
+
+    def add(self, tag_name, post_id, post_datetime):
+        '''Tag a post
+        '''
+        self.bitmaps.setdefault(tag_name, Bitmap()).add(post_id)
+        self.datetimes[post_id] = post_datetime
+
+    def remove(self, tag_name, post_id):
+        '''Untag a post
+        '''
+        bitmap = self.bitmaps.get(tag_name)
+        if bitmap is not None:
+            bitmap.discard(post_id)
+            if not bitmap.chunks:
+                del self.bitmaps[tag_name]
+
+    def match(self, tag_names, any_tag=False):
+        '''Bitmap of the posts with all (or any, with `any_tag`) of the tags
+        '''
+        bitmaps = [self.bitmaps.get(tag_name, Bitmap())
+                   for tag_name in tag_names]
+        if not bitmaps:
+            return Bitmap()
+        if any_tag:
+            return reduce(lambda first, second: first | second, bitmaps)
+        ## Intersect the smallest bitmaps first
+        bitmaps.sort(key=lambda bitmap: len(bitmap.chunks))
+        return reduce(lambda first, second: first & second, bitmaps)
+
+    def post_ids(self, session, tag_names, any_tag=False, limit=None,
+                 after=None):
+        '''Ids of the posts with all (or any) of the tags, most recent
+        first, `limit` at a time, starting after the (post_datetime,
+        post_id) key `after`
+        '''
+        if not self.loaded:
+            self.load(session)
+        keys = ((self.datetimes.get(post_id), post_id) for post_id
+                in self.match(tag_names, any_tag=any_tag).descending())
+        if after is not None:
+            after = tuple(after)
+            keys = (key for key in keys if key < after)
+        if limit is None:
+            keys = sorted(keys, reverse=True)
+        else:
+            keys = heapq.nlargest(limit, keys)
+        return [post_id for _, post_id in keys]
+
+    def watch(self, session_factory):
+        '''Keep the index up to date with the tags committed by the sessions
+        of `session_factory` (a `sessionmaker` or `Session` class)
+        '''
+        def collect(session, changes):
+            '''Record the (tag name, post id, post datetime, tagged) changes
+            of a flush. A change without tag name updates (or, untagged,
+            forgets) the datetime of a post.
+            '''
+            for obj in session.new:
+                if isinstance(obj, Posts):
+                    changes.extend((tag.tag_name, obj.post_id,
+                                    obj.post_datetime, True)
+                                   for tag in obj.tags)
+            for obj in session.dirty:
+                if isinstance(obj, Posts):
+                    history = get_history(obj, 'tags')
+                    changes.extend((tag.tag_name, obj.post_id,
+                                    obj.post_datetime, True)
+                                   for tag in history.added)
+                    changes.extend((tag.tag_name, obj.post_id, None, False)
+                                   for tag in history.deleted)
+                    changes.append((None, obj.post_id, obj.post_datetime,
+                                    True))
+                elif isinstance(obj, Tags):
+                    history = get_history(obj, 'posts')
+                    changes.extend((obj.tag_name, post.post_id,
+                                    post.post_datetime, True)
+                                   for post in history.added)
+                    changes.extend((obj.tag_name, post.post_id, None, False)
+                                   for post in history.deleted)
+            for obj in session.deleted:
+                if isinstance(obj, Posts):
+                    changes.extend((tag.tag_name, obj.post_id, None, False)
+                                   for tag in obj.tags)
+                    changes.append((None, obj.post_id, None, False))
+                elif isinstance(obj, Tags):
+                    changes.append((obj.tag_name, None, None, False))
+
+        def apply_changes(changes):
+            '''Apply the changes of a committed transaction
+            '''
+            for tag_name, post_id, post_datetime, tagged in changes:
+                if tag_name is None:
+                    if tagged:
+                        self.datetimes[post_id] = post_datetime
+                    else:
+                        self.datetimes.pop(post_id, None)
+                elif post_id is None:
+                    self.bitmaps.pop(tag_name, None)
+                elif tagged:
+                    self.add(tag_name, post_id, post_datetime)
+                else:
+                    self.remove(tag_name, post_id)
+
+        watch_changes(session_factory, ('tagindex', id(self)), collect,
+                      apply_changes)
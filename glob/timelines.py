@@ -0,0 +1,157 @@
+'''
+.. module:: glob.timelines
+
+Home timelines built with fan-out on write: when a post is flushed, its id
+is added to the timeline of its author and of each of their friends (the
+`timelines` table), so that reading a page of a feed is a single index range
+scan instead of a join over relationships and posts.
+
+A timeline keeps (about) the `size` most recent posts. Users with more than
+`fanout_limit` friends are not fanned out: their posts are merged into the
+feeds of their friends when the feeds are read (fan-out on read).
+'''
+
+from sqlalchemy import event
+from sqlalchemy.sql import and_, bindparam, or_, select
+
+from dbmodels import Posts, Users, t_timelines
+import projections
+
+TIMELINE_KEY = (t_timelines.c.post_datetime, t_timelines.c.post_id)
+
+class HomeTimelines(object):
+    '''Home timelines of all users. `graph` is a function returning the
+    friends graph (see `socialgraph`), so that the graph is only built when
+    first needed.
+    '''
+
+    def __init__(self, graph, size=800, fanout_limit=1000, trim_every=50):
+        self.graph = graph
+        self.size = size
+        self.fanout_limit = fanout_limit
+        ## Timelines are trimmed back to `size` posts once `trim_every` posts
+        ## have been added to them, rather than after every post
+        self.trim_every = trim_every
+        self.added = {}
+
+    def is_popular(self, user_id):
+        '''Whether the posts of a user are merged into feeds on read
+        '''
+        return self.graph().degree(user_id) > self.fanout_limit
+
+    def followers(self, user_id):
+        '''Ids of the users whose timeline gets the posts of a user
+        '''
+        if self.is_popular(user_id):
+            return [user_id]
+        return [user_id]+list(self.graph().friends(user_id))
+
+    ### WRITES ###
+
+    def fan_out(self, connection, posts):
+        '''Add (post_id, user_id, post_datetime) posts to the timelines of
+        the followers of their authors
+        '''
+        rows = [{'user_id': follower,
+                 'post_id': post_id,
+                 'post_datetime': post_datetime}
+                for post_id, user_id, post_datetime in posts
+                for follower in self.followers(user_id)]
+        if not rows:
+            return
+        connection.execute(t_timelines.insert(), rows)
+        full = []
+        for row in rows:
+            count = self.added.get(row['user_id'], 0)+1
+            self.added[row['user_id']] = count
+            if count == self.trim_every:
+                full.append(row['user_id'])
+        if full:
+            self.trim(connection, full)
+
+    def trim(self, connection, user_ids):
+        '''Drop the posts of the given timelines that are not among their
+        `size` most recent ones
+        '''
+        table = t_timelines
+        inner = table.alias()
+        oldest = (select([inner.c.post_id])
+                  .where(inner.c.user_id == bindparam('owner'))
+                  .order_by(inner.c.post_datetime.desc(),
+                            inner.c.post_id.desc())
+                  .offset(self.size))
+        connection.execute(table.delete()
+                           .where(and_(table.c.user_id == bindparam('owner'),
+                                       table.c.post_id.in_(oldest))),
+                           [{'owner': user_id} for user_id in user_ids])
+        for user_id in user_ids:
+            self.added.pop(user_id, None)
+
+    def remove(self, connection, post_ids):
+        '''Remove posts from all the timelines
+        '''
+        connection.execute(t_timelines.delete()
+                           .where(t_timelines.c.post_id.in_(post_ids)))
+
+    def watch(self, session_factory):
+        '''Fan out the posts flushed by the sessions of `session_factory` (a
+        `sessionmaker` or `Session` class), in the same transaction
+        '''
+        def update_timelines(session, flush_context):
+            '''Add the new posts to the timelines and remove the deleted ones
+            '''
+            new = [(obj.post_id, obj.user_id, obj.post_datetime)
+                   for obj in session.new if isinstance(obj, Posts)]
+            deleted = [obj.post_id
+                       for obj in session.deleted if isinstance(obj, Posts)]
+            if new:
+                self.fan_out(session.connection(), new)
+            if deleted:
+                self.remove(session.connection(), deleted)
+
+        event.listen(session_factory, 'after_flush', update_timelines)
+
+    def rebuild(self, session):
+        '''Rebuild all the timelines from the posts table (e.g. after
+        friendships were removed, or to backfill existing posts)
+        '''
+        connection = session.connection()
+        connection.execute(t_timelines.delete())
+        for user_id, in session.query(Users.user_id):
+            authors = [user_id]+[friend
+                                 for friend in self.graph().friends(user_id)
+                                 if not self.is_popular(friend)]
+            posts = (select([Posts.post_id, Posts.post_datetime])
+                     .where(Posts.user_id.in_(authors))
+                     .order_by(Posts.post_datetime.desc(),
+                               Posts.post_id.desc())
+                     .limit(self.size))
+            rows = [{'user_id': user_id, 'post_id': post_id,
+                     'post_datetime': post_datetime}
+                    for post_id, post_datetime in connection.execute(posts)]
+            if rows:
+                connection.execute(t_timelines.insert(), rows)
+        self.added.clear()
+        session.commit()
+
+    ### READS ###
+
+    def read(self, session, user_id, limit=None, after=None):
+        '''Get the posts of the feed of a user, most recent first, `limit` at
+        a time, starting after the (post_datetime, post_id) key `after`
+        '''
+        timeline = projections.paginate(
+            select([t_timelines.c.post_id])
+            .where(t_timelines.c.user_id == user_id),
+            TIMELINE_KEY, limit=limit, after=after, descending=True)
+        criterion = Posts.post_id.in_(timeline)
+        popular = [friend for friend in self.graph().friends(user_id)
+                   if self.is_popular(friend)]
+        if popular:
+            pulled = projections.paginate(
+                select([Posts.post_id]).where(Posts.user_id.in_(popular)),
+                projections.POST_KEY, limit=limit, after=after,
+                descending=True)
+            criterion = or_(criterion, Posts.post_id.in_(pulled))
+        return projections.select_posts(session, limit=limit,
+                                        criteria=[criterion])
@@ -0,0 +1,184 @@
+'''
+.. module:: glob.trending
+
+Trending tags: number of posts per tag over a sliding window of time.
+
+The counters are kept in memory in time buckets (one minute by default),
+updated when posts are committed, so that the top tags over a window are
+summed from the buckets instead of reading every tagged post of the window.
+Buckets older than `horizon` are dropped. The buckets are filled with the
+posts of the last `horizon` when the database is opened (see `load`), then
+with the posts committed since: a window that starts before that or that is
+longer than `horizon` is counted by the database.
+'''
+
+import datetime
+import heapq
+import re
+
+from sqlalchemy import Integer, cast, func
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import select
+
+from changes import watch_changes
+from dbmodels import Posts, Tags, t_posts_tags
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+WINDOW_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+def parse_window(string):
+    '''Parse a window like '90m', '1h', '24h' or '7d' into a `timedelta`
+    '''
+    match = re.match(r'^(\d+)([mhd])$', string or '')
+    if not match or not int(match.group(1)):
+        raise ValueError('Invalid window: {}'.format(string))
+    return datetime.timedelta(**{WINDOW_UNITS[match.group(2)]:
+                                 int(match.group(1))})
+
+class TrendingTags(object):
+    '''Per-tag post counters, bucketed by post time
+    '''
+
+    def __init__(self, bucket_size=datetime.timedelta(minutes=1),
+                 horizon=datetime.timedelta(days=7)):
+        self.bucket_seconds = int(bucket_size.total_seconds())
+        self.horizon = horizon
+        ## bucket number -> {tag_name: number of posts}
+        self.buckets = {}
+        ## Posts after this time are in the buckets (moved back by `load`)
+        self.start = datetime.datetime.utcnow()
+
+    def load(self, session, now=None):
+        '''Fill the buckets with the posts of the last `horizon` before
+        `now`, counted by the database with one GROUP BY (bucket, tag name)
+        '''
+        now = now or datetime.datetime.utcnow()
+        since = now-self.horizon
+        ## Seconds since the epoch of the (naive UTC) post time, as `bucket`
+        bucket = (cast(func.strftime('%s', Posts.post_datetime), Integer)
+                  / self.bucket_seconds)
+        number_of_posts = func.count(t_posts_tags.c.post_id)
+        query = (select([bucket, Tags.tag_name, number_of_posts])
+                 .select_from(t_posts_tags
+                              .join(Tags.__table__,
+                                    Tags.tag_id == t_posts_tags.c.tag_id)
+                              .join(Posts.__table__,
+                                    Posts.post_id == t_posts_tags.c.post_id))
+                 .where(Posts.post_datetime > since)
+                 .group_by(bucket, Tags.tag_name))
+        self.buckets = {}
+        for number, tag_name, count in session.execute(query):
+            self.buckets.setdefault(number, {})[tag_name] = count
+        self.start = since
+
+    def bucket(self, when):
+        '''Number of the bucket of a (naive UTC) datetime
+        '''
+        return int((when - EPOCH).total_seconds()) // self.bucket_seconds
+
+    def add(self, when, tag_name, count=1):
+        '''Add `count` posts with a tag at a given time
+        '''
+        counts = self.buckets.setdefault(self.bucket(when), {})
+        counts[tag_name] = counts.get(tag_name, 0)+count
+        if not counts[tag_name]:
+            del counts[tag_name]
+
+    def prune(self, now):
+        '''Drop the buckets older than `horizon`
+        '''
+        oldest = self.bucket(now-self.horizon)
+        for number in [number for number in self.buckets if number < oldest]:
+            del self.buckets[number]
+
+    def covers(self, since):
+        '''Whether the buckets hold all the posts after `since`
+        '''
+        return since >= self.start
+
+    ### QUERIES ###
+
+    def top(self, session, window, n_tags=5, now=None):
+        '''Get the `n_tags` tags with the most posts in the `window` (a
+        `timedelta`) before `now`, most posts first, as (tag_name, number of
+        posts) pairs
+        '''
+        now = now or datetime.datetime.utcnow()
+        since = now-window
+        if window > self.horizon or not self.covers(since):
+            return self.count(session, since, n_tags)
+        self.prune(now)
+        first = self.bucket(since)
+        counts = {}
+        for number, bucket in self.buckets.iteritems():
+            if number < first:
+                continue
+            for tag_name, count in bucket.iteritems():
+                counts[tag_name] = counts.get(tag_name, 0)+count
+        return heapq.nsmallest(n_tags,
+                               ((tag_name, count)
+                                for tag_name, count in counts.iteritems()
+                                if count > 0),
+                               key=lambda tag: (-tag[1], tag[0]))
+
+    def count(self, session, since, n_tags=5):
+        '''Same as `top`, counted by the database with a GROUP BY
+        '''
+        number_of_posts = func.count(t_posts_tags.c.post_id)
+        query = (select([Tags.tag_name, number_of_posts])
+                 .select_from(t_posts_tags
+                              .join(Tags.__table__,
+                                    Tags.tag_id == t_posts_tags.c.tag_id)
+                              .join(Posts.__table__,
+                                    Posts.post_id == t_posts_tags.c.post_id))
+                 .where(Posts.post_datetime > since)
+                 .group_by(Tags.tag_name)
+                 .order_by(number_of_posts.desc(), Tags.tag_name)
+                 .limit(n_tags))
+        return [(tag_name, count)
+                for tag_name, count in session.execute(query)]
+
+    ### UPDATES ###
+
+    def watch(self, session_factory):
+        '''Keep the counters up to date with the posts committed by the
+        sessions of `session_factory` (a `sessionmaker` or `Session` class)
+        '''
+        def collect(session, changes):
+            '''Record the (post time, tag name, +1/-1) changes of a flush
+            '''
+            for obj in session.new:
+                if isinstance(obj, Posts):
+                    changes.extend((obj.post_datetime, tag.tag_name, 1)
+                                   for tag in obj.tags)
+            for obj in session.dirty:
+                if isinstance(obj, Posts):
+                    history = get_history(obj, 'tags')
+                    changes.extend((obj.post_datetime, tag.tag_name, 1)
+                                   for tag in history.added)
+                    changes.extend((obj.post_datetime, tag.tag_name, -1)
+                                   for tag in history.deleted)
+                elif isinstance(obj, Tags):
+                    history = get_history(obj, 'posts')
+                    changes.extend((post.post_datetime, obj.tag_name, 1)
+                                   for post in history.added)
+                    changes.extend((post.post_datetime, obj.tag_name, -1)
+                                   for post in history.deleted)
+            for obj in session.deleted:
+                if isinstance(obj, Posts):
+                    changes.extend((obj.post_datetime, tag.tag_name, -1)
+                                   for tag in obj.tags)
+                elif isinstance(obj, Tags):
+                    changes.extend((post.post_datetime, obj.tag_name, -1)
+                                   for post in obj.posts)
+
+        def apply_changes(changes):
+            '''Apply the changes of a committed transaction
+            '''
+            for when, tag_name, count in changes:
+                if when is not None and self.covers(when):
+                    self.add(when, tag_name, count)
+
+        watch_changes(session_factory, ('trending', id(self)), collect,
+                      apply_changes, flush_event='before_flush')
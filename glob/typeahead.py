@@ -0,0 +1,215 @@
+'''
+.. module:: glob.typeahead
+
+In-memory prefix index over the tag names, item names and category paths,
+for autocompletion.
+
+Every name is indexed under each of its word suffixes ('hotel california'
+and 'california' for 'Hotel California'), normalized as in `duplicates`,
+in a sorted list: the names starting with a prefix are a contiguous slice of
+the list, found by bisection. The matches are ranked by popularity: number
+of posts of a tag, number of ratings of an item, number of items of a
+category. The index is filled on first use and kept up to date with the
+committed changes, which are read (in one batch per kind) on the next
+lookup.
+'''
+
+from bisect import bisect_left, insort
+import heapq
+
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import func, select
+
+from changes import watch_changes
+from dbmodels import Categories, Items, Tags
+from duplicates import normalize_name
+
+## Rankings of the prefixes up to this length are cached, as they match the
+## most names
+CACHED_PREFIX_LENGTH = 2
+
+def item_counts():
+    '''Correlated subquery counting the items of a category
+    '''
+    return (select([func.count(Items.item_id)])
+            .where(Items.category_id == Categories.category_id)
+            .as_scalar())
+
+## Indexed objects: kind -> (class, id column, name column, popularity)
+KINDS = {'tag': (Tags, Tags.tag_id, Tags.tag_name, Tags.post_count),
+         'item': (Items, Items.item_id, Items.item_name, Items.rating_count),
+         'category': (Categories, Categories.category_id, Categories.path,
+                      item_counts())}
+
+def word_keys(name):
+    '''Keys of a name: its normalized word suffixes
+    '''
+    words = normalize_name(name).split()
+    return [u' '.join(words[i:]) for i in range(len(words))]
+
+def rank(entry):
+    '''Ordering key of a match: most popular first, then by name
+    '''
+    obj_id, name, score = entry
+    return -score, name.lower(), obj_id
+
+class PrefixIndex(object):
+    '''Sorted (key, id) pairs of the names of one kind of objects
+    '''
+
+    def __init__(self):
+        self.keys = []
+        ## id -> (name, popularity)
+        self.names = {}
+        self.cache = {}
+
+    def set(self, obj_id, name, score):
+        '''Index (or re-index) a name
+        '''
+        if self.names.get(obj_id, (None,))[0] != name:
+            self.remove(obj_id)
+            for key in word_keys(name):
+                insort(self.keys, (key, obj_id))
+        self.names[obj_id] = (name, score or 0)
+        self.cache.clear()
+
+    def remove(self, obj_id):
+        '''Remove a name from the index
+        '''
+        if obj_id not in self.names:
+            return
+        name, _ = self.names.pop(obj_id)
+        for key in word_keys(name):
+            index = bisect_left(self.keys, (key, obj_id))
+            if index < len(self.keys) and self.keys[index] == (key, obj_id):
+                del self.keys[index]
+        self.cache.clear()
+
+    def lookup(self, prefix, limit):
+        '''The `limit` most popular (id, name, popularity) entries with a
+        word starting with the normalized `prefix`
+        '''
+        cached = len(prefix) <= CACHED_PREFIX_LENGTH
+        if cached and (prefix, limit) in self.cache:
+            return self.cache[prefix, limit]
+        start = bisect_left(self.keys, (prefix,))
+        stop = bisect_left(self.keys, (prefix+u'\uffff',))
+        ids = set(obj_id for _, obj_id in self.keys[start:stop])
+        entries = heapq.nsmallest(limit, ((obj_id,)+self.names[obj_id]
+                                          for obj_id in ids), key=rank)
+        if cached:
+            self.cache[prefix, limit] = entries
+        return entries
+
+class Typeahead(object):
+    '''Prefix index of every kind, filled on first use and kept up to date
+    with the committed changes
+    '''
+
+    def __init__(self):
+        self.indexes = dict((kind, PrefixIndex()) for kind in KINDS)
+        self.loaded = False
+        ## Ids of the objects of each kind committed (created, modified or
+        ## deleted) since the last lookup
+        self.pending = dict((kind, set()) for kind in KINDS)
+
+    def read(self, session, kind, ids=None):
+        '''Index the objects of a kind (all of them, or those of `ids`,
+        removing the ones that do not exist anymore)
+        '''
+        _, id_column, name_column, popularity = KINDS[kind]
+        query = select([id_column, name_column, popularity])
+        if ids is not None:
+            query = query.where(id_column.in_(sorted(ids)))
+            ids = set(ids)
+        index = self.indexes[kind]
+        for obj_id, name, score in session.execute(query):
+            if name:
+                index.set(obj_id, name, score)
+            else:
+                index.remove(obj_id)
+            if ids is not None:
+                ids.discard(obj_id)
+        for obj_id in ids or ():
+            index.remove(obj_id)
+
+    def load(self, session):
+        '''Build the index from the database
+        '''
+        self.indexes = dict((kind, PrefixIndex()) for kind in KINDS)
+        for kind in KINDS:
+            self.read(session, kind)
+            self.pending[kind].clear()
+        self.loaded = True
+
+    def refresh(self, session):
+        '''Read the objects committed since the last lookup into the index
+        '''
+        if not self.loaded:
+            self.load(session)
+            return
+        for kind, pending in self.pending.iteritems():
+            if pending:
+                self.pending[kind] = set()
+                self.read(session, kind, pending)
+
+    def invalidate(self, kind, ids):
+        '''Read these objects again on the next lookup (for changes made
+        without the ORM)
+        '''
+        self.pending[kind].update(ids)
+
+    def complete(self, session, string, kind=None, limit=10):
+        '''The `limit` most popular tags, items and categories (or only those
+        of `kind`) with a word starting with `string`, with their `kind`,
+        id, `name` and popularity `score`
+        '''
+        if kind is not None and kind not in KINDS:
+            raise ValueError('Invalid kind')
+        prefix = normalize_name(string)
+        if not prefix:
+            return []
+        self.refresh(session)
+        kinds = [kind] if kind is not None else sorted(KINDS)
+        matches = heapq.nsmallest(
+            limit, ((kind_,)+entry for kind_ in kinds
+                    for entry in self.indexes[kind_].lookup(prefix, limit)),
+            key=lambda match: rank(match[1:]))
+        return [{'kind': kind_, kind_+'_id': obj_id, 'name': name,
+                 'score': score}
+                for kind_, obj_id, name, score in matches]
+
+    def watch(self, session_factory):
+        '''Keep the index up to date with the tags, items and categories
+        committed by the sessions of `session_factory` (a `sessionmaker` or
+        `Session` class)
+        '''
+        classes = dict((cls, kind) for kind, (cls, _, _, _)
+                       in KINDS.iteritems())
+
+        def collect(session, changes):
+            '''Record the objects of a flush, by kind
+            '''
+            for obj in session.new.union(session.dirty).union(
+                    session.deleted):
+                kind = classes.get(type(obj))
+                if kind is None:
+                    continue
+                changes[kind].add(getattr(obj, kind+'_id'))
+                if kind == 'item':
+                    ## The item counts of the categories
+                    history = get_history(obj, 'category_id')
+                    changes['category'].update(
+                        category_id for category_id
+                        in history.sum() + [obj.category_id]
+                        if category_id is not None)
+
+        def apply_changes(changes):
+            '''Apply the changes of a committed transaction
+            '''
+            for kind, ids in changes.iteritems():
+                self.pending[kind] |= ids
+
+        watch_changes(session_factory, ('typeahead', id(self)), collect,
+                      apply_changes,
+                      empty=lambda: dict((kind, set()) for kind in KINDS))
@@ -8,7 +8,9 @@ import datetime
 import os
 import random
 import requests
+import shutil
 import sys
+import tempfile
 import unittest
 
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
@@ -172,7 +174,13 @@ DIC_USER_3 = {'user_id': 3,
               'account_creation_date': u'2017-09-19',
               'posts': [DIC_POST_4_FULL],
               'comments': [],
-              'likes': [DIC_POST_1_ID, DIC_POST_3_ID]}
+              'likes': [DIC_POST_1_ID, DIC_POST_3_ID],
+              'friends': [{'user_id': 1,
+                           'status': 'active',
+                           'account_creation_date': u'2017-09-19'},
+                          {'user_id': 2,
+                           'status': 'active',
+                           'account_creation_date': u'2017-09-19'}]}
 
 def find_dic_diff(dic1, dic2):
     keys = set(dic1.keys()+dic2.keys())
@@ -222,6 +230,20 @@ class TestGet(unittest.TestCase):
                                     {u'uri': url+'3/',
                                      u'category_name': u'Place\\Business\\Hotel'}])
 
+    def test_get_category_items(self):
+        url = ROOT+u'categories/8/items/'
+        res = requests.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {u'items': []})
+        res = requests.get(url, params={'recursive': 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {u'items': [DIC_ITEM_3]})
+
+    def test_get_nonexisting_category_items(self):
+        url = ROOT+u'categories/3743/items/'
+        res = requests.get(url)
+        self.assertEqual(res.status_code, 404)
+
     def test_get_tag(self):
         url = ROOT+u'tags/1/'
         res = requests.get(url)
@@ -242,12 +264,59 @@ class TestGet(unittest.TestCase):
         tags = res.json()['tags']
         self.assertEqual(tags[:3], [DIC_TAG_2, DIC_TAG_3, DIC_TAG_1])
 
+    def test_get_nearby_items(self):
+        url = ROOT+u'items/nearby/'
+        res = requests.get(url, params={'lat': 37.8, 'lon': -122.3,
+                                        'radius': 20})
+        self.assertEqual(res.status_code, 200)
+        item = res.json()['items'][0]
+        self.assertEqual(item['uri'], ROOT+u'items/1/')
+        self.assertAlmostEqual(item['distance'], 10.86, places=2)
+        res = requests.get(url, params={'lat': 1, 'lon': 5, 'limit': 1,
+                                        'category': 8})
+        self.assertEqual(res.json()['items'][0]['uri'], ROOT+u'items/3/')
+        for params in ({'lat': 1}, {'lat': 'a', 'lon': 1},
+                       {'lat': 1, 'lon': 1, 'radius': 0}):
+            res = requests.get(url, params=params)
+            self.assertEqual(res.status_code, 400)
+        res = requests.get(url, params={'lat': 1, 'lon': 5,
+                                        'category': 3743})
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_map_clusters(self):
+        url = ROOT+u'map/clusters/'
+        params = {'zoom': 16, 'bbox': '-122.5,37,-122,38'}
+        res = requests.get(url, params=params)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['clusters'][0]['cell'],
+                         [16, 20964, 19014])
+        self.assertIn('max-age', res.headers['Cache-Control'])
+        res = requests.get(url, params=params,
+                           headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        res = requests.get(url, params={'zoom': 1})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_trending_tags(self):
+        url = ROOT+u'tags/trending/'
+        res = requests.get(url, params={'window': '36500d', 'n': 2})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['tags'],
+                         [{'tag_name': u'awesome', 'number_of_posts': 5},
+                          {'tag_name': u'bof', 'number_of_posts': 4}])
+        res = requests.get(url, params={'window': '1h'})
+        self.assertEqual(res.status_code, 200)
+        for params in ({'window': '1w'}, {'n': 0}, {'n': 'a'}):
+            res = requests.get(url, params=params)
+            self.assertEqual(res.status_code, 400)
+
     def test_get_item(self):
         url = ROOT+u'items/3/'
         res = requests.get(url)
         self.assertEqual(res.status_code, 200)
         shouldbe = {"item": DIC_ITEM_3.copy()}
         shouldbe['item']['posts'] = []
+        shouldbe['item']['rating_histogram'] = [0, 0, 0, 0, 0]
         self.assertEqual(res.json(), shouldbe)
 
     def test_get_nonexisting_item(self):
@@ -262,6 +331,68 @@ class TestGet(unittest.TestCase):
         shouldbe = [DIC_ITEM_3, DIC_ITEM_4, DIC_ITEM_2]
         self.assertEqual(res.json()['items'][:3], shouldbe)
 
+    def test_get_posts_pages(self):
+        url = ROOT+u'posts/'
+        posts = requests.get(url).json()['posts']
+        res = requests.get(url, params={'limit': 4})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['posts'], posts[:4])
+        res = requests.get(url, params={'limit': 4,
+                                        'cursor': res.json()['next_cursor']})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['posts'], posts[4:8])
+
+    def test_get_posts_invalid_page(self):
+        url = ROOT+u'posts/'
+        for params in ({'limit': 0}, {'limit': 'a'}, {'cursor': 'notacursor'}):
+            res = requests.get(url, params=params)
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_posts_stream(self):
+        url = ROOT+u'posts/'
+        res = requests.get(url, params={'stream': 1}, stream=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Length', res.headers)
+        posts = requests.get(url, params={'limit': 1000}).json()
+        self.assertEqual(res.json(), posts)
+
+    def test_get_stream_ignores_limit(self):
+        for kind in ('posts', 'items'):
+            url = ROOT+kind+u'/'
+            res = requests.get(url, params={'stream': 1, 'limit': 5000})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json(),
+                             requests.get(url, params={'stream': 1}).json())
+
+    def test_get_posts_fields(self):
+        url = ROOT+u'posts/'
+        res = requests.get(url, params={'fields': 'post_id,rating',
+                                        'limit': 4})
+        self.assertEqual(res.status_code, 200)
+        posts = requests.get(url).json()['posts']
+        self.assertEqual(res.json()['posts'],
+                         [{'uri': post['uri'], 'rating': post['rating']}
+                          for post in posts[:4]])
+        res = requests.get(url, params={'fields': 'rating', 'limit': 4,
+                                        'cursor': res.json()['next_cursor']})
+        self.assertEqual(res.json()['posts'],
+                         [{'rating': post['rating']} for post in posts[4:8]])
+
+    def test_get_post_expand(self):
+        url = ROOT+u'posts/1/'
+        res = requests.get(url, params={'expand': 'tags'})
+        self.assertEqual(res.status_code, 200)
+        shouldbe = DIC_POST_1.copy()
+        del shouldbe['item'], shouldbe['photos']
+        self.assertEqual(res.json(), {'post': shouldbe})
+
+    def test_get_posts_invalid_fields(self):
+        url = ROOT+u'posts/'
+        for params in ({'fields': 'password'}, {'expand': 'user'},
+                       {'expand': 'user', 'stream': 1}):
+            res = requests.get(url, params=params)
+            self.assertEqual(res.status_code, 400)
+
     def test_get_post(self):
         url = ROOT+u'posts/1/'
         res = requests.get(url)
@@ -282,6 +413,16 @@ class TestGet(unittest.TestCase):
                               DIC_POST_2, DIC_POST_1]}
         self.assertEqual(res.json()['posts'][-6:], shouldbe['posts'])
 
+    def test_get_recent_posts(self):
+        url = ROOT+u'posts/recent/'
+        res = requests.get(url, params={'n': 3})
+        self.assertEqual(res.status_code, 200)
+        posts = requests.get(ROOT+u'posts/', params={'limit': 3}).json()
+        self.assertEqual(res.json()['posts'], posts['posts'])
+        for n_posts in (0, 3743, 'a'):
+            res = requests.get(url, params={'n': n_posts})
+            self.assertEqual(res.status_code, 400)
+
     def test_get_user(self):
         url = ROOT+u'users/3/'
         res = requests.get(url)
@@ -289,6 +430,76 @@ class TestGet(unittest.TestCase):
         shouldbe = {"user": DIC_USER_3}
         self.assertEqual(res.json(), shouldbe)
 
+    def test_get_user_friends(self):
+        url = ROOT+u'users/3/friends/'
+        res = requests.get(url, params={'limit': 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['friends'],
+                         [{'uri': ROOT+u'users/1/',
+                           'status': 'active',
+                           'account_creation_date': u'2017-09-19'}])
+        res = requests.get(url, params={'limit': 1,
+                                        'cursor': res.json()['next_cursor']})
+        self.assertEqual([friend['uri'] for friend in res.json()['friends']],
+                         [ROOT+u'users/2/'])
+
+    def test_get_user_feed(self):
+        url = ROOT+u'users/2/feed/'
+        res = requests.get(url, params={'limit': 2})
+        self.assertEqual(res.status_code, 200)
+        posts = res.json()['posts']
+        res = requests.get(url, params={'limit': 2,
+                                        'cursor': res.json()['next_cursor']})
+        self.assertEqual(res.status_code, 200)
+        feed = requests.get(url, params={'limit': 1000}).json()['posts']
+        self.assertEqual(posts+res.json()['posts'], feed[:4])
+        ## The posts of 2 and of their friend 3
+        shouldbe = [DIC_POST_6, DIC_POST_5, DIC_POST_4, DIC_POST_3]
+        self.assertEqual([post for post in feed if post in shouldbe],
+                         shouldbe)
+        res = requests.get(ROOT+u'users/3743/feed/')
+        self.assertEqual(res.status_code, 404)
+
+    def test_search(self):
+        url = ROOT+u'search/'
+        res = requests.get(url, params={'q': 'stuff', 'limit': 1})
+        self.assertEqual(res.status_code, 200)
+        page = res.json()
+        self.assertEqual(page['results'][0]['kind'], 'item')
+        res = requests.get(url, params={'q': 'stuff', 'limit': 1,
+                                        'cursor': page['next_cursor']})
+        self.assertEqual(set([page['results'][0]['uri'],
+                              res.json()['results'][0]['uri']]),
+                         set([ROOT+u'items/3/', ROOT+u'items/4/']))
+        res = requests.get(url)
+        self.assertEqual(res.status_code, 400)
+
+    def test_autocomplete(self):
+        url = ROOT+u'autocomplete/'
+        res = requests.get(url, params={'q': 'awe', 'kind': 'tag'})
+        self.assertEqual(res.status_code, 200)
+        suggestion = res.json()['suggestions'][0]
+        self.assertEqual(suggestion['name'], 'awesome')
+        self.assertEqual(suggestion['uri'], ROOT+u'tags/2/')
+        res = requests.get(url, params={'q': 'awe', 'kind': 'user'})
+        self.assertEqual(res.status_code, 400)
+        for limit in (-1, 0, 'a', 5000):
+            res = requests.get(url, params={'q': 'awe', 'limit': limit})
+            self.assertEqual(res.status_code, 400)
+        res = requests.get(url, params={'q': 'a', 'limit': 1})
+        self.assertEqual(len(res.json()['suggestions']), 1)
+
+    def test_get_user_suggestions(self):
+        res = requests.get(ROOT+u'users/1/suggestions/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'suggestions': []})
+        res = requests.get(ROOT+u'users/3743/suggestions/')
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_nonexisting_user_friends(self):
+        res = requests.get(ROOT+u'users/3743/friends/')
+        self.assertEqual(res.status_code, 404)
+
     def test_get_nonexisting_user(self):
         url = ROOT+u'users/3743/'
         res = requests.get(url)
@@ -550,6 +761,26 @@ class TestPost(unittest.TestCase):
         res = requests.post(url, json=data)
         self.assertEqual(res.status_code, 201)
 
+    def test_post_item_duplicate(self):
+        url = ROOT+u'items/'
+        data = {'item': {'item_name': 'Test API Duplicate '+DATE,
+                         'category': {'category_id': 5},
+                         'location': {'location_id': 1},
+                         'check_duplicates': True}}
+        res = requests.post(url, json=data)
+        self.assertEqual(res.status_code, 201)
+        obj_id = res.json()['item']['item_id']
+
+        data['item']['item_name'] = ' test api  duplicate '+DATE
+        res = requests.post(url, json=data)
+        self.assertEqual(res.status_code, 409)
+        self.assertIn(str(obj_id), [item['uri'].rstrip('/').split('/')[-1]
+                                    for item in res.json()['items']])
+
+        del data['item']['check_duplicates']
+        res = requests.post(url, json=data)
+        self.assertEqual(res.status_code, 201)
+
     def test_post_item_category_name(self):
         url = ROOT+u'items/'
         data = {'item': {'item_name': 'Test API Item '+DATE,
@@ -604,6 +835,26 @@ class TestPost(unittest.TestCase):
         res = requests.post(url, json=data)
         self.assertEqual(res.status_code, 201)
 
+    def test_post_posts_batch(self):
+        url = ROOT+u'posts/batch/'
+        data = {'posts': [{'item_id': 1, 'user_id': 1, 'review': 'Test'},
+                          {'item_id': -1, 'user_id': 1, 'review': 'Test'}]}
+        res = requests.post(url, json=data)
+        self.assertEqual(res.status_code, 207)
+        results = res.json()['results']
+        self.assertIn(ROOT+u'posts/', results[0]['uri'])
+        self.assertIn('error', results[1])
+        res = requests.get(results[0]['uri'])
+        self.assertEqual(res.status_code, 200)
+        res = requests.post(url, json={'posts': {}})
+        self.assertEqual(res.status_code, 400)
+
+    def test_post_tags_batch(self):
+        url = ROOT+u'tags/batch/'
+        data = {'tags': [{'tag_name': 'Test API batch '+DATE}]}
+        res = requests.post(url, json=data)
+        self.assertEqual(res.status_code, 201)
+
     def test_post_post_1(self):
         url = ROOT+u'posts/'
         post = dict(item={'item_id': 1}, user_id=1, review="Test")
@@ -756,5 +1007,84 @@ class TestDelete(unittest.TestCase):
         res = requests.delete(url)
         self.assertEqual(res.status_code, 400)
 
+def import_api():
+    '''Import the api module from the glob directory, where it opens its
+    database
+    '''
+    cwd = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'glob'))
+    try:
+        import api
+    finally:
+        os.chdir(cwd)
+    return api
+
+class TestMakePublic(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.api = import_api()
+
+    def test_uri_templates(self):
+        with self.api.APP.test_request_context('/'):
+            for endpoint in ('get_post', 'get_item', 'get_tag',
+                             'get_category', 'get_location', 'get_user'):
+                self.assertEqual(self.api.get_uri(endpoint, 12),
+                                 self.api.url_for(endpoint, obj_id=12,
+                                                  _external=True))
+
+    def test_nested_resources(self):
+        post = {'post_id': 1,
+                'rating': 4,
+                'item': {'item_id': 2,
+                         'item_name': u'Some trail',
+                         'location': {'location_id': 3, 'lat': 37.7749}},
+                'tags': [{'tag_id': 4, 'tag_name': u'cool'},
+                         {'tag_id': 5, 'tag_name': u'awesome'}],
+                'photos': []}
+        root = 'http://localhost/api/v1.0/'
+        with self.api.APP.test_request_context('/'):
+            self.assertEqual(self.api.make_public(post),
+                             {'uri': root+'posts/1/',
+                              'rating': 4,
+                              'item': {'uri': root+'items/2/',
+                                       'item_name': u'Some trail',
+                                       'location': {'uri': root+'locations/3/',
+                                                    'lat': 37.7749}},
+                              'tags': [{'uri': root+'tags/4/',
+                                        'tag_name': u'cool'},
+                                       {'uri': root+'tags/5/',
+                                        'tag_name': u'awesome'}],
+                              'photos': []})
+
+    def test_missing_id(self):
+        item = {'item_name': u'Hotel California', 'location': {},
+                'tags': [u'cool']}
+        with self.api.APP.test_request_context('/'):
+            self.assertEqual(self.api.make_public(item), item)
+            self.assertEqual(self.api.make_public(u'cool'), u'cool')
+
+class TestEmptyCollections(unittest.TestCase):
+
+    def setUp(self):
+        self.api = import_api()
+        self.directory = tempfile.mkdtemp()
+        self.database = self.api.DATABASE
+        self.api.DATABASE = self.api.queries.DataBase(path=self.directory)
+        self.client = self.api.APP.test_client()
+
+    def tearDown(self):
+        self.api.DATABASE.session.close()
+        self.api.DATABASE = self.database
+        shutil.rmtree(self.directory)
+
+    def test_get_empty_collections(self):
+        for kind in ('posts', 'items', 'tags', 'categories'):
+            url = '/api/v1.0/'+kind+'/'
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(self.client.get(url+'?stream=1').status_code,
+                             404)
+
 if __name__ == '__main__':
     unittest.main()
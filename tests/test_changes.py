@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.changes
+'''
+import os
+import sys
+import unittest
+
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from changes import watch_changes
+
+Base = declarative_base()
+
+class Thing(Base):
+    __tablename__ = 'things'
+    thing_id = Column(Integer, primary_key=True)
+
+class TestWatchChanges(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.applied = []
+        def collect(session, changes):
+            changes.extend(obj.thing_id for obj in session.new)
+        watch_changes(self.session, 'things', collect, self.applied.append)
+
+    def test_commit(self):
+        self.session.add(Thing(thing_id=1))
+        self.session.flush()
+        self.session.add(Thing(thing_id=2))
+        self.assertEqual(self.applied, [])
+        self.session.commit()
+        self.assertEqual(self.applied, [[1, 2]])
+        self.assertNotIn('things', self.session.info)
+
+    def test_rollback(self):
+        self.session.add(Thing(thing_id=1))
+        self.session.flush()
+        self.session.rollback()
+        self.assertNotIn('things', self.session.info)
+        self.session.commit()
+        self.assertEqual(self.applied, [])
+
+    def test_commit_without_changes(self):
+        self.session.commit()
+        self.assertEqual(self.applied, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.duplicates
+'''
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from duplicates import (cell, find_duplicates, neighbours, normalize_name,
+                        similarity)
+
+class TestDuplicates(unittest.TestCase):
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name(u'  Hotel   California '),
+                         u'hotel california')
+        self.assertEqual(normalize_name(u'Caf\xe9 de Flore!'),
+                         u'cafe de flore')
+        self.assertEqual(normalize_name(None), u'')
+
+    def test_similarity(self):
+        self.assertEqual(similarity(u'Hotel California',
+                                    u'Hotel california '), 1.)
+        self.assertGreater(similarity(u'Hotel California',
+                                      u'Hotel Californa'), 0.7)
+        self.assertLess(similarity(u'Hotel California',
+                                   u'Hotel Carolina'), 0.5)
+
+    def test_cells(self):
+        self.assertEqual(cell(None, None), None)
+        self.assertEqual(neighbours(None), [None])
+        self.assertEqual(len(neighbours(cell(37.7749, -122.4194))), 9)
+
+    def test_find_duplicates(self):
+        items = [(1, u'Hotel California', 3, None, None),
+                 (2, u'Hotel california ', 3, None, None),
+                 ## Other category
+                 (3, u'Hotel California', 4, None, None),
+                 ## Located
+                 (4, u'Some trail', 5, 37.7749, -122.4194),
+                 ## In the next cell
+                 (5, u'Some trails', 5, 37.7751, -122.4201),
+                 ## Too far
+                 (6, u'Some trail', 5, 40.7128, -74.0059),
+                 (7, u'Cool stuff', 5, 37.7749, -122.4194)]
+        pairs = find_duplicates(items, threshold=0.7)
+        self.assertEqual([pair[:2] for pair in pairs], [(1, 2), (4, 5)])
+        self.assertEqual(pairs[0][2], 1.)
+        self.assertEqual(find_duplicates(items, threshold=0.9), [pairs[0]])
+
+if __name__ == '__main__':
+    unittest.main()
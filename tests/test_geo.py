@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.geo
+'''
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from geo import bounding_boxes, check_point, distance
+
+SF = (37.7749, -122.4194)
+NYC = (40.7128, -74.0059)
+
+class TestGeo(unittest.TestCase):
+
+    def test_distance(self):
+        self.assertAlmostEqual(distance(*(SF+SF)), 0)
+        self.assertAlmostEqual(distance(*(SF+NYC)), 4129, delta=1)
+        self.assertAlmostEqual(distance(0, 179.5, 0, -179.5), 111.2,
+                               delta=0.1)
+
+    def test_bounding_boxes(self):
+        [(min_lat, max_lat, min_lon, max_lon)] = bounding_boxes(0, 0, 111.2)
+        self.assertAlmostEqual(min_lat, -1, places=2)
+        self.assertAlmostEqual(max_lon, 1, places=2)
+        ## Across the antimeridian
+        boxes = bounding_boxes(0, 179.5, 111.2)
+        self.assertEqual(len(boxes), 2)
+        self.assertAlmostEqual(boxes[1][3], -179.5, places=2)
+        ## Around a pole
+        self.assertEqual(bounding_boxes(89.5, 0, 111.2)[0][2:],
+                         (-180., 180.))
+
+    def test_check_point(self):
+        self.assertEqual(check_point('1.5', 2), (1.5, 2.))
+        with self.assertRaises(ValueError):
+            check_point(91, 0)
+        with self.assertRaises(ValueError):
+            check_point(0, 'a')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -213,19 +213,16 @@ DIC_POST_3_ALL = {'rating': 4,
                   'post_datetime': POST3.post_datetime.isoformat(),
                   'item': DIC_ITEM_1}
 
-DIC_USER_3_NOFRIENDS = {'user_id': 3,
-                        'status': 'active',
-                        'likes': [DIC_POST_1_ITEM, DIC_POST_3_ITEM],
-                        'comments': [],
-                        'posts': [],
-                        'account_creation_date': JACK.account_creation_date.isoformat()}
+DIC_USER_3_SUMMARY = {'user_id': 3,
+                      'status': 'active',
+                      'account_creation_date': JACK.account_creation_date.isoformat()}
 
 DIC_USER_2 = {'user_id': 2,
               'status': 'active',
               'likes': [],
               'comments': [DIC_COMMENT_2],
               'posts': [DIC_POST_3_ALL],
-              'friends': [DIC_USER_3_NOFRIENDS],
+              'friends': [DIC_USER_3_SUMMARY],
               'account_creation_date': JANE.account_creation_date.isoformat()}
 
 class TestUser(unittest.TestCase):
@@ -507,6 +504,25 @@ class TestDicts(unittest.TestCase):
         self.assertEqual(JANE.as_dict(friends=True), DIC_USER_2)
 
 
+class TestUpgrade(unittest.TestCase):
+
+    def test_upgrade_database(self):
+        old = create_engine('sqlite://')
+        Base.metadata.create_all(old)
+        ## Schema of a database created before the tag counters and the
+        ## timelines
+        old.execute('DROP INDEX ix_tags_post_count')
+        old.execute('ALTER TABLE tags DROP COLUMN post_count')
+        old.execute('DROP TABLE timelines')
+        self.assertEqual(upgrade_database(old),
+                         set(['tags.post_count', 'timelines']))
+        inspector = inspect(old)
+        self.assertIn('post_count', [column['name'] for column
+                                     in inspector.get_columns('tags')])
+        self.assertIn('ix_tags_post_count', [index['name'] for index
+                                             in inspector.get_indexes('tags')])
+        self.assertEqual(upgrade_database(old), set())
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.mapclusters
+'''
+import os
+import sys
+import unittest
+
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from dbmodels import Base
+from mapclusters import CLUSTER_TABLE, cell_ranges, install, parse_bbox
+
+class TestMapClusters(unittest.TestCase):
+
+    def test_parse_bbox(self):
+        self.assertEqual(parse_bbox('-122.5,37,-122,38.5'),
+                         (-122.5, 37., -122., 38.5))
+        for bbox in (None, '', '1,2,3', 'a,1,2,3', '0,10,1,5', '0,0,200,1'):
+            with self.assertRaises(ValueError):
+                parse_bbox(bbox)
+
+    def test_cell_ranges(self):
+        ## 2 columns and 1 row at zoom 0, cells of 45 degrees at zoom 2
+        self.assertEqual(cell_ranges(0, (-180, -90, 180, 90)), [(0, 1, 0, 0)])
+        self.assertEqual(cell_ranges(2, (-100, 10, -50, 50)), [(1, 2, 0, 1)])
+        ## Across the antimeridian
+        self.assertEqual(cell_ranges(2, (170, -10, -170, 10)),
+                         [(7, 7, 1, 2), (0, 0, 1, 2)])
+
+    def test_install(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        install(engine, max_zoom=2)
+        self.assertEqual(engine.execute('SELECT COUNT(*) FROM {0}'.format(
+            CLUSTER_TABLE)).scalar(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ import os
 import sys
 import unittest
 
+from sqlalchemy import event
+
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
 
 import queries
@@ -100,6 +102,39 @@ class TestGetCategory(unittest.TestCase):
         cat = db.get_category(1)
         self.assertEqual(cat, DIC_CAT_1)
 
+    def test_category_path(self):
+        cat = db.get_category(3, return_object=True)
+        self.assertEqual(cat.path, u'Place\\Business\\Hotel')
+        self.assertEqual(cat.depth, 2)
+
+    def test_create_category_path(self):
+        cat = db.create_category(category_name='Test path', parent_id=3,
+                                 return_object=True)
+        self.assertEqual(cat.path, u'Place\\Business\\Hotel\\Test path')
+        self.assertEqual(cat.depth, 3)
+        db.delete_category(cat.category_id)
+
+    def test_get_all_categories(self):
+        cats = [cat['category_name'] for cat in db.get_all_categories()]
+        self.assertEqual(cats, sorted(cats))
+
+    def test_get_category_items(self):
+        self.assertEqual(db.get_category_items(1), [])
+        self.assertIsNone(db.get_category_items(3743))
+
+    def test_get_category_items_recursive(self):
+        items = [item['item_name']
+                 for item in db.get_category_items(1, recursive=True)
+                 if 'test' not in item['item_name'].lower()]
+        self.assertEqual(items, [u'Cool stuff', u'Hotel California'])
+
+    def test_get_category_rollups(self):
+        self.assertEqual(db.get_category_rollups(8),
+                         [{'category_id': 8,
+                           'category_name': u'Animals',
+                           'number_of_items': 1,
+                           'rating': None}])
+
 class TestGetPhoto(unittest.TestCase):
 
     def test_get_photo(self):
@@ -113,6 +148,333 @@ class TestGetPost(unittest.TestCase):
         shouldbe = [DIC_POST_6, DIC_POST_5, DIC_POST_4]
         self.assertEqual(posts, shouldbe)
 
+class TestLoadingProfiles(unittest.TestCase):
+
+    def count_statements(self, func, *args):
+        statements = []
+        def before_execute(*args):
+            statements.append(args)
+        db.session.expire_all()
+        event.listen(db.engine, 'before_cursor_execute', before_execute)
+        try:
+            func(*args)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_execute)
+        return len(statements)
+
+    def test_get_all_posts(self):
+        self.assertLessEqual(self.count_statements(db.get_all_posts), 5)
+
+    def test_get_recent_posts(self):
+        self.assertLessEqual(self.count_statements(db.get_recent_posts, 300),
+                             5)
+
+    def test_get_all_items(self):
+        self.assertLessEqual(self.count_statements(db.get_all_items), 2)
+
+    def test_get_user(self):
+        self.assertLessEqual(self.count_statements(db.get_user, 3), 14)
+
+    def test_get_all_posts_without_relationships(self):
+        self.assertEqual(self.count_statements(
+            lambda: db.get_all_posts(expand=[])), 1)
+
+    def test_get_friends(self):
+        self.assertEqual(self.count_statements(db.get_friends, 3), 2)
+
+class TestFriends(unittest.TestCase):
+
+    def test_get_friends(self):
+        self.assertEqual([friend['user_id'] for friend in db.get_friends(3)],
+                         [1, 2])
+        self.assertEqual(db.get_friends(1),
+                         [{'user_id': 3,
+                           'status': 'active',
+                           'account_creation_date': '2017-09-19'}])
+
+    def test_get_friends_pages(self):
+        page = db.get_friends(3, limit=1)
+        self.assertEqual([friend['user_id'] for friend in page], [1])
+        page = db.get_friends(3, limit=1,
+                              cursor=queries.next_cursor('friends', page, 1))
+        self.assertEqual([friend['user_id'] for friend in page], [2])
+
+    def test_get_friends_nonexisting_user(self):
+        self.assertIsNone(db.get_friends(3743))
+
+    def test_get_user_friends(self):
+        user = db.get_user(3)
+        self.assertEqual(user['friends'], db.get_friends(3))
+        self.assertNotIn('friends_next_cursor', user)
+
+class TestSocialGraph(unittest.TestCase):
+
+    def test_get_degree_of_separation(self):
+        self.assertEqual(db.get_degree_of_separation(1, 3), 1)
+        self.assertEqual(db.get_degree_of_separation(1, 2), 2)
+        self.assertIsNone(db.get_degree_of_separation(1, 4))
+
+    def test_get_network_posts(self):
+        posts = db.get_network_posts(1)
+        self.assertEqual([post['post_id'] for post in posts], [6, 5, 4, 3])
+        posts = db.get_network_posts(1, depth=1)
+        self.assertEqual([post['post_id'] for post in posts], [4])
+        self.assertIsNone(db.get_network_posts(3743))
+
+    def test_incremental_update(self):
+        graph = db.friends_graph
+        relationship = queries.UserRelationships(
+            first_user_id=4, second_user_id=1,
+            type_id=db.USER_RELATIONSHIP_FRIENDS.relationship_id)
+        db.session.add(relationship)
+        db.session.flush()
+        self.assertFalse(graph.are_linked(1, 4))
+        db.session.commit()
+        try:
+            self.assertTrue(graph.are_linked(1, 4))
+            self.assertEqual(db.get_degree_of_separation(4, 2), 3)
+        finally:
+            db.session.delete(relationship)
+            db.session.commit()
+        self.assertFalse(graph.are_linked(1, 4))
+
+    def test_get_friend_suggestions(self):
+        ## 1 and 2 are both friends with 3, but 1 sent a friend request to 2
+        self.assertEqual(db.get_friend_suggestions(1), [])
+        self.assertIsNone(db.get_friend_suggestions(3743))
+        relationship = queries.UserRelationships(
+            first_user_id=3, second_user_id=4,
+            type_id=db.USER_RELATIONSHIP_FRIENDS.relationship_id)
+        db.session.add(relationship)
+        db.session.commit()
+        try:
+            self.assertEqual(db.get_friend_suggestions(4),
+                             [{'user_id': 1, 'common_friends': 1},
+                              {'user_id': 2, 'common_friends': 1}])
+            self.assertEqual(db.get_friend_suggestions(4, limit=1),
+                             [{'user_id': 1, 'common_friends': 1}])
+            self.assertEqual(db.get_friend_suggestions(1),
+                             [{'user_id': 4, 'common_friends': 1}])
+        finally:
+            db.session.delete(relationship)
+            db.session.commit()
+        self.assertEqual(db.get_friend_suggestions(1), [])
+
+class TestTimelines(unittest.TestCase):
+
+    def feed_ids(self, user_id, **kwargs):
+        return [post['post_id'] for post in db.get_feed(user_id, **kwargs)]
+
+    def posts_of(self, *user_ids):
+        return [post_id for post_id, in
+                db.session.query(queries.Posts.post_id)
+                          .filter(queries.Posts.user_id.in_(user_ids))
+                          .order_by(queries.Posts.post_datetime.desc(),
+                                    queries.Posts.post_id.desc())]
+
+    def test_get_feed(self):
+        self.assertEqual(self.feed_ids(1), self.posts_of(1, 3))
+        self.assertEqual(self.feed_ids(3), self.posts_of(1, 2, 3))
+        self.assertIsNone(db.get_feed(3743))
+
+    def test_get_feed_pages(self):
+        page = db.get_feed(3, limit=2)
+        posts = page
+        while len(page) == 2:
+            page = db.get_feed(3, limit=2, cursor=queries.next_cursor(
+                'posts', page, 2))
+            posts = posts+page
+        self.assertEqual(posts, db.get_feed(3))
+
+    def test_fan_out(self):
+        post = db.create_post(item_id=1, user_id=3, return_object=True)
+        try:
+            for user_id in (1, 2, 3):
+                self.assertEqual(self.feed_ids(user_id, limit=1),
+                                 [post.post_id])
+            self.assertNotIn(post.post_id, self.feed_ids(4))
+        finally:
+            db.delete_post(post.post_id)
+        self.assertNotIn(post.post_id, self.feed_ids(1))
+
+    def test_fan_out_on_read(self):
+        ## 3 has two friends: their posts are not fanned out anymore
+        db.timelines.fanout_limit = 1
+        post = db.create_post(item_id=1, user_id=3, return_object=True)
+        try:
+            self.assertEqual(
+                [user_id for user_id, in db.session.execute(
+                    queries.select([queries.t_timelines.c.user_id])
+                    .where(queries.t_timelines.c.post_id == post.post_id))],
+                [3])
+            self.assertEqual(self.feed_ids(1, limit=1), [post.post_id])
+        finally:
+            db.timelines.fanout_limit = queries.config.FANOUT_LIMIT
+            db.delete_post(post.post_id)
+
+    def test_trim(self):
+        db.timelines.size = 2
+        try:
+            db.timelines.trim(db.session.connection(), [3])
+            db.session.commit()
+            self.assertEqual(self.feed_ids(3), self.posts_of(1, 2, 3)[:2])
+        finally:
+            db.timelines.size = queries.config.TIMELINE_SIZE
+            db.rebuild_timelines()
+        self.assertEqual(self.feed_ids(3), self.posts_of(1, 2, 3))
+
+class TestRecentPosts(unittest.TestCase):
+
+    def test_get_recent_posts(self):
+        self.assertEqual(db.get_recent_posts(5),
+                         db.get_recent_posts(n_posts=300)[:5])
+
+    def test_no_statements(self):
+        db.get_recent_posts(5)
+        self.assertEqual(TestLoadingProfiles('run').count_statements(
+            db.get_recent_posts, 5), 0)
+
+    def test_create_delete_post(self):
+        db.get_recent_posts(5)
+        post = db.create_post(item_id=1, user_id=3, return_object=True)
+        try:
+            self.assertEqual(db.get_recent_posts(1),
+                             [db.get_post(post.post_id)])
+            post.review = u'Updated'
+            db.session.commit()
+            self.assertEqual(db.get_recent_posts(1)[0]['review'], u'Updated')
+        finally:
+            db.delete_post(post.post_id)
+        self.assertNotIn(post.post_id, [recent['post_id'] for recent
+                                        in db.get_recent_posts(100)])
+        self.assertEqual(db.get_recent_posts(100),
+                         db.get_recent_posts(n_posts=300)[:100])
+
+class TestFieldsets(unittest.TestCase):
+
+    def test_get_all_posts_fields(self):
+        posts = db.get_all_posts(fields=['post_id', 'rating'])
+        self.assertEqual(posts[-1], {'post_id': 1, 'rating': 4})
+
+    def test_get_all_posts_expand(self):
+        post = db.get_all_posts(expand=['tags'])[-1]
+        self.assertEqual(post, dict((key, DIC_POST_1[key])
+                                    for key in DIC_POST_1
+                                    if key not in ('item', 'photos')))
+
+    def test_get_all_posts_fields_and_expand(self):
+        posts = db.get_all_posts(fields=['post_id', 'item'],
+                                 expand=['item', 'tags'])
+        self.assertEqual(posts[-1], {'post_id': 1, 'item': DIC_ITEM_1})
+
+    def test_get_post(self):
+        self.assertEqual(db.get_post(1, fields=['rating', 'tags']),
+                         {'rating': 4, 'tags': [DIC_TAG_1, DIC_TAG_2]})
+        self.assertEqual(db.get_post(1, expand=['item', 'tags', 'photos']),
+                         DIC_POST_1)
+
+    def test_get_all_items(self):
+        item = [item for item in db.get_all_items(expand=[])
+                if item['item_id'] == 1][0]
+        self.assertEqual(item, dict((key, DIC_ITEM_1[key])
+                                    for key in DIC_ITEM_1
+                                    if key != 'location'))
+
+    def test_get_item(self):
+        self.assertEqual(db.get_item(1, fields=['item_name', 'location']),
+                         {'item_name': u'Some trail', 'location': DIC_LOC_1})
+        self.assertEqual(db.get_item(2, fields=['rating_histogram']),
+                         {'rating_histogram': [0, 0, 2, 0, 0]})
+
+    def test_invalid_fieldset(self):
+        with self.assertRaises(ValueError):
+            db.get_all_posts(fields=['post_id', 'user_id'])
+        with self.assertRaises(ValueError):
+            db.get_post(1, expand=['comments'])
+        with self.assertRaises(ValueError):
+            db.get_all_items(expand=['posts'])
+        with self.assertRaises(ValueError):
+            db.get_all_items(fields=['item_name', 'rating_histogram'])
+
+    def test_iter_all_fields(self):
+        self.assertEqual(list(db.iter_all('posts', batch_size=2,
+                                          fields=['rating'])),
+                         db.get_all_posts(fields=['rating']))
+
+class TestProjections(unittest.TestCase):
+
+    def test_get_all_items(self):
+        items = queries.get_all_obj(queries.Items,
+                                    order_by=lambda x: x['item_name'],
+                                    profile='item')(db)
+        self.assertEqual(db.get_all_items(), items)
+
+    def test_get_all_posts(self):
+        posts = queries.get_all_obj(
+            queries.Posts, order_by=queries.Posts.post_datetime.desc(),
+            profile='post_with_item', with_item=True)(db)
+        self.assertEqual(db.get_all_posts(), posts)
+
+    def test_get_all_tags(self):
+        tags = queries.get_all_obj(queries.Tags,
+                                   order_by=queries.Tags.tag_name)(db)
+        self.assertEqual(db.get_all_tags(), tags)
+
+class TestPagination(unittest.TestCase):
+
+    def pages(self, func, kind, limit, **kwargs):
+        objs, cursor = [], None
+        while True:
+            page = func(limit=limit, cursor=cursor, **kwargs)
+            self.assertLessEqual(len(page), limit)
+            objs.extend(page)
+            cursor = queries.next_cursor(kind, page, limit)
+            if cursor is None:
+                return objs
+
+    def test_get_all_posts(self):
+        self.assertEqual(self.pages(db.get_all_posts, 'posts', 4),
+                         db.get_all_posts())
+
+    def test_get_all_items(self):
+        self.assertEqual(self.pages(db.get_all_items, 'items', 2),
+                         db.get_all_items())
+
+    def test_get_all_tags(self):
+        self.assertEqual(self.pages(db.get_all_tags, 'tags', 1),
+                         db.get_all_tags())
+
+    def test_get_all_categories(self):
+        self.assertEqual(self.pages(db.get_all_categories, 'categories', 3),
+                         db.get_all_categories())
+
+    def test_search_tags(self):
+        self.assertEqual(self.pages(db.search_tags, 'posts', 2,
+                                    string='awesome'),
+                         db.search_tags('awesome'))
+
+    def test_last_page(self):
+        posts = db.get_all_posts()
+        self.assertIsNone(queries.next_cursor('posts', posts, len(posts)+1))
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            db.get_all_posts(limit=2, cursor='notacursor')
+        with self.assertRaises(ValueError):
+            db.get_all_tags(limit=2, cursor='WzFd')
+
+    def test_iter_all(self):
+        for kind in ('posts', 'items', 'tags', 'categories'):
+            self.assertEqual(list(db.iter_all(kind, batch_size=2)),
+                             getattr(db, 'get_all_'+kind)())
+
+    def test_iter_all_unknown_collection(self):
+        with self.assertRaises(ValueError):
+            list(db.iter_all('users'))
+
+    def test_invalid_limit(self):
+        with self.assertRaises(ValueError):
+            db.get_all_tags(limit=0)
 
 class TestGetTag(unittest.TestCase):
 
@@ -154,6 +516,48 @@ class TestGetTag(unittest.TestCase):
         with self.assertRaises(ValueError):
             tags = db.get_popular_tags(n_tags="2 or 1 = 1")
 
+    def test_get_trendy_tags_from_buckets(self):
+        ## Window covered by the buckets: counted in memory
+        def top():
+            return dict(db.trending.top(db.session, db.trending.horizon,
+                                        n_tags=100))
+        bof = top().get(u'bof', 0)
+        post = db.create_post(item_id=1, user_id=3, return_object=True,
+                              tags=[db.get_tag(3, return_object=True)])
+        try:
+            self.assertEqual(top()[u'bof'], bof+1)
+        finally:
+            db.delete_post(post.post_id)
+        self.assertEqual(top().get(u'bof', 0), bof)
+
+    def test_get_trendy_tags_after_restart(self):
+        ## The buckets of a new instance hold the posts already in the
+        ## database
+        post = db.create_post(item_id=1, user_id=3, return_object=True,
+                              tags=[db.get_tag(3, return_object=True)])
+        restarted = queries.DataBase(path='../glob')
+        try:
+            window = datetime.timedelta(hours=24)
+            statements = []
+            def before_execute(*args):
+                statements.append(args)
+            event.listen(restarted.engine, 'before_cursor_execute',
+                         before_execute)
+            try:
+                tags = restarted.trending.top(restarted.session, window,
+                                              n_tags=100)
+            finally:
+                event.remove(restarted.engine, 'before_cursor_execute',
+                             before_execute)
+            self.assertEqual(statements, [])
+            self.assertEqual(tags, restarted.trending.count(
+                restarted.session, datetime.datetime.utcnow()-window,
+                n_tags=100))
+            self.assertIn(u'bof', dict(tags))
+        finally:
+            restarted.session.close()
+            db.delete_post(post.post_id)
+
 class TestSearch(unittest.TestCase):
 
     def test_get_trendy_invalid_input_type(self):
@@ -207,6 +611,446 @@ class TestSearch(unittest.TestCase):
         self.assertEqual(db.search_tags("bof cool awesome"),
                          [DIC_POST_4])
 
+    def test_search_any_tag(self):
+        self.assertEqual(db.search_tags("bof cool", any_tag=True),
+                         [DIC_POST_6, DIC_POST_5, DIC_POST_4, DIC_POST_2,
+                          DIC_POST_1])
+        self.assertEqual(db.search_tags("cool blah", any_tag=True),
+                         [DIC_POST_4, DIC_POST_1])
+
+    def test_search_new_post(self):
+        post = db.create_post(item_id=1, user_id=3, return_object=True,
+                              tags=[db.get_tag(1, return_object=True)])
+        try:
+            self.assertEqual(db.search_tags("cool", limit=1),
+                             [db.get_post(post.post_id)])
+        finally:
+            db.delete_post(post.post_id)
+        self.assertEqual(db.search_tags("cool"), [DIC_POST_4, DIC_POST_1])
+
+class TestLocationDedupe(unittest.TestCase):
+
+    def test_location_key(self):
+        self.assertEqual(queries.location_key(37.774904, -122.419396),
+                         '37.77490,-122.41940')
+        self.assertEqual(queries.location_key(-0.000001, 0),
+                         '0.00000,0.00000')
+
+    def test_find_location(self):
+        location = db.find_location(37.774901, -122.4194,
+                                    address=u' san francisco, CA,  USA')
+        self.assertEqual(location.location_id, 1)
+        self.assertIsNone(db.find_location(37.7749, -122.4194))
+        self.assertIsNone(db.find_location(37.7749, -122.4195,
+                                           address=u'San Francisco, CA, USA'))
+
+    def test_create_item_reuses_location(self):
+        item = db.create_item(item_name=u'Test dedupe item', category_id=8,
+                              location={'lat': 37.7749, 'lon': -122.4194,
+                                        'address': u'San Francisco, CA, USA'},
+                              return_object=True)
+        try:
+            self.assertEqual(item.location_id, 1)
+        finally:
+            db.delete_item(item.item_id)
+
+    def test_merge_duplicate_locations(self):
+        ## Duplicates of the fixture database
+        db.merge_duplicate_locations()
+        first = db.create_location(lat=-33.8688, lon=151.2093,
+                                   address=u'Sydney', return_object=True)
+        second = db.create_location(lat=-33.868801, lon=151.2093,
+                                    address=u'SYDNEY ', return_object=True)
+        item = db.create_item(item_name=u'Test merge item', category_id=8,
+                              location={'location_id': second.location_id},
+                              return_object=True)
+        ## Location created before the grid keys existed
+        db.session.execute(queries.Locations.__table__.update()
+                           .where(queries.Locations.location_id ==
+                                  second.location_id)
+                           .values(geokey=None))
+        db.session.commit()
+        try:
+            second_id = second.location_id
+            self.assertEqual(db.merge_duplicate_locations(batch_size=1), 1)
+            self.assertEqual(item.location_id, first.location_id)
+            self.assertIsNone(db.get_location(second_id))
+            self.assertEqual(db.merge_duplicate_locations(), 0)
+        finally:
+            db.delete_item(item.item_id)
+            db.delete_location(first.location_id)
+
+class TestDuplicateItems(unittest.TestCase):
+
+    TOKYO = {'lat': 35.6762, 'lon': 139.6503, 'address': u'Tokyo'}
+
+    def test_create_item_precheck(self):
+        item = db.create_item(item_name=u'Test Duplicate Hotel',
+                              category_id=8, location=self.TOKYO,
+                              return_object=True)
+        try:
+            with self.assertRaises(
+                    queries.duplicates.DuplicateItemError) as ctx:
+                db.create_item(item_name=u' test duplicate  hotel',
+                               category_id=8,
+                               location={'location_id': item.location_id},
+                               check_duplicates=True)
+            self.assertEqual(ctx.exception.candidates[0]['item_id'],
+                             item.item_id)
+            self.assertEqual(ctx.exception.candidates[0]['similarity'], 1.)
+            ## Other category
+            self.assertEqual(db.find_similar_items(u'Test Duplicate Hotel',
+                                                   category_id=5,
+                                                   location=self.TOKYO), [])
+            other = db.create_item(item_name=u'Test Duplicate Hotels',
+                                   category={'category_id': 8},
+                                   location=self.TOKYO, return_object=True)
+            try:
+                pairs = [(pair['item_id'], pair['duplicate_id'])
+                         for pair in db.find_duplicate_items()]
+                self.assertIn((item.item_id, other.item_id), pairs)
+            finally:
+                db.delete_item(other.item_id)
+        finally:
+            db.delete_item(item.item_id)
+
+    def test_merge_items(self):
+        item = db.create_item(item_name=u'Test Merge Hotel', category_id=8,
+                              location=self.TOKYO, return_object=True)
+        other = db.create_item(item_name=u'Test merge hotel ', category_id=8,
+                               location=self.TOKYO, return_object=True)
+        item_id, other_id = item.item_id, other.item_id
+        posts = [db.create_post(item_id=item_id, user_id=1, rating=2,
+                                review='Test merge', return_object=True),
+                 db.create_post(item_id=other_id, user_id=2, rating=5,
+                                review='Test merge', return_object=True)]
+        try:
+            with self.assertRaises(ValueError):
+                db.merge_items(item_id, [item_id])
+            with self.assertRaises(ValueError):
+                db.merge_items(item_id, [-1])
+            self.assertEqual(db.merge_items(item_id, [other_id]), 'OK')
+            self.assertEqual([post.item_id for post in posts],
+                             [item_id, item_id])
+            dic = db.get_item(item_id)
+            self.assertEqual(dic['rating'], 3.5)
+            self.assertEqual(dic['rating_histogram'], [0, 1, 0, 0, 1])
+            self.assertIsNone(db.get_item(other_id))
+        finally:
+            for post in posts:
+                db.delete_post(post.post_id)
+            db.delete_item(item_id)
+
+class TestNearbyItems(unittest.TestCase):
+
+    def test_within_radius(self):
+        ## Other tests add items at the location of item 1
+        items = db.get_nearby_items(37.8, -122.3, radius=20)
+        self.assertEqual(items[0]['item_id'], 1)
+        self.assertAlmostEqual(items[0]['distance'], 10.86, places=2)
+        self.assertEqual(set(item['location']['location_id']
+                             for item in items), set([1]))
+        self.assertEqual(dict((key, items[0][key]) for key in DIC_ITEM_1),
+                         DIC_ITEM_1)
+        self.assertEqual(db.get_nearby_items(37.8, -122.3, radius=5), [])
+
+    def test_nearest(self):
+        items = db.get_nearby_items(37.8, -122.3, limit=2)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0]['item_id'], 1)
+        self.assertLessEqual(items[0]['distance'], items[1]['distance'])
+
+    def test_category(self):
+        ## Item 3 is in Animals (8) > Cats
+        items = db.get_nearby_items(1, 5, limit=1, category_id=8)
+        self.assertEqual([item['item_id'] for item in items], [3])
+        self.assertEqual(db.get_nearby_items(1, 5, radius=1000,
+                                             category_id=3), [])
+        self.assertIsNone(db.get_nearby_items(1, 5, category_id=3743))
+
+    def test_location_index_sync(self):
+        location = db.create_location(lat=-45.5, lon=170.5,
+                                      return_object=True)
+        item = db.create_item(item_name=u'Test nearby item', category_id=8,
+                              location={'location_id': location.location_id},
+                              return_object=True)
+        try:
+            items = db.get_nearby_items(-45.5, 170.6, radius=10)
+            self.assertEqual([nearby['item_id'] for nearby in items],
+                             [item.item_id])
+        finally:
+            db.delete_item(item.item_id)
+            db.delete_location(location.location_id)
+        self.assertEqual(db.get_nearby_items(-45.5, 170.6, radius=10), [])
+
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            db.get_nearby_items(95, 0)
+        with self.assertRaises(ValueError):
+            db.get_nearby_items(0, 0, radius=-1)
+
+class TestMapClusters(unittest.TestCase):
+
+    def cluster(self, zoom, bbox):
+        clusters = db.get_map_clusters(zoom, bbox)
+        self.assertEqual(len(clusters), 1)
+        return clusters[0]
+
+    def test_get_map_clusters(self):
+        ## Items 1 (San Francisco) and 3 (lat 1.45, lon 5.67)
+        clusters = db.get_map_clusters(0, '-180,-90,180,90')
+        self.assertEqual([cluster['cell'] for cluster in clusters],
+                         [[0, 0, 0], [0, 1, 0]])
+        cluster = self.cluster(16, '-122.5,37,-122,38')
+        self.assertEqual(cluster['cell'], [16, 20964, 19014])
+        self.assertEqual(cluster['lat'], 37.7749)
+        self.assertEqual(cluster['category'], u'Sport\\Hike')
+        self.assertEqual(db.get_map_clusters(16, '-122,37,-121,38'), [])
+
+    def test_incremental_update(self):
+        bbox = '-123,37,-122,38'
+        before = self.cluster(10, bbox)
+        item = db.create_item(item_name=u'Test map item', category_id=8,
+                              location={'lat': 37.77, 'lon': -122.43},
+                              return_object=True)
+        try:
+            cluster = self.cluster(10, bbox)
+            self.assertEqual(cluster['number_of_items'],
+                             before['number_of_items']+1)
+            self.assertEqual(cluster['rating'], before['rating'])
+            self.assertEqual(len(db.get_map_clusters(16, bbox)), 2)
+            post = db.create_post(item_id=item.item_id, user_id=3, rating=1,
+                                  return_object=True)
+            cluster = self.cluster(10, bbox)
+            self.assertLess(cluster['rating'], before['rating'])
+            db.delete_post(post.post_id)
+        finally:
+            db.delete_item(item.item_id)
+        self.assertEqual(self.cluster(10, bbox), before)
+
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            db.get_map_clusters(17, '-180,-90,180,90')
+        with self.assertRaises(ValueError):
+            db.get_map_clusters(1, '-180,-90')
+
+class TestFullTextSearch(unittest.TestCase):
+
+    def test_search(self):
+        results = db.search('hotel california')
+        self.assertEqual([(result['kind'], result['item_id'])
+                          for result in results], [('item', 2)])
+        self.assertEqual(results[0]['snippet'],
+                         u'<b>Hotel</b> <b>California</b>')
+        self.assertEqual([(result['kind'], result['post_id'])
+                          for result in db.search("didn't like")],
+                         [('comment', 1)])
+        self.assertEqual(db.search(u'hotel californ'), [])
+
+    def test_search_pages(self):
+        first = db.search('stuff', limit=1)
+        second = db.search('stuff', limit=1,
+                           cursor=queries.next_cursor('results', first, 1))
+        self.assertEqual(first+second, db.search('stuff'))
+
+    def test_search_sync(self):
+        comment = db.create_comment(comment=u'Best sunset hike ever',
+                                    user_id=2, post_id=3, return_object=True)
+        try:
+            results = db.search('hiking sunsets')
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0]['post_id'], 3)
+            comment.comment = u'Meh'
+            db.session.commit()
+            self.assertEqual(db.search('sunset'), [])
+        finally:
+            db.delete_comment(comment.comment_id)
+        self.assertEqual(len(db.search('meh')), 1)
+
+    def test_search_invalid_query(self):
+        with self.assertRaises(ValueError):
+            db.search(u' -*" ')
+        with self.assertRaises(TypeError):
+            db.search(5)
+        self.assertEqual(db.search(u'awesome" OR "cool'), [])
+
+class TestAutocomplete(unittest.TestCase):
+
+    def test_autocomplete(self):
+        suggestions = db.autocomplete(u'AWE')
+        self.assertEqual(suggestions[0]['kind'], 'tag')
+        self.assertEqual(suggestions[0]['tag_id'], 2)
+        self.assertEqual(suggestions[0]['name'], u'awesome')
+        self.assertIn(3, [suggestion.get('item_id')
+                          for suggestion in suggestions])
+        suggestions = db.autocomplete(u'hik', kind='category')
+        self.assertEqual([suggestion['name'] for suggestion in suggestions],
+                         [u'Sport\\Hike'])
+        self.assertEqual(len(db.autocomplete(u'a', limit=1)), 1)
+        self.assertEqual(db.autocomplete(u' '), [])
+        with self.assertRaises(ValueError):
+            db.autocomplete(u'awe', kind='user')
+
+    def test_autocomplete_updates(self):
+        name = u'Test Typeahead '+DATETIME
+        self.assertEqual(db.autocomplete(name), [])
+        tag = db.create_tag(tag_name=name, return_object=True)
+        [suggestion] = db.autocomplete(name, kind='tag')
+        self.assertEqual(suggestion['tag_id'], tag.tag_id)
+        self.assertEqual(suggestion['score'], 0)
+        post = db.create_post(item_id=4, user_id=1, review='Test typeahead',
+                              tags=[tag], return_object=True)
+        self.assertEqual(db.autocomplete(name)[0]['score'], 1)
+        db.delete_post(post.post_id)
+        db.delete_tag(tag.tag_id)
+        self.assertEqual(db.autocomplete(name), [])
+
+def count_commits(test):
+    '''List that gets an element at every commit of the database session,
+    until the end of `test`
+    '''
+    commits = []
+    def after_commit(session):
+        commits.append(session)
+    event.listen(db.session, 'after_commit', after_commit)
+    test.addCleanup(event.remove, db.session, 'after_commit', after_commit)
+    return commits
+
+class TestBatches(unittest.TestCase):
+
+    def test_create_tags(self):
+        name = u'Test batch tag '+DATETIME
+        results = db.create_tags([{'tag_name': name},
+                                  {'tag_name': name.upper()},
+                                  {'tag_name': u'Awesome'},
+                                  {'name': name},
+                                  name])
+        try:
+            self.assertEqual(results[0].keys(), ['tag_id'])
+            self.assertEqual([result.keys() for result in results[1:]],
+                             [['error']]*4)
+            self.assertEqual(db.get_tag(results[0]['tag_id'])['tag_name'],
+                             name.lower())
+        finally:
+            db.delete_tag(results[0]['tag_id'])
+        with self.assertRaises(TypeError):
+            db.create_tags({'tag_name': name})
+
+    def test_create_posts(self):
+        name = u'Test batch post tag '+DATETIME
+        commits = count_commits(self)
+        results = db.create_posts([
+            {'item_id': 4, 'user_id': 1, 'review': 'Test batch',
+             'rating': 4, 'tags': [name, {'tag_id': 1}]},
+            {'item': {'item_id': 4}, 'user_id': 2, 'review': 'Test batch',
+             'tags': [{'tag_name': name.upper()}]},
+            {'item_id': -1, 'user_id': 1},
+            {'item_id': 4, 'user_id': -1},
+            {'item_id': 4, 'user_id': 1, 'tags': [{'tag_id': -1}]},
+            {'item_id': 4, 'user_id': 1, 'blah': 'blah'}])
+        self.assertEqual(len(commits), 1)
+        posts = [db.get_post(result['post_id'], return_object=True)
+                 for result in results[:2]]
+        try:
+            self.assertEqual([result.keys() for result in results[2:]],
+                             [['error']]*4)
+            tag = db.get_tag(tag_name=name, return_object=True)
+            self.assertEqual(tag.number_of_posts, 2)
+            self.assertEqual([[tag.tag_name for tag in post.tags]
+                              for post in posts],
+                             [[name.lower(), u'cool'], [name.lower()]])
+        finally:
+            for post in posts:
+                db.delete_post(post.post_id)
+            db.delete_tag(tag.tag_id)
+
+    def test_create_items(self):
+        location = {'lat': -41.2865, 'lon': 174.7762, 'address': u'Wellington'}
+        results = db.create_items([
+            {'item_name': u'Test batch item A', 'category_id': 8,
+             'location': dict(location)},
+            {'item_name': u'Test batch item B',
+             'category': {'category_id': 8}, 'location': dict(location)},
+            {'item_name': u'Test batch item C', 'category_id': -1},
+            {'item_name': u'Test batch item D', 'category_id': 8,
+             'location': {'location_id': -1}}])
+        try:
+            items = [db.get_item(result['item_id'])
+                     for result in results[:2]]
+            self.assertEqual(items[0]['location']['location_id'],
+                             items[1]['location']['location_id'])
+            self.assertEqual([result.keys() for result in results[2:]],
+                             [['error']]*2)
+        finally:
+            for item in items:
+                db.delete_item(item['item_id'])
+            db.delete_location(items[0]['location']['location_id'])
+
+    def test_create_likes_and_comments(self):
+        post = db.create_post(item_id=4, user_id=1, review='Test batch',
+                              return_object=True)
+        try:
+            results = db.create_likes([
+                {'post_id': post.post_id, 'user_id': 2},
+                {'post_id': post.post_id, 'user_id': 2},
+                {'post_id': post.post_id, 'user_id': -1}])
+            self.assertEqual(results[0], {'post_id': post.post_id,
+                                          'user_id': 2})
+            self.assertEqual([result.keys() for result in results[1:]],
+                             [['error']]*2)
+            results = db.create_comments([
+                {'post_id': post.post_id, 'user_id': 2, 'comment': 'Test'},
+                {'post_id': -1, 'user_id': 2, 'comment': 'Test'}])
+            self.assertEqual(db.get_comment(results[0]['comment_id']).post_id,
+                             post.post_id)
+            self.assertIn('error', results[1])
+        finally:
+            db.delete_like(post_id=post.post_id, user_id=2)
+            db.delete_post(post.post_id)
+
+class TestNestedCreation(unittest.TestCase):
+
+    def test_create_post_single_commit(self):
+        names = [u'Test nested A '+DATETIME, u'Test nested B '+DATETIME]
+        commits = count_commits(self)
+        post = db.create_post(
+            item={'item_name': u'Test nested item '+DATETIME,
+                  'category': {'category_name': u'Test nested '+DATETIME},
+                  'location': {'lat': 64.1466, 'lon': -21.9426,
+                               'address': u'Reykjavik'}},
+            user_id=1, rating=5, review='Test nested',
+            tags=[names[0], {'tag_name': names[1]}, names[0].upper()],
+            return_object=True)
+        item, category = post.item, post.item.category
+        try:
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(category.category_name, u'Test nested '+DATETIME)
+            self.assertEqual(item.location.address, u'Reykjavik')
+            self.assertEqual(item.rating, 5.)
+            self.assertEqual(len(set(tag.tag_id for tag in post.tags)), 2)
+        finally:
+            tags = list(post.tags)
+            db.delete_post(post.post_id)
+            for tag in tags:
+                db.delete_tag(tag.tag_id)
+            db.delete_item(item.item_id)
+            db.delete_location(item.location_id)
+            db.delete_category(category.category_id)
+
+    def test_create_post_rollback(self):
+        name = u'Test nested rollback '+DATETIME
+        with self.assertRaises(TypeError):
+            db.create_post(item={'item_name': name,
+                                 'category': {'category_name': name},
+                                 'location': {'lat': 64.1466,
+                                              'lon': -21.9426}},
+                           user_id=1, tags=[name], photos=1)
+        self.assertEqual(len(db.session.new), 0)
+        db.session.commit()
+        self.assertIsNone(db.get_tag(tag_name=name))
+        self.assertEqual(db.session.query(queries.Items)
+                         .filter(queries.Items.item_name == name).count(), 0)
+
 class TestPosting(unittest.TestCase):
 
     def test_create_photo_string(self):
@@ -501,6 +1345,39 @@ class TestPosting(unittest.TestCase):
                                {'tag_name': 'Test PostTag '+DATETIME},
                                {'tag_name': 'Test PostTag4 '+DATETIME}])
 
+    def test_item_rating_aggregates(self):
+        item = db.create_item(item_name='Test rating aggregates',
+                              category_id=3, return_object=True)
+        post1 = db.create_post(item_id=item.item_id, user_id=1, rating=4,
+                               return_object=True)
+        post2 = db.create_post(item=item, user_id=2, rating=2,
+                               return_object=True)
+        db.create_post(item=item, user_id=3, review='Test no rating')
+        dic = db.get_item(item.item_id)
+        self.assertEqual(dic['rating'], 3.)
+        self.assertEqual(dic['rating_histogram'], [0, 1, 0, 1, 0])
+        db.delete_post(post1.post_id)
+        dic = db.get_item(item.item_id)
+        self.assertEqual(dic['rating'], 2.)
+        self.assertEqual(dic['rating_histogram'], [0, 1, 0, 0, 0])
+
+    def test_tag_post_counts(self):
+        post = db.create_post(item_id=4, user_id=1, review='Test tag counts',
+                              tags=['Test count A '+DATETIME],
+                              return_object=True)
+        tag_a = db.get_tag(tag_name='Test count A '+DATETIME,
+                           return_object=True)
+        tag_b = db.create_tag(tag_name='Test count B '+DATETIME,
+                              return_object=True)
+        self.assertEqual(tag_a.number_of_posts, 1)
+        self.assertEqual(tag_b.number_of_posts, 0)
+        post.tags.append(tag_b)
+        db.session.commit()
+        self.assertEqual(tag_b.number_of_posts, 1)
+        db.delete_post(post.post_id)
+        self.assertEqual(tag_a.number_of_posts, 0)
+        self.assertEqual(tag_b.number_of_posts, 0)
+
     def test_create_user_missing_email(self):
         with self.assertRaises(TypeError):
             db.create_user(secondary_login='000',
@@ -531,7 +1408,31 @@ class TestZDelete(unittest.TestCase):
         child2 = db.create_category(category_name='Test for deletion 3',
                                     parent_id=obj.category_id,
                                     return_object=True)
+        child1_id = child1.category_id
+        child2_id = child2.category_id
+        db.delete_category(obj.category_id)
+        self.assertIsNone(db.get_category(child1_id))
+        self.assertIsNone(db.get_category(child2_id))
+        self.assertIsNone(db.get_category_items(child1_id, recursive=True))
+
+    def test_delete_category_with_items(self):
+        obj = db.create_category(category_name='Test for deletion',
+                                 return_object=True)
+        child = db.create_category(category_name='Test for deletion 2',
+                                   parent_id=obj.category_id,
+                                   return_object=True)
+        item = db.create_item(item_name='Test delete category with items',
+                              category=child, return_object=True)
+        with self.assertRaises(queries.IntegrityError):
+            db.delete_category(obj.category_id)
+        self.assertIsNotNone(db.get_category(child.category_id))
+        self.assertEqual(
+            [dic['item_id'] for dic in
+             db.get_category_items(obj.category_id, recursive=True)],
+            [item.item_id])
+        db.delete_item(item.item_id)
         db.delete_category(obj.category_id)
+        self.assertIsNone(db.get_category(child.category_id))
 
     def test_delete_location(self):
         obj = db.create_location(lat=3.45, lon=6.78, return_object=True)
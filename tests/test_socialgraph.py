@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.socialgraph
+'''
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from socialgraph import FriendSuggestions, SocialGraph
+
+## 1 - 2 - 3 - 4 - 5, 2 - 6 and 7 alone
+EDGES = [(1, 2), (3, 2), (3, 4), (4, 5), (6, 2)]
+
+class TestSocialGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = SocialGraph(max_changes=3)
+        self.graph.build(EDGES)
+
+    def test_friends(self):
+        self.assertEqual(list(self.graph.friends(2)), [1, 3, 6])
+        self.assertEqual(list(self.graph.friends(7)), [])
+
+    def test_are_linked(self):
+        self.assertTrue(self.graph.are_linked(2, 3))
+        self.assertTrue(self.graph.are_linked(3, 2))
+        self.assertFalse(self.graph.are_linked(1, 3))
+
+    def test_within(self):
+        self.assertEqual(self.graph.within(1), {2: 1, 3: 2, 6: 2})
+        self.assertEqual(self.graph.within(1, max_depth=1), {2: 1})
+        self.assertEqual(len(self.graph.within(1, max_depth=5, limit=2)), 2)
+
+    def test_friends_of_friends(self):
+        self.assertEqual(self.graph.friends_of_friends(3), [1, 5, 6])
+
+    def test_distance(self):
+        self.assertEqual(self.graph.distance(1, 1), 0)
+        self.assertEqual(self.graph.distance(1, 2), 1)
+        self.assertEqual(self.graph.distance(1, 5), 4)
+        self.assertEqual(self.graph.distance(6, 5), 4)
+        self.assertIsNone(self.graph.distance(1, 5, max_depth=3))
+        self.assertIsNone(self.graph.distance(1, 7))
+
+    def test_add_remove_edge(self):
+        self.graph.add_edge(1, 5)
+        self.assertEqual(list(self.graph.friends(5)), [1, 4])
+        self.assertEqual(self.graph.distance(1, 4), 2)
+        self.graph.remove_edge(2, 3)
+        self.assertEqual(list(self.graph.friends(2)), [1, 6])
+        self.assertEqual(self.graph.distance(6, 3), 5)
+        self.graph.add_edge(2, 3)
+        self.assertEqual(self.graph.n_changes, 3)
+        self.assertEqual(list(self.graph.friends(3)), [2, 4])
+
+    def test_compact(self):
+        for first, second in [(1, 7), (5, 7), (2, 4), (1, 2)]:
+            self.graph.add_edge(first, second)
+        self.graph.remove_edge(1, 2)
+        ## The overlays are merged into the arrays after more than 3 changes
+        self.assertEqual((self.graph.added, self.graph.removed), ({}, {}))
+        self.assertEqual(self.graph.n_changes, 0)
+        self.assertEqual(sorted(self.graph.edges()),
+                         [(1, 7), (2, 3), (2, 4), (2, 6), (3, 4), (4, 5),
+                          (5, 7)])
+
+class TestFriendSuggestions(unittest.TestCase):
+
+    def setUp(self):
+        self.friends = SocialGraph()
+        self.friends.build(EDGES+[(1, 3), (4, 6)])
+        self.excluded = SocialGraph()
+        self.excluded.build([(1, 6)])
+        self.suggestions = FriendSuggestions(self.friends, self.excluded, k=2)
+
+    def test_common_friends(self):
+        self.assertEqual(self.suggestions.common_friends(1),
+                         {2: 1, 3: 1, 4: 1, 6: 1})
+
+    def test_suggest(self):
+        self.assertEqual(self.suggestions.suggest(1), [(4, 1)])
+        self.assertEqual(self.suggestions.suggest(5), [(3, 1), (6, 1)])
+        self.assertEqual(self.suggestions.suggest(7), [])
+
+    def test_compute_all(self):
+        self.suggestions.compute_all()
+        self.assertEqual(sorted(self.suggestions.cache), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.suggestions.cache[6], [(3, 2), (5, 1)])
+
+    def test_refresh(self):
+        self.assertEqual(self.suggestions.suggest(5), [(3, 1), (6, 1)])
+        self.friends.add_edge(5, 2)
+        self.assertEqual(self.suggestions.suggest(5), [(3, 2), (6, 2)])
+        self.excluded.add_edge(5, 3)
+        self.assertEqual(self.suggestions.suggest(5), [(6, 2), (1, 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.tagindex
+'''
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from tagindex import Bitmap, TagIndex
+
+class TestBitmap(unittest.TestCase):
+
+    def setUp(self):
+        self.first = Bitmap([1, 5, 70000, 200000])
+        self.second = Bitmap([5, 6, 200000, 300000])
+
+    def test_contains(self):
+        self.assertIn(70000, self.first)
+        self.assertNotIn(70001, self.first)
+        self.assertEqual(len(self.first), 4)
+
+    def test_discard(self):
+        self.first.discard(70000)
+        self.first.discard(3743)
+        self.assertNotIn(70000, self.first)
+        self.assertEqual(sorted(self.first.chunks), [0, 3])
+
+    def test_and_or(self):
+        self.assertEqual(list((self.first & self.second).descending()),
+                         [200000, 5])
+        self.assertEqual(list((self.first | self.second).descending()),
+                         [300000, 200000, 70000, 6, 5, 1])
+
+    def test_descending(self):
+        self.assertEqual(list(self.first.descending(before=200000)),
+                         [70000, 5, 1])
+        self.assertEqual(list(self.first.descending(before=70000)), [5, 1])
+        self.assertEqual(list(Bitmap().descending()), [])
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TagIndex()
+        self.index.loaded = True
+        ## Post 3 was created with an earlier datetime than post 2
+        datetimes = {1: datetime.datetime(2017, 9, 1),
+                     2: datetime.datetime(2017, 9, 3),
+                     3: datetime.datetime(2017, 9, 2),
+                     4: datetime.datetime(2017, 9, 4)}
+        for tag_name, post_id in [(u'hike', 1), (u'hike', 2), (u'sunset', 2),
+                                  (u'sunset', 3), (u'hike', 4)]:
+            self.index.add(tag_name, post_id, datetimes[post_id])
+
+    def test_post_ids(self):
+        self.assertEqual(self.index.post_ids(None, [u'hike', u'sunset']), [2])
+        self.assertEqual(self.index.post_ids(None, [u'hike', u'sunset'],
+                                             any_tag=True),
+                         [4, 2, 3, 1])
+        self.assertEqual(self.index.post_ids(
+            None, [u'hike'], limit=2,
+            after=[datetime.datetime(2017, 9, 4), 4]), [2, 1])
+        self.assertEqual(self.index.post_ids(
+            None, [u'hike', u'sunset'], any_tag=True,
+            after=[datetime.datetime(2017, 9, 3), 2]), [3, 1])
+        self.assertEqual(self.index.post_ids(None, [u'hike', u'blah']), [])
+
+    def test_remove(self):
+        self.index.remove(u'sunset', 2)
+        self.index.remove(u'sunset', 3)
+        self.assertNotIn(u'sunset', self.index.bitmaps)
+        self.assertEqual(self.index.post_ids(None, [u'hike', u'sunset'],
+                                             any_tag=True), [4, 2, 1])
+
+if __name__ == '__main__':
+    unittest.main()
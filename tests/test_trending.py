@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.trending
+'''
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from trending import TrendingTags, parse_window
+
+NOW = datetime.datetime(2017, 10, 1, 12, 0)
+
+class TestTrendingTags(unittest.TestCase):
+
+    def setUp(self):
+        self.trending = TrendingTags(horizon=datetime.timedelta(days=1))
+        self.trending.start = NOW-datetime.timedelta(days=1)
+        for minutes, tag_name in [(1, u'cool'), (2, u'bof'), (3, u'cool'),
+                                  (90, u'bof'), (100, u'bof'),
+                                  (2000, u'cool')]:
+            self.trending.add(NOW-datetime.timedelta(minutes=minutes),
+                              tag_name)
+
+    def top(self, **window):
+        return self.trending.top(None, datetime.timedelta(**window), now=NOW)
+
+    def test_top(self):
+        self.assertEqual(self.top(hours=1), [(u'cool', 2), (u'bof', 1)])
+        self.assertEqual(self.top(hours=2), [(u'bof', 3), (u'cool', 2)])
+        self.assertEqual(self.trending.top(None, datetime.timedelta(hours=2),
+                                           n_tags=1, now=NOW),
+                         [(u'bof', 3)])
+
+    def test_remove(self):
+        self.trending.add(NOW-datetime.timedelta(minutes=2), u'bof', -1)
+        self.assertEqual(self.top(hours=1), [(u'cool', 2)])
+
+    def test_prune(self):
+        self.assertEqual(len(self.trending.buckets), 6)
+        self.top(hours=1)
+        ## The bucket older than a day is dropped
+        self.assertEqual(len(self.trending.buckets), 5)
+
+    def test_parse_window(self):
+        self.assertEqual(parse_window('1h'), datetime.timedelta(hours=1))
+        self.assertEqual(parse_window('24h'), datetime.timedelta(days=1))
+        self.assertEqual(parse_window('7d'), datetime.timedelta(days=7))
+        self.assertEqual(parse_window('90m'), datetime.timedelta(minutes=90))
+        for window in ('', '0h', '1w', 'h', '1.5h', None):
+            with self.assertRaises(ValueError):
+                parse_window(window)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for glob.typeahead
+'''
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'glob'))
+
+from typeahead import PrefixIndex, word_keys
+
+class TestTypeahead(unittest.TestCase):
+
+    def test_word_keys(self):
+        self.assertEqual(word_keys(u'Hotel  California'),
+                         [u'hotel california', u'california'])
+        self.assertEqual(word_keys(u'Sport\\Hike'), [u'sport hike', u'hike'])
+
+    def test_lookup(self):
+        index = PrefixIndex()
+        index.set(1, u'Hotel California', 2)
+        index.set(2, u'Hotel Carolina', 5)
+        index.set(3, u'Cafe', 2)
+        self.assertEqual(index.lookup(u'hotel ca', 10),
+                         [(2, u'Hotel Carolina', 5),
+                          (1, u'Hotel California', 2)])
+        ## Word prefixes, ties by name
+        self.assertEqual([entry[0] for entry in index.lookup(u'ca', 10)],
+                         [2, 3, 1])
+        self.assertEqual(index.lookup(u'ca', 1), [(2, u'Hotel Carolina', 5)])
+        self.assertEqual(index.lookup(u'x', 10), [])
+
+    def test_update(self):
+        index = PrefixIndex()
+        index.set(1, u'Hotel California', 2)
+        self.assertEqual(len(index.lookup(u'h', 10)), 1)
+        index.set(1, u'Motel California', 3)
+        self.assertEqual(index.lookup(u'h', 10), [])
+        self.assertEqual(index.lookup(u'm', 10),
+                         [(1, u'Motel California', 3)])
+        index.remove(1)
+        index.remove(1)
+        self.assertEqual(index.lookup(u'm', 10), [])
+        self.assertEqual(index.keys, [])
+
+if __name__ == '__main__':
+    unittest.main()